@@ -7,11 +7,11 @@
 #
 
 import appModuleHandler
-import os, sys
-
-parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-sys.path.insert(0, os.path.join(parentdir, "globalPlugins", "Windows7Magnifier"))
-import Windows7MagnifierConfig
+# The plugin's own config module, so both share one configuration
+from globalPlugins.Windows7Magnifier import Windows7MagnifierConfig
 
 class AppModule(appModuleHandler.AppModule):
-	sleepMode = Windows7MagnifierConfig.conf["magnifier"]["muteNVDA"]
+
+	def __init__(self, *args, **kwargs):
+		super(AppModule, self).__init__(*args, **kwargs)
+		self.sleepMode = Windows7MagnifierConfig.getConf()["magnifier"]["muteNVDA"]
@@ -1,5 +1,7 @@
 import config
 import os, sys
+import threading
+import time
 
 import globalVars
 import addonHandler
@@ -13,8 +15,14 @@ confspec = ConfigObj(StringIO(
 [magnifier]
 	startWithNVDA = boolean(default=True),
 	closeWithNVDA = boolean(default=True),
+	restartMagnifier = boolean(default=True),
 	hideMagnifierControls = boolean(default=True),
 	muteNVDA = boolean(default=True),
+	settingsBackend = option("registry", "dialog", default="registry"),
+	tracing = boolean(default=False),
+	recordCalls = boolean(default=False),
+	profileSwitchDelay = float(default=0.5,min=0,max=10),
+	zoomPresets = int_list(default=list(200, 400, 800)),
 	mode = string(default=Fullscreen), 
 	invertColors = boolean(default=False), 
 	followMouse = boolean(default=True), 
@@ -26,38 +34,179 @@ confspec = ConfigObj(StringIO(
 ), list_values=False, encoding="UTF-8") 
 confspec.newlines = "\r\n" 
 
+#: The options a profile may set, see L{getProfiles}
+PROFILE_OPTIONS = (
+	"mode", "invertColors", "followMouse", "followKeyboard",
+	"followTextInsertion", "lensSizeHorizontal", "lensSizeVertical",
+)
+
+#: The tracking options, at least one of which must be enabled in
+#: Fullscreen and Docked modes (they don't apply to Lens mode)
+FOLLOW_OPTIONS = ("followMouse", "followKeyboard", "followTextInsertion")
+
+#: The [magnifier] options, in the order of confspec
+FIELDS = (
+	"startWithNVDA", "closeWithNVDA", "restartMagnifier",
+	"hideMagnifierControls", "muteNVDA", "settingsBackend", "tracing",
+	"recordCalls", "profileSwitchDelay", "zoomPresets", "mode",
+	"invertColors", "followMouse", "followKeyboard",
+	"followTextInsertion", "lensSizeHorizontal", "lensSizeVertical",
+)
+
+#: The loaded configuration. Use L{getConf}, which loads it on first use.
 conf = None
+#: The settings snapshot, see L{getSettings}
+settings = None
+_loadLock = threading.RLock()
+_saveLock = threading.Lock()
+# (modification time, size) of the file when it was last loaded or saved
+_fileStamp = None
+# The defaults are copied into the file on the first save only
+_defaultsCopied = False
+# The parsed [profiles] section, see L{getProfiles}
+_profiles = None
 
-def load(factoryDefaults=False): 
-	"""Loads the configuration from the configFile. 
-	It also takes note of the file's modification time so that L{save} won't lose any changes made to the file while NVDA is running. 
-	""" 
-	global conf, confspec
-	
-	configFileName = os.path.join(globalVars.appArgs.configPath, "windows7magnifier.ini") 
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+def getConf():
+	""" The addon's configuration, loaded from the configFile the first
+	time it's needed rather than when this module is imported.
+	@returns: the configuration
+	@rtype: ConfigObj
+	"""
+	if conf is None:
+		with _loadLock:
+			if conf is None: load()
+	return conf
+
+def getSettings():
+	""" The typed settings snapshot, created (and the configuration
+	loaded) on first use. Changes made through it are saved in the
+	background.
+	@rtype: L{MagnifierSettings}
+	"""
+	global settings
+	if settings is None:
+		with _loadLock:
+			if settings is None:
+				settings = MagnifierSettings(getConf()["magnifier"])
+				settings.saver = ConfigSaver(save, check=checkForChanges)
+	return settings
+
+def getProfiles():
+	""" The per application profiles: each is a [[section]] of [profiles]
+	named after an application (e.g. winword), giving the magnifier
+	options which apply while it's in the foreground. Options a profile
+	leaves out keep their [magnifier] value.
+	@returns: the options of each profile, by application name. The same
+	object is returned until the configuration is (re)loaded.
+	@rtype: dict
+	"""
+	global _profiles
+	profiles = _profiles
+	if profiles is None:
+		with _loadLock:
+			profiles = {}
+			for appName, section in getConf().get("profiles", {}).items():
+				if not isinstance(section, dict): continue
+				options = {}
+				for name, value in section.items():
+					if name not in PROFILE_OPTIONS:
+						log.warning("Magnifier: unknown option %s in profile %s" % (name, appName))
+						continue
+					# Checked against the same spec as the [magnifier] option
+					try:
+						value = config.val.check(confspec["magnifier"][name], value)
+					except Exception, e:
+						log.warning("Magnifier: invalid %s in profile %s: %s" % (name, appName, e))
+						continue
+					if name == "mode" and value not in ("Fullscreen", "Docked", "Lens"):
+						log.warning("Magnifier: invalid mode %s in profile %s" % (value, appName))
+						continue
+					options[name] = value
+				# The magnifier can't follow nothing, except in Lens mode,
+				# where the follow options don't apply
+				merged = dict(getConf()["magnifier"])
+				merged.update(options)
+				if merged["mode"] != "Lens" and not any(merged[name] for name in FOLLOW_OPTIONS):
+					log.warning("Magnifier: profile %s follows neither the mouse, the keyboard nor the text cursor; ignoring it" % appName)
+					continue
+				profiles[appName.lower()] = options
+			_profiles = profiles
+	return profiles
+
+def _parse(configFileName, factoryDefaults=False):
 	if factoryDefaults: 
-		conf = ConfigObj(None, configspec=confspec, indent_type="\t", encoding="UTF-8") 
-		conf.filename=configFileName 
+		parsed = ConfigObj(None, configspec=confspec, indent_type="\t", encoding="UTF-8") 
+		parsed.filename=configFileName 
 	else: 
 		try: 
-			conf = ConfigObj(configFileName, configspec = confspec, indent_type = "\t", encoding="UTF-8") 
+			parsed = ConfigObj(configFileName, configspec = confspec, indent_type = "\t", encoding="UTF-8") 
 		except ConfigObjError as e: 
-			conf = ConfigObj(None, configspec = confspec, indent_type = "\t", encoding="UTF-8") 
-			conf.filename = configFileName 
+			parsed = ConfigObj(None, configspec = confspec, indent_type = "\t", encoding="UTF-8") 
+			parsed.filename = configFileName 
 			log.warn("Error parsing configuration file: %s" % e) 
 			
 	# Python converts \r\n to \n when reading files in Windows, so ConfigObj can't determine the true line ending. 
-	conf.newlines = "\r\n" 
-	errorList = config.validateConfig(conf, config.val)
+	parsed.newlines = "\r\n" 
+	errorList = config.validateConfig(parsed, config.val)
 	if errorList:
-		log.warn("Errors in configuration file '%s':\n%s" % (conf.filename, "\n".join(errorList)))
+		log.warn("Errors in configuration file '%s':\n%s" % (parsed.filename, "\n".join(errorList)))
+	return parsed
+
+def _stamp(path):
+	try:
+		info = os.stat(path)
+	except OSError:
+		return None
+	return (info.st_mtime, info.st_size)
+
+def load(factoryDefaults=False): 
+	"""Loads the configuration from the configFile. 
+	It also takes note of the file's modification time so that L{save} won't lose any changes made to the file while NVDA is running. 
+	""" 
+	global conf, confspec, _fileStamp, _profiles
+	
+	configFileName = os.path.join(globalVars.appArgs.configPath, "windows7magnifier.ini") 
+	_fileStamp = _stamp(configFileName)
+	conf = _parse(configFileName, factoryDefaults)
+	_profiles = None
+	if settings is not None:
+		settings.replaceAll(conf["magnifier"])
+
+def reloadIfChanged():
+	""" Pick up changes made to the file outside of the addon. Values
+	changed in the addon but not yet saved take precedence.
+	@returns: True if the file had changed
+	"""
+	global conf, _fileStamp, _profiles
+	getConf()
+	stamp = _stamp(conf.filename)
+	if stamp == _fileStamp or stamp is None: return False
+	log.info("Magnifier: %s was changed outside the addon, reloading" % conf.filename)
+	_fileStamp = stamp
+	conf = _parse(conf.filename)
+	_profiles = None
+	if settings is not None:
+		settings.mergeExternal(conf["magnifier"])
+	return True
+
+def checkForChanges():
+	""" L{reloadIfChanged}, kept apart from saves. Run on the saver's
+	thread when asked (see L{ConfigSaver.requestCheck}), so edits made to
+	the file by hand are noticed without waiting for the next save.
+	"""
+	with _saveLock:
+		return reloadIfChanged()
 
 def save(): 
-	"""Saves the configuration to the config file. 
+	"""Saves the configuration to the config file. The file is replaced
+	atomically, so it's never left partially written.
 	""" 
 	#We never want to save config if runing securely 
 	if globalVars.appArgs.secure: return 
-	global conf 
+	global _fileStamp, _defaultsCopied
 
 	if not os.path.isdir(globalVars.appArgs.configPath): 
 		try: 
@@ -66,14 +215,247 @@ def save():
 			log.warning("Could not create configuration directory") 
 			log.debugWarning("", exc_info=True) 
 			raise e 
-	try: 
-		# Copy default settings and formatting. 
-		conf.validate(config.val, copy=True) 
-		conf.write() 
-		log.info("Configuration saved") 
-	except Exception, e: 
-		log.warning("Could not save configuration - probably read only file system") 
-		log.debugWarning("", exc_info=True) 
-		raise e
-
-load()
+	with _saveLock:
+		reloadIfChanged()
+		dirty = settings.takeDirty() if settings is not None else {}
+		section = conf["magnifier"]
+		for name, value in dirty.items():
+			section[name] = value
+		try: 
+			if not _defaultsCopied:
+				# Copy default settings and formatting. 
+				conf.validate(config.val, copy=True) 
+				_defaultsCopied = True
+			tempName = conf.filename + ".tmp"
+			with open(tempName, "wb") as f:
+				conf.write(f)
+				f.flush()
+				os.fsync(f.fileno())
+			_replaceFile(tempName, conf.filename)
+			_fileStamp = _stamp(conf.filename)
+			log.info("Configuration saved") 
+		except Exception, e: 
+			# Keep the changes so the next save tries them again
+			if dirty: settings.markDirty(dirty)
+			log.warning("Could not save configuration - probably read only file system") 
+			log.debugWarning("", exc_info=True) 
+			raise e
+
+def _replaceFile(source, destination):
+	if os.name == "nt":
+		# os.rename won't replace an existing file on Windows
+		import winBindings
+		winBindings.get().moveFileEx(source, destination, MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH)
+	else:
+		os.rename(source, destination)
+
+class MagnifierSettings(object):
+	""" The [magnifier] options as typed attributes, e.g.
+	settings.invertColors. Change them through L{update}, which
+	records which fields are dirty (unsaved) and tells subscribers.
+	"""
+
+	__slots__ = FIELDS + ("saver", "_lock", "_dirty", "_subscribers")
+
+	def __init__(self, section):
+		""" @param section: the validated [magnifier] section
+		"""
+		object.__setattr__(self, "saver", None)
+		object.__setattr__(self, "_lock", threading.Lock())
+		object.__setattr__(self, "_dirty", set())
+		object.__setattr__(self, "_subscribers", [])
+		for name in FIELDS:
+			object.__setattr__(self, name, section[name])
+
+	def __setattr__(self, name, value):
+		if name in FIELDS:
+			self.update(**{name: value})
+		else:
+			object.__setattr__(self, name, value)
+
+	def update(self, **values):
+		""" Change options, then notify subscribers and schedule a save
+		@returns: the options which actually changed, with their new values
+		@rtype: dict
+		"""
+		changes = {}
+		with self._lock:
+			for name, value in values.items():
+				if name not in FIELDS: raise AttributeError(name)
+				if getattr(self, name) != value:
+					object.__setattr__(self, name, value)
+					self._dirty.add(name)
+					changes[name] = value
+		if changes:
+			self._notify(changes, False)
+			if self.saver: self.saver.request()
+		return changes
+
+	def snapshot(self):
+		""" @returns: every option's value
+		@rtype: dict
+		"""
+		with self._lock:
+			return dict((name, getattr(self, name)) for name in FIELDS)
+
+	@property
+	def dirty(self):
+		""" The options changed since they were last saved
+		"""
+		with self._lock:
+			return frozenset(self._dirty)
+
+	def takeDirty(self):
+		""" Clear the dirty set
+		@returns: the dirty options with their values
+		@rtype: dict
+		"""
+		with self._lock:
+			dirty = dict((name, getattr(self, name)) for name in self._dirty)
+			self._dirty.clear()
+			return dirty
+
+	def markDirty(self, names):
+		""" Mark options as needing to be saved (again)
+		"""
+		with self._lock:
+			self._dirty.update(names)
+
+	def mergeExternal(self, section):
+		""" Take on values from a file changed outside of the addon,
+		except for options with unsaved changes
+		"""
+		changes = {}
+		with self._lock:
+			for name in FIELDS:
+				if name in self._dirty or getattr(self, name) == section[name]: continue
+				object.__setattr__(self, name, section[name])
+				changes[name] = section[name]
+		if changes: self._notify(changes, True)
+
+	def replaceAll(self, section):
+		""" Take on every value from a freshly loaded file
+		"""
+		with self._lock:
+			self._dirty.clear()
+		self.mergeExternal(section)
+
+	def subscribe(self, callback):
+		""" @param callback: called as callback(changes, external) after
+			options change. changes maps option names to new values;
+			external is True when the file was changed outside the addon.
+		"""
+		self._subscribers.append(callback)
+
+	def unsubscribe(self, callback):
+		if callback in self._subscribers:
+			self._subscribers.remove(callback)
+
+	def _notify(self, changes, external):
+		for callback in list(self._subscribers):
+			try:
+				callback(changes, external)
+			except:
+				log.error("Magnifier: settings subscriber failed", exc_info=True)
+
+class ConfigSaver(object):
+	""" Saves on a background thread once changes stop arriving for a
+	short while, so a burst of changes is written once and the GUI
+	thread never waits on the disk.
+	"""
+
+	def __init__(self, save, delay=1.0, clock=time.time, check=None):
+		""" @param save: performs the save
+		@param delay: seconds without changes before saving
+		@param check: optional function run by L{requestCheck}, e.g. to
+		look for changes made to the file outside the addon
+		"""
+		self._save = save
+		self.delay = delay
+		self.clock = clock
+		self.check = check
+		self.thread = None
+		self._cond = threading.Condition()
+		self._deadline = None
+		self._checkPending = False
+		self._running = False
+		# Statistics
+		self.requests = 0
+		self.saves = 0
+		self.failures = 0
+
+	def request(self):
+		""" Save soon. Returns immediately.
+		"""
+		with self._cond:
+			self.requests += 1
+			self._deadline = self.clock() + self.delay
+			self._startThread()
+			self._cond.notify()
+
+	def requestCheck(self):
+		""" Run the check function soon, on the saver's thread. Returns
+		immediately.
+		"""
+		if self.check is None: return
+		with self._cond:
+			self._checkPending = True
+			self._startThread()
+			self._cond.notify()
+
+	@property
+	def pending(self):
+		with self._cond:
+			return self._deadline is not None
+
+	def flush(self):
+		""" Save now, on this thread, if a save is pending
+		"""
+		with self._cond:
+			if self._deadline is None: return
+			self._deadline = None
+		self._doSave()
+
+	def stop(self):
+		""" Save anything pending and end the thread
+		"""
+		self.flush()
+		with self._cond:
+			self._running = False
+			self._cond.notify()
+		if self.thread and self.thread is not threading.currentThread():
+			self.thread.join(5)
+		self.thread = None
+
+	def _startThread(self):
+		""" Must be called with the lock held
+		"""
+		if self._running: return
+		self._running = True
+		self.thread = threading.Thread(target=self._run, name="Windows7Magnifier.ConfigSaver")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while self._running and not self._checkPending and (self._deadline is None or self.clock() < self._deadline):
+					self._cond.wait(None if self._deadline is None else self._deadline - self.clock())
+				if not self._running: return
+				check, self._checkPending = self._checkPending, False
+				save = self._deadline is not None and self.clock() >= self._deadline
+				if save: self._deadline = None
+			if check:
+				try:
+					self.check()
+				except:
+					log.error("Magnifier: could not check the configuration file", exc_info=True)
+			if save: self._doSave()
+
+	def _doSave(self):
+		try:
+			self._save()
+			self.saves += 1
+		except:
+			self.failures += 1
+			log.error("Magnifier: could not save configuration", exc_info=True)
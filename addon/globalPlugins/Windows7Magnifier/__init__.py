@@ -9,26 +9,21 @@
 
 # Standard Python Imports
 import os
-import sys
-import subprocess
 import time
-import threading
+import functools
+
+# Measured so import time can be tracked across releases
+_importStart = time.time()
 
 # NVDA imports
 import ui
 import globalPluginHandler
 import winUser
-import win32api
-import ctypes
-import win32con
-import api
 import gui
 import wx
 import tones
-import speech
-import keyboardHandler
 import addonHandler
-import shellapi
+import globalVars
 
 _addonDir = os.path.join(os.path.dirname(__file__), "..", "..").decode("mbcs")
 _curAddon = addonHandler.Addon(_addonDir)
@@ -37,6 +32,20 @@ addonHandler.initTranslation()
 from logHandler import log 
 
 import Windows7MagnifierConfig
+import windowWatcher
+import windowInventory
+import modeMachine
+import keyInjector
+import processTracker
+import automationWorker
+import zoomController
+import windowHider
+import magnifierState
+import settingsBackend
+import readiness
+import tracing
+import winBindings
+from tracing import traced
 
 # Win32 Constants - Controlling windows
 #WS_EX_NOACTIVATE = 0x8000000L
@@ -48,6 +57,8 @@ import Windows7MagnifierConfig
 
 GWL_EXSTYLE = -20
 WM_CLOSE = 0x10
+WM_COMMAND = 0x111
+IDOK = 1
 WM_MOVE = 0x0003
 SWP_NOACTIVATE = 0x10
 SWP_NOSIZE = 0x01
@@ -63,16 +74,6 @@ GW_CHILD = 5
 # Win32 Constants - Keyboard
 VK_OEM_PLUS = 0xBB
 VK_OEM_MINUS = 0xBD
-KEYEVENTF_KEYUP = 0x02
-
-# Win32 Constants - Controls
-BM_CLICK = 0xF5
-BM_GETCHECK = 0xF0
-BM_SETCHECK = 0xF1
-BST_UNCHECKED = 0x00
-BST_CHECKED = 0x01
-TBM_GETPOS = 0x400
-TBM_SETPOSNOTIFY = 0x422
 
 class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 	""" Please see description at the top of this file.
@@ -82,9 +83,25 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 
 	_instance = None
 	
+	#: Where the options button is on the magnifier's toolbar (client
+	#: coordinates)
+	_OPTIONS_BUTTON = (160, 15)
+
+	# The options which are applied to the (real) magnifier
+	_MAGNIFIER_OPTIONS = frozenset(("mode", "invertColors", "followMouse", "followKeyboard", "followTextInsertion", "lensSizeHorizontal", "lensSizeVertical"))
+	
+	# Factories for the parts which talk to Windows. These can be
+	# replaced to run the plugin against a simulated system (see the
+	# benchmarks directory)
+	windowBackendFactory = windowWatcher.WinEventBackend
+	processBackendFactory = processTracker.Win32ProcessBackend
+	settingsStoreFactory = settingsBackend.RegistrySettingsStore
+	
 	def __init__(self):
 		""" Class is instantiated during NVDA startup
 		"""
+		initStart = time.time()
+		
 		# Allow parent class to process
 		super(GlobalPlugin, self).__init__()
 		
@@ -92,9 +109,101 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 		# reference
 		GlobalPlugin._instance = self
 		
-		# Keep track of primary thread, so long-running functions can
-		# detect it and be pushed to background threads
-		self.mainThread = threading.currentThread()
+		# The addon's options as typed attributes. Changes are saved in
+		# the background.
+		self.settings = Windows7MagnifierConfig.getSettings()
+		self.settings.subscribe(self._onSettingsChanged)
+		
+		# Every Win32 call (and what prompted it) can be recorded, to be
+		# replayed off Windows (off by default; read at startup only)
+		self.recorder = None
+		if self.settings.recordCalls:
+			import callTrace
+			self.recorder = callTrace.CallRecorder(winBindings.get(), header={
+				"settings": self.settings.snapshot(),
+				"profiles": Windows7MagnifierConfig.getProfiles(),
+			}, ignoredThreads=(windowWatcher.HOOK_THREAD,))
+			winBindings.install(self.recorder)
+		
+		# Win32 functions, resolved once with their argument types
+		# declared, for every call the plugin makes
+		self.win32 = winBindings.get()
+		self.sleep = self.recorder.sleep if self.recorder else time.sleep
+		
+		# Simulated keystrokes, injected a chord at a time
+		self.keys = keyInjector.KeyInjector(self.win32)
+		
+		# Explicit readiness checks (with timing statistics) instead of
+		# fixed sleeps
+		self.readiness = readiness.Readiness(sleep=self.sleep)
+		
+		# Latency tracing of each automation phase (off by default)
+		tracing.tracer.enabled = self.settings.tracing
+		
+		# Window create/show/destroy notifications, so waiting for the
+		# magnifier's windows doesn't need to poll
+		self.windowWatcher = windowWatcher.WindowWatcher(self.windowBackendFactory())
+		
+		# The handles of the magnifier's windows, found together and
+		# kept up to date, rather than searched for at every use
+		self.windows = windowInventory.WindowInventory(self.windowWatcher, _("Magnifier Options"))
+		
+		# Which mode the magnifier is in, followed from its windows, so
+		# mode switches can be awaited rather than polled for
+		self.modeMachine = modeMachine.ModeMachine(self.windowWatcher, self.windows)
+		
+		# Cached knowledge of the magnifier process, so checking if it's
+		# running doesn't need a process list snapshot every time
+		self.processTracker = processTracker.ProcessTracker("magnify.exe", self.processBackendFactory())
+		
+		# What the magnifier is currently set to, so applying settings
+		# only has to change what differs
+		self.magnifierState = magnifierState.MagnifierState()
+		self.processTracker.addExitListener(self._onMagnifierExit)
+		
+		# Settings can be written straight to the magnifier's settings
+		# store, with the options dialog as a fallback
+		self.settingsBackend = settingsBackend.SettingsBackend(self.settingsStoreFactory())
+		
+		# All (slow) magnifier automation happens on this worker, so
+		# scripts return immediately. Completion is reported back on the
+		# GUI thread.
+		self.worker = automationWorker.AutomationWorker(callAfter=wx.CallAfter)
+		self.worker.register("start", self.startMagnifier, merge=automationWorker.mergeReplace)
+		self.worker.register("close", self._closeMagnifierAfterSpeech, merge=automationWorker.mergeReplace)
+		self.worker.register("applySettings", self._applyConfiguredSettings, merge=automationWorker.mergeReplace)
+		self.worker.register("switchProfile", self._switchProfile, merge=automationWorker.mergeReplace)
+		self.worker.register("zoom", self._flushZoom, merge=automationWorker.mergeReplace)
+		self.worker.register("zoomTo", self._zoomTo, merge=automationWorker.mergeReplace)
+		self.worker.register("recover", self._recover, merge=automationWorker.mergeReplace)
+		self.worker.register("invert", self._invert)
+		self.worker.start()
+		
+		# Restarts the magnifier if it crashes
+		import supervisor
+		self.supervisor = supervisor.Supervisor(self._restartMagnifier,
+			enabled=lambda: self.settings.restartMagnifier and not self.terminated)
+		
+		# The options follow the foreground application's profile
+		import profiles
+		self.profileSwitcher = profiles.ProfileSwitcher(self.settings, Windows7MagnifierConfig.getProfiles,
+			self._applyProfile, delay=self.settings.profileSwitchDelay)
+		
+		# Hides the magnifier's control window whenever it pops up
+		self.windowHider = windowHider.WindowHider(self.windowWatcher, self._hideWindow,
+			find=lambda: self.windows.get(windowInventory.MAIN))
+		self.windowHider.start()
+		
+		# The zoom level, from the magnifier's stored settings and the
+		# steps sent since
+		self.zoomModel = zoomController.ZoomModel(self.settingsBackend.readZoom)
+		
+		# Rapid zoom presses are merged into one burst of keystrokes
+		self.zoomController = zoomController.ZoomController(
+			schedule=lambda: self.worker.submit("zoom"),
+			inject=self._zoom,
+			afterBurst=self.hideWindows
+		)
 		
 		# Add magnifier options to the NVDA preferences menu
 		prefsMenu = gui.mainFrame.sysTrayIcon.menu.FindItemByPosition(0).SubMenu
@@ -120,22 +229,82 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 			"okButton": 1
 		}
 		
-		# Launch the magnifier if it's configured to start w/ NVDA
-		if Windows7MagnifierConfig.conf["magnifier"]["startWithNVDA"]:
-			self.configuring = True
-			self.startMagnifier()
-			self.configuring = False
-			ui.message(_("Magnifier launched"))
-			
+		# Launch the magnifier if it's configured to start w/ NVDA.
+		# This waits until NVDA has finished starting (CallAfter runs
+		# once its main loop is processing events), so NVDA's startup
+		# never waits for the magnifier.
 		self.configuring = False
+		# The options dialog, while kept open between commands
+		self._optionsSession = None
+		# The command of the magnifier's options button: None until
+		# looked up, 0 if it can't be, so the button is clicked instead
+		self._optionsCommand = None
+		#: How long the options dialog took to open, by how it was opened
+		self.optionsOpenLatency = {"message": modeMachine.TransitionStats(), "click": modeMachine.TransitionStats()}
+		# The addon's settings dialog class, once it has been opened
+		self._settingsDialog = None
+		self.terminated = False
+		self.startupTimes = {"initStart": initStart, "initEnd": None, "nvdaReady": None, "magnifierReady": None}
+		# The hook thread is already running, so window notifications are
+		# only listened to once everything they use has been set up
+		self.windowWatcher.addListener(self._onWindowEvent)
+		if self.recorder:
+			self._recordInputs()
+		self.startupTimes["initEnd"] = time.time()
+		log.debug("Magnifier: plugin initialized in %.3fs" % (self.startupTimes["initEnd"] - initStart))
+		# The magnifier may already be running (e.g. from before NVDA
+		# started); this opens a handle to it, so the supervisor sees it
+		# exit
+		self.processTracker.isRunning()
+		if self.settings.startWithNVDA:
+			wx.CallAfter(self._startWithNVDA)
 		
 	def terminate(self): 
 		""" Called when NVDA is done with the plugin
 		"""
+		self.terminated = True
+
+		# Stop the threads which could still act on the magnifier
+		self.supervisor.stop()
+		self.profileSwitcher.stop()
+		self.worker.stop()
+		# Commit changes waiting in the options dialog
+		self._commitOptionsSession()
+		self.configuring = False
+		
 		# Close the magnifier if it's configured to close w/ NVDA
-		if Windows7MagnifierConfig.conf["magnifier"]["closeWithNVDA"]:
+		if self.settings.closeWithNVDA:
 			self.closeMagnifier()
 
+		# Write any pending changes before NVDA exits
+		self.settings.unsubscribe(self._onSettingsChanged)
+		self.settings.unsubscribe(self._recordSettings)
+		self.settings.saver.stop()
+
+		self.windowHider.stop()
+		log.debug("Magnifier: window hider %s" % self.windowHider.summary())
+		log.debug("Magnifier: window inventory %s" % self.windows.summary())
+		log.debug("Magnifier: mode transitions %s" % self.modeMachine.summary())
+		log.debug("Magnifier: profiles %s" % self.profileSwitcher.summary())
+		log.debug("Magnifier: supervisor %s" % self.supervisor.summary())
+		log.debug("Magnifier: process tracker %s" % self.processTracker.summary())
+		for line in self.readiness.summary():
+			log.debug("Magnifier: readiness %s" % line)
+		for path, stats in sorted(self.optionsOpenLatency.items()):
+			if stats.count:
+				log.debug("Magnifier: options dialog opened by %s %d x %.3fs (max %.3fs)" % (path, stats.count, stats.mean, stats.max))
+		if self._settingsDialog:
+			for path, stats in sorted(self._settingsDialog.openLatency.items()):
+				if stats.count:
+					log.debug("Magnifier: settings dialog focused after %s %d x %.3fs (max %.3fs)" % (path, stats.count, stats.mean, stats.max))
+			self._settingsDialog.discard()
+		self.modeMachine.stop()
+		self.windows.stop()
+		self.windowWatcher.stop()
+		self.processTracker.stop()
+		if self.recorder:
+			self._saveCalls()
+			winBindings.install(self.recorder.bindings)
 		super(GlobalPlugin, self).terminate()
 		
 	def onMagnifierSettingsCommand(self, evt):
@@ -143,46 +312,190 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 			NVDA menu
 			@param evt: the event which caused this action
 		"""
-		# Launch the settings dialog just like other settings dialogs
-		gui.mainFrame._popupSettingsDialog(MagnifierSettingsDialog)
+		# Launch the settings dialog just like other settings dialogs.
+		# It's created once, then reused.
+		import settingsDialog
+		self._settingsDialog = settingsDialog.MagnifierSettingsDialog
+		self._settingsDialog.popup()
 
 	def script_toggleMagnifier(self, gesture):
 		if self.isMagnifierRunning():
 			ui.message(_("Closing magnifier"))
-			# Pause so the speech can complete uninterrupted
-			time.sleep(1)
-			self.closeMagnifier()
+			self.worker.submit("close")
 		else:
-			self.startMagnifier()
+			self.worker.submit("start")
 	script_toggleMagnifier.__doc__="Toggles magnifier on and off."
 
 	def script_zoomIn(self, gesture):
-		# Simulate the Windows (built-in) hotkey for zooming in
-		self._pressKey([winUser.VK_LWIN, VK_OEM_PLUS])
+		self.zoomController.press(1)
 		try:
 			tones.beep(800, 50)
 		except:
 			pass
-		
-		# Windows will automatically launch the magnifier on zoom adjust
-		# If this happens, the windows need to be hidden (if configured)
-		self.hideWindows()
 	script_zoomIn.__doc__="Increase the zoom level."
 
 	def script_zoomOut(self, gesture):
-		# Simulate the Windows (built-in) hotkey for zooming out
-		self._pressKey([winUser.VK_LWIN, VK_OEM_MINUS])
+		self.zoomController.press(-1)
 		try:
 			tones.beep(400, 50)
 		except:
 			pass
-		
-		# Windows will automatically launch the magnifier on zoom adjust
-		# If this happens, the windows need to be hidden (if configured)
-		self.hideWindows()
 	script_zoomOut.__doc__="Decrease the zoom level."
 
+	def script_nextZoomPreset(self, gesture):
+		presets = sorted(set(zoomController.clampZoom(level) for level in self.settings.zoomPresets))
+		if not presets: return
+		level = self.zoomModel.level or zoomController.MINIMUM_ZOOM
+		# The next preset up, or back to the first
+		higher = [preset for preset in presets if preset > level]
+		self.zoomTo(higher[0] if higher else presets[0])
+	script_nextZoomPreset.__doc__="Zoom to the next configured zoom level."
+
+	def script_resetZoom(self, gesture):
+		self.zoomTo(zoomController.MINIMUM_ZOOM)
+	script_resetZoom.__doc__="Zoom back to 100 percent."
+
+	def zoomTo(self, level, onComplete=None):
+		""" Zoom to a level. Returns immediately; the zoom steps needed
+			are sent as one burst by the automation worker, and the level
+			reached is announced.
+			@param level: the zoom level, in percent
+			@param onComplete: optional function called (on the GUI
+				thread) as onComplete(command); command.result is the
+				level reached
+		"""
+		def done(command):
+			self._onZoomed(command)
+			if onComplete: onComplete(command)
+		self.worker.submit("zoomTo", onComplete=done, level=level)
+
 	def script_invert(self, gesture):
+		self.worker.submit("invert")
+		try:
+			tones.beep(1000, 50)
+		except:
+			pass
+	script_invert.__doc__="Invert the screen colors."
+
+	def script_reportLastOperation(self, gesture):
+		if not tracing.tracer.enabled:
+			ui.message(_("Magnifier tracing is disabled"))
+			return
+		operation = tracing.tracer.lastOperation()
+		if operation is None:
+			ui.message(_("No magnifier operations recorded"))
+		else:
+			ui.message(operation.describe())
+	script_reportLastOperation.__doc__="Reports how long each phase of the last magnifier operation took."
+
+	def script_exportTrace(self, gesture):
+		path = os.path.join(globalVars.appArgs.configPath, "windows7magnifier-trace.jsonl")
+		try:
+			count = tracing.tracer.export(path)
+		except EnvironmentError:
+			log.warning("Magnifier: could not export trace", exc_info=True)
+			ui.message(_("Could not export the magnifier trace"))
+			return
+		if self.recorder:
+			calls = self._saveCalls()
+			if calls is None:
+				ui.message(_("Could not export the magnifier trace"))
+			else:
+				ui.message(_("Exported %d new magnifier operations and %d recorded calls") % (count, calls))
+			return
+		ui.message(_("Exported %d new magnifier operations") % count)
+	script_exportTrace.__doc__="Adds the magnifier operation timings recorded since the last export to a file."
+
+	def _recordInputs(self):
+		""" Record what prompts the plugin to act, alongside the Win32
+			calls it makes, so the recording can be replayed
+		"""
+		recorder = self.recorder
+		def recordScript(name, script):
+			@functools.wraps(script)
+			def recorded(gesture):
+				with recorder.input("script", name):
+					return script(gesture)
+			return recorded
+		for name in set(self.__gestures.values()):
+			setattr(self, "script_%s" % name, recordScript(name, getattr(self, "script_%s" % name)))
+		self._recordedWindows = set()
+		self.windowWatcher.addListener(self._recordWindowEvent)
+		self.settings.subscribe(self._recordSettings)
+
+	def _recordWindowEvent(self, event, hwnd, windowClass, windowName):
+		# Only the magnifier's windows matter, out of every window on
+		# the system
+		if event == windowWatcher.EVENT_OBJECT_DESTROY:
+			if hwnd not in self._recordedWindows: return
+			self._recordedWindows.discard(hwnd)
+		elif windowClass in windowInventory.CLASSES.values():
+			self._recordedWindows.add(hwnd)
+		else:
+			return
+		self.recorder.note("window", event, hwnd, windowClass, windowName)
+
+	def _recordSettings(self, changes, external):
+		self.recorder.note("settings", changes, external)
+
+	def _saveCalls(self):
+		""" Save the recorded Win32 calls
+			@returns: the number of calls saved, or None on failure
+		"""
+		path = os.path.join(globalVars.appArgs.configPath, "windows7magnifier-calls.trace")
+		try:
+			count = self.recorder.save(path)
+		except EnvironmentError:
+			log.warning("Magnifier: could not save recorded calls", exc_info=True)
+			return None
+		log.debug("Magnifier: saved %d recorded events (%d dropped) to %s" % (count, self.recorder.recorded - count, path))
+		return count
+
+	def _flushZoom(self):
+		""" Worker command: send the zoom presses collected so far
+		"""
+		# Windows will automatically launch the magnifier on zoom adjust
+		# If this happens, the windows need to be hidden (if configured).
+		# The controller does this once per burst.
+		self.zoomController.flush()
+
+	@traced()
+	def _zoom(self, steps):
+		""" Zoom in (positive) or out (negative) by a number of steps,
+			as one uninterrupted burst of keystrokes
+		"""
+		# Simulate the Windows (built-in) hotkey for zooming in/out
+		key = VK_OEM_PLUS if steps > 0 else VK_OEM_MINUS
+		self.keys.pressSequence([[winUser.VK_LWIN, key]] * abs(steps))
+		self.zoomModel.stepped(steps)
+
+	@traced()
+	def _zoomTo(self, level):
+		""" Worker command: zoom to a level in one burst
+			@param level: the zoom level, in percent
+			@returns: the level reached
+		"""
+		# Relative presses still waiting go first, so the steps are
+		# counted from where they leave the zoom
+		self.zoomController.flush()
+		if not self.isMagnifierRunning():
+			self.startMagnifier(block=True, applyConfig=False)
+		steps = self.zoomModel.stepsTo(level)
+		before = self.zoomModel.level
+		if steps:
+			self._zoom(steps)
+			self.hideWindows()
+		return self.zoomModel.confirm(before, self.readiness.waitUntil)
+
+	def _onZoomed(self, command):
+		""" Called on the GUI thread once a zoom level has been set
+		"""
+		if command.error is None and command.result is not None:
+			ui.message(_("%d percent") % command.result)
+
+	def _invert(self):
+		""" Worker command: toggle color inversion
+		"""
 		# Windows does not automatically launch the magnifier for color
 		# inversion, so we need to start it
 		if not self.isMagnifierRunning():
@@ -190,30 +503,135 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 			
 		# Simulate the Windows (built-in) hotkey for color inversion
 		self._pressKey([winUser.VK_CONTROL, winUser.VK_MENU, 'i'])
-		# Toggle in the config
-		Windows7MagnifierConfig.conf["magnifier"]["invertColors"] = not Windows7MagnifierConfig.conf["magnifier"]["invertColors"]
-		try:
-			tones.beep(1000, 50)
-		except:
-			pass
-	script_invert.__doc__="Invert the screen colors."
+		inverted = self.magnifierState.get("invertColors")
+		if inverted is not None:
+			self.magnifierState.update(invertColors=not inverted)
+		# Toggle in the config, only now that the magnifier has been
+		# started with the old value and the hotkey has flipped it
+		self.settings.update(invertColors=not self.settings.invertColors)
+
+	def _closeMagnifierAfterSpeech(self):
+		""" Worker command: close the magnifier
+		"""
+		# Pause so the speech can complete uninterrupted
+		self.sleep(1)
+		self.closeMagnifier()
+
+	def _startWithNVDA(self):
+		""" Called on the GUI thread once NVDA has started: launch and
+			configure the magnifier in the background
+		"""
+		if self.terminated: return
+		self.startupTimes["nvdaReady"] = time.time()
+		self.worker.submit("start", onComplete=self._onMagnifierLaunched)
+
+	def _onMagnifierLaunched(self, command):
+		""" Called on the GUI thread once the startup launch completes
+		"""
+		times = self.startupTimes
+		times["magnifierReady"] = command.endTime
+		log.info("Magnifier: plugin init %.3fs; magnifier ready %.3fs after NVDA was ready (%.3fs after plugin init)%s" % (
+			times["initEnd"] - times["initStart"],
+			command.endTime - times["nvdaReady"],
+			command.endTime - times["initStart"],
+			"" if command.error is None else ", with errors"))
+		if command.error is None:
+			ui.message(_("Magnifier launched"))
 
 	def isMagnifierRunning(self):
 		""" Determine if the Windows magnifier is running
 			@returns: True if running, False if not
 			@rtype: boolean
 		"""
-		return None != searchProcessList("magnify.exe")
+		return self.processTracker.isRunning()
+
+	def _onWindowEvent(self, event, hwnd, windowClass, windowName):
+		""" Called (on a background thread) for each top level window
+			notification
+		"""
+		# The magnifier may have been started outside of this addon
+		if event == windowWatcher.EVENT_OBJECT_CREATE and windowClass == u"MagUIClass":
+			self.processTracker.invalidate()
+			self.magnifierState.markStale("magnifier window created")
+			# Opens a handle to it, so the supervisor sees it exit
+			self.processTracker.isRunning()
+		# The user may change settings in the real options dialog
+		if event == windowWatcher.EVENT_OBJECT_SHOW and not self.configuring and windowName == _("Magnifier Options"):
+			self.magnifierState.markStale("options dialog opened outside the addon")
+
+	def _onMagnifierExit(self, pid, exitCode):
+		""" Called (on a background thread) when the magnifier exits
+		"""
+		state = self.magnifierState.snapshot()
+		state["zoom"] = self.zoomModel.level
+		self.magnifierState.markStale("magnifier exited")
+		self.modeMachine.exited()
+		self.zoomModel.forget()
+		self.supervisor.exited(state, exitCode)
+
+	def _restartMagnifier(self, state):
+		""" Called (on the supervisor's thread) to restart the magnifier
+			after it crashed
+		"""
+		self.worker.submit("recover", onComplete=self._onRecovered, state=state)
+
+	@traced()
+	def _recover(self, state):
+		""" Worker command: start the magnifier again as it was. Its
+			settings are stored for it to pick up as it starts, so
+			neither its options dialog nor a second restart is needed.
+			@param state: its last known settings (None if unknown) and
+				zoom level
+			@returns: True if it's running again
+		"""
+		if self.isMagnifierRunning(): return True
+		settings = self._configuredSettings()
+		for name, value in state.items():
+			if name in magnifierState.FIELDS and value is not None:
+				settings[name] = value
+		try:
+			self.settingsBackend.write(**settings)
+			if state.get("zoom"):
+				self.settingsBackend.writeZoom(state["zoom"])
+		except EnvironmentError:
+			log.warning("Magnifier: could not use the settings store, restoring the configured settings instead", exc_info=True)
+			self.startMagnifier(block=True)
+			return self.isMagnifierRunning()
+		self.startMagnifier(block=True, applyConfig=False)
+		self.magnifierState.refreshed(**self.settingsBackend.read())
+		self.zoomModel.sync()
+		self.hideWindows()
+		return self.isMagnifierRunning()
+
+	def _onRecovered(self, command):
+		""" Called on the GUI thread once a restart has completed
+		"""
+		succeeded = command.error is None and bool(command.result)
+		self.supervisor.recovered(succeeded)
+		if succeeded:
+			ui.message(_("Magnifier restarted"))
 
+	@traced()
 	def startMagnifier(self, block=True, applyConfig=True):
 		""" Launch the Windows magnifier"
 			@param block: don't return until confirmed running
 			@param type: boolean
+			@param applyConfig: apply the configured settings too
+			@param type: boolean
 		"""
+		if applyConfig:
+			# Applying settings launches the magnifier when needed, and
+			# can store them beforehand rather than restarting it
+			self._applyConfiguredSettings(**self._configuredSettings())
+			wx.CallAfter(ui.message, _("Settings applied"))
+			return
+		
 		# don't launch if already running
 		if not self.isMagnifierRunning():
-			ui.message(_("Launching magnifier"))
+			wx.CallAfter(ui.message, _("Launching magnifier"))
 			
+			import subprocess
+			import shellapi
 			winDir = os.path.expandvars("%WINDIR%")
 			try:
 				# Force 64-bit version on 64-bit OS
@@ -223,42 +641,43 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 				# Fallback
 				exe = winDir + u"\\System32\\Magnify.exe"
 				shellapi.ShellExecute(None, None, exe, subprocess.list2cmdline([exe]), None, 0)
+			self.processTracker.invalidate()
+			self.modeMachine.launching()
 
-		if block or applyConfig:
+		if block:
 			self._waitForMagnifierWindow()
-			time.sleep(1)
-				
-		if applyConfig:
-			self.applyConfig()
+			# The hotkeys and options only work once a mode window exists
+			with tracing.tracer.span("magnifier initialized"):
+				self.modeMachine.waitFor(modeMachine.MODES, timeout=5)
 
 	def detectCurrentMode(self):
 		""" Try to determine the current executing mode. This works by 
 			looking for mode-specific windows.
 			@returns 'Fullscreen', 'Lens', or 'Docked'
 		"""
-		modes = {
-			"Fullscreen": ("Screen Magnifier Fullscreen Window", None),
-			"Lens": ("Screen Magnifier Lens Window", None),
-			"Docked": ("Screen Magnifier Window", None)
-		}
-		for mode,args in modes.items():
-			if winUser.user32.FindWindowA(args[0], args[1]) != 0:
-				return mode
-				
-		return None
+		mode = self.modeMachine.mode
+		if mode is None:
+			# In case a window notification was missed
+			state = self.modeMachine.sync()
+			mode = state if state in modeMachine.MODES else None
+		return mode
 		
+	@traced()
 	def closeMagnifier(self):
 		""" Close the magnifier
 		"""
 		# Find the window, send it the standard win32 message to close
-		winUser.sendMessage(
-			winUser.user32.FindWindowA("MagUIClass", None),
-			WM_CLOSE, 0, 0
-		)
+		hwnd = self.windows.get(windowInventory.MAIN)
+		if hwnd:
+			self.supervisor.expectExit()
+			self.win32.sendMessage(hwnd, WM_CLOSE, 0, 0)
 
-	def applySettings(self, mode=None, invertColors=None, followMouse=None, followKeyboard=None, followTextInsertion=None, lensSizeHorizontal=None, lensSizeVertical=None):
+	@traced()
+	def applySettings(self, mode=None, invertColors=None, followMouse=None, followKeyboard=None, followTextInsertion=None, lensSizeHorizontal=None, lensSizeVertical=None, useStore=True):
 		""" Apply the (supplied) options in the Windows magnifier
-			settings dialog.
+			settings dialog. Only options which differ from the
+			magnifier's known state are applied, and the dialog isn't
+			opened at all when there is nothing it needs to change.
 			@param mode: 'Fullscreen', 'Docked', or 'Lens'
 			@param invertColors: Enable/disable color inversion
 			@param followMouse: Enable/disable mouse cursor tracking
@@ -267,198 +686,285 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 				tracking
 			@param lensSizeHorizontal: The horizontal size of the lens
 			@param lensSizeVertical: The vertical size of the lens
+			@param useStore: whether the settings may be written to the
+				magnifier's settings store (restarting it) when that backend
+				is configured, rather than set in its options dialog
 			@raise ValueError if all tracking options are supplied and 
 				all are False
 		"""
+		settings = dict(
+			mode=mode,
+			invertColors=invertColors,
+			followMouse=followMouse,
+			followKeyboard=followKeyboard,
+			followTextInsertion=followTextInsertion,
+			lensSizeHorizontal=lensSizeHorizontal,
+			lensSizeVertical=lensSizeVertical
+		)
 		self.configuring = True
+		keepOpen = False
+		try:
+			# If tracking options are specified, at least one must be
+			# enabled. Checked in here, so a dialog kept open by the
+			# previous command is still committed.
+			inputOK = False
+			for trackingOption in [followMouse, followKeyboard, followTextInsertion]:
+				if trackingOption == None or trackingOption == True:
+					inputOK = True
+					break
+			if not inputOK: raise ValueError("If all tracking options are supplied, at least one must be enabled")
+
+			if useStore and self.settings.settingsBackend == "registry":
+				self._commitOptionsSession()
+				try:
+					if self._applyThroughStore(settings): return
+				except EnvironmentError:
+					log.warning("Magnifier: could not use the settings store, falling back to the options dialog", exc_info=True)
+			self.startMagnifier(block=True, applyConfig=False)
+			if mode != None:
+				if self.detectCurrentMode() != mode:
+					# The dialog's controls depend on the mode
+					self._commitOptionsSession()
+				self._switchMode(mode)
+
+			# The dialog may have been kept open by the previous command
+			session = self._optionsSession
+			if session is not None and not session.isOpen():
+				session = self._optionsSession = None
+			if session is None and self.magnifierState.stale:
+				# Something may have changed behind our back, so read the
+				# real values before deciding what to change
+				session = self._openOptionsSession()
+
+			delta = self.magnifierState.diff(
+				invertColors=invertColors,
+				followMouse=followMouse,
+				followKeyboard=followKeyboard,
+				followTextInsertion=followTextInsertion,
+				lensSizeHorizontal=lensSizeHorizontal,
+				lensSizeVertical=lensSizeVertical
+			)
+			log.debug("Magnifier: settings to apply %r" % delta)
+
+			if delta.keys() == ["invertColors"] and session is None:
+				# Inversion has its own hotkey, no need for the dialog
+				self._pressKey([winUser.VK_CONTROL, winUser.VK_MENU, 'i'])
+			elif delta:
+				if session is None:
+					session = self._openOptionsSession()
+				self._writeSettings(session, delta)
+
+			if session is not None:
+				session.uses += 1
+				if self.worker.isWorkerThread() and self.worker.nextCommand in ("applySettings", "switchProfile"):
+					# More changes are queued; commit them all at once
+					log.debug("Magnifier: keeping the options dialog open for the next command")
+					keepOpen = True
+				else:
+					self._commitOptionsSession()
+			self.magnifierState.update(**delta)
+		except:
+			if self._optionsSession is not None:
+				# Some of the changes may have been made in the dialog
+				self.magnifierState.markStale("applying settings failed")
+			raise
+		finally:
+			if not keepOpen:
+				if self._optionsSession is not None:
+					# Left open by an error; don't leave it on screen
+					self._commitOptionsSession()
+				self.configuring = False
+				self.hideWindows()
+
+	@traced()
+	def _applyThroughStore(self, settings):
+		""" Apply settings by writing them to the magnifier's settings
+			store, then launching (or restarting) the magnifier so it
+			picks them up
+			@param settings: the arguments given to L{applySettings}
+			@returns: False if the running magnifier is better served by
+				its hotkeys and options dialog (nothing was done)
+		"""
+		if self.isMagnifierRunning():
+			if self.magnifierState.stale:
+				# A stale model differs in everything, so read the real
+				# values before deciding to restart. The dialog is left
+				# open for applySettings if there's no need to.
+				self._openOptionsSession()
+			delta = self.magnifierState.diff(**settings)
+			# The mode and inversion have hotkeys, so don't restart for them
+			delta.pop("mode", None)
+			if not delta or delta.keys() == ["invertColors"]: return False
+			# The magnifier writes its settings back when it exits, so it
+			# must be gone before the new ones are stored
+			log.debug("Magnifier: restarting to apply %r" % delta)
+			self._commitOptionsSession()
+			self.closeMagnifier()
+			if not self.processTracker.waitForExit(10): return False
+		self.settingsBackend.write(**settings)
 		self.startMagnifier(block=True, applyConfig=False)
+		self.magnifierState.refreshed(**self.settingsBackend.read())
+		return True
+
+	@traced()
+	def _switchMode(self, mode):
+		""" Switch the magnifier to the given mode using its hotkeys
+			@param mode: 'Fullscreen', 'Docked', or 'Lens'
+		"""
+		if self.detectCurrentMode() == mode:
+			self.magnifierState.update(mode=mode)
+			return
+		self._waitForMagnifierWindow()
 		
-		if mode != None and self.detectCurrentMode() != mode:
-			hwnd = self._waitForMagnifierWindow()
-			
-			if mode == "Fullscreen":
-				self._pressKey([winUser.VK_CONTROL, winUser.VK_MENU, 'f'])
-			if mode == "Docked":
-				self._pressKey([winUser.VK_CONTROL, winUser.VK_MENU, 'd'])
-			elif mode == "Lens":
-				self._pressKey([winUser.VK_CONTROL, winUser.VK_MENU, 'l'])
-
-			log.debug("Magnifier - Mode changed to %s" % mode)
-			time.sleep(1)
-			
-			for i in range(250):
-				if self.detectCurrentMode() == mode: break
-				time.sleep(0.02)
-			
-			# When switching between modes, the window likes to be
-			# shuffled. Without this, other settings do not get applied
-			# properly
-			mainWindow = self._waitForMagnifierWindow()
-			self._hideWindow(mainWindow)
-			self._showWindow(mainWindow)
-			self._hideWindow(mainWindow)
-		
-		# If tracking options are specified, at least one must be enabled
-		inputOK = False
-		for trackingOption in [followMouse, followKeyboard, followTextInsertion]:
-			if trackingOption == None or trackingOption == True:
-				inputOK = True
-				break
-		if not inputOK: raise ValueError("If all tracking options are supplied, at least one must be enabled")
-
-		checkboxes = [
-			("invertColors", invertColors),
-			("followMouse", followMouse),
-			("followKeyboard", followKeyboard),
-			("followTextInsertion", followTextInsertion)
-		]
-		
-		# Magnifier will complain if you uncheck all tracking options.
-		# So we must mark all the CHECKED boxes first
-		checkboxes = sorted(checkboxes, key=lambda boxArgs: not boxArgs[1])
-
-		# Open the settings dialog and grab controls
-		[dialog, controls] = self.openSettings()
-	
-		# Loop through each setting
-		for boxArgs in checkboxes:
-			name = boxArgs[0]
-			# if its value is specified in the arguments
-			# AND if there's a control for it, set it appropriately
-			if not name in controls:
-				log.debug("Magnifier: Could not find control %s" % name)
-			if boxArgs[1] != None and name in controls:
-				log.debug("Magnifier: Setting %s %s" % (name, boxArgs[1]))
-				controls[name].setChecked(boxArgs[1])
-		
-		# Set the lens size
-		if lensSizeHorizontal != None: controls["lensSizeHorizontal"].setTrackbarValue(lensSizeHorizontal - 10)
-		if lensSizeVertical != None: controls["lensSizeVertical"].setTrackbarValue(100 - lensSizeVertical)
-		
-		# Close the dialog
-		time.sleep(0.25)
-		keyboardHandler.KeyboardInputGesture.fromName("enter").send()
-		# Pause for a moment - helps with windows behaving
-		time.sleep(0.25)
+		hotkeys = {"Fullscreen": 'f', "Docked": 'd', "Lens": 'l'}
+		switched = self.modeMachine.requestMode(mode,
+			lambda: self._pressKey([winUser.VK_CONTROL, winUser.VK_MENU, hotkeys[mode]]),
+			timeout=3, retries=1)
+		if not switched:
+			self.magnifierState.markStale("mode switch timed out")
+			return
 
-		self.configuring = False
-		self.hideWindows()
+		log.debug("Magnifier - Mode changed to %s" % mode)
+		self.magnifierState.update(mode=mode)
 		
-	def openSettings(self):
-		""" Opens the (real) settings window
-			@returns The hwnd to the settings window and a list of each 
-			(relevant) control in that window
+		# When switching between modes, the window likes to be
+		# shuffled. Without this, other settings do not get applied
+		# properly
+		mainWindow = self._waitForMagnifierWindow()
+		self._hideWindow(mainWindow)
+		self._showWindow(mainWindow)
+		self._hideWindow(mainWindow)
+
+	@traced()
+	def _readSettings(self, session):
+		""" Refresh the state model from the (real) options dialog
+			@param session: the L{optionsDialog.OptionsDialogSession}
+		"""
+		values = session.read()
+		values["mode"] = self.detectCurrentMode()
+		self.magnifierState.refreshed(**values)
+
+	@traced()
+	def _writeSettings(self, session, settings):
+		""" Set controls in the (real) options dialog
+			@param session: the L{optionsDialog.OptionsDialogSession}
+			@param settings: the values to set, by control name
+		"""
+		session.write(settings, confirm=lambda name, isSet: self.readiness.waitUntil("checkbox state confirmed", isSet, timeout=1))
+
+	@traced()
+	def _openOptionsSession(self):
+		""" Open the (real) options dialog and read all of its controls
+			@returns: the L{optionsDialog.OptionsDialogSession}, which is
+				kept until L{_commitOptionsSession}
+		"""
+		import optionsDialog
+		session = self._optionsSession = optionsDialog.OptionsDialogSession(self.win32, self._openOptionsWindow(), self.controlIDs)
+		self._readSettings(session)
+		return session
+
+	@traced()
+	def _commitOptionsSession(self):
+		""" Close the options dialog kept open by L{applySettings} (if
+			any) with Enter, so the magnifier applies its changes
+		"""
+		session, self._optionsSession = self._optionsSession, None
+		if session is None or not session.isOpen(): return
+		dialog = session.hwnd
+		# The OK command works whether or not the dialog is in the
+		# foreground
+		self.win32.postMessage(dialog, WM_COMMAND, IDOK, 0)
+		if not self.readiness.waitUntil("options dialog closed",
+			lambda: not self.win32.isWindow(dialog),
+			timeout=1):
+			# Enter goes to the foreground window, so make sure that's the
+			# dialog
+			self.win32.setForegroundWindow(dialog)
+			self.readiness.waitUntil("options dialog foreground",
+				lambda: self.win32.getForegroundWindow() == dialog,
+				timeout=1)
+			import keyboardHandler
+			keyboardHandler.KeyboardInputGesture.fromName("enter").send()
+			self.readiness.waitUntil("options dialog closed",
+				lambda: not self.win32.isWindow(dialog),
+				timeout=2)
+		log.debug("Magnifier: options dialog committed %d changes for %d commands" % (session.writes, session.uses))
+
+	def _openOptionsWindow(self):
+		""" Open the magnifier's options dialog. Its options button's
+			command is posted to the main window, which neither moves the
+			mouse nor changes the foreground window; the button is only
+			clicked if that isn't possible.
+			@returns: the options dialog
 		"""
 		# make sure the magnifier is running
 		self.startMagnifier(block=True, applyConfig=False)
 
 		# So... find the window
 		mainWindow = self._waitForMagnifierWindow()
-		self._showWindow(mainWindow, True)
+		toolbar = self.win32.getWindow(mainWindow, GW_CHILD)
+		optionsTitle = _("Magnifier Options")
 
-		controls = winUser.getWindow(mainWindow, GW_CHILD)
-		# short pause to help make sure the window has focus
-		time.sleep(0.1)
+		if self._optionsCommand is None:
+			# Command IDs come from the magnifier's resources, so one
+			# look up does for every run
+			self._optionsCommand = self.win32.toolbarCommandAt(toolbar, *self._OPTIONS_BUTTON) or 0
+			log.debug("Magnifier: options button command %r" % self._optionsCommand)
+		if self._optionsCommand:
+			start = time.time()
+			self.win32.postMessage(mainWindow, WM_COMMAND, self._optionsCommand, toolbar)
+			optionsWindow = self._waitForWindow(windowName=optionsTitle, maxChecks=10)
+			if optionsWindow:
+				self.optionsOpenLatency["message"].add(time.time() - start)
+				return optionsWindow
+			log.debug("Magnifier: options command %d had no effect, clicking instead" % self._optionsCommand)
+			self._optionsCommand = 0
+
+		start = time.time()
+		self._showWindow(mainWindow, True)
+		# make sure the window has focus before clicking it
+		self.readiness.waitUntil("main window foreground",
+			lambda: self.win32.getForegroundWindow() == mainWindow,
+			timeout=1)
 		# click on the settings button
-		self._click(160, 15, controls)
+		self._click(self._OPTIONS_BUTTON[0], self._OPTIONS_BUTTON[1], toolbar)
 
 		# Wait for options window to be visible (but don't wait forever)
-		optionsWindow = self._waitForWindow(windowName=_("Magnifier Options"))
-	
-		# Grab the contros so we can return them to the caller
-		controls = {}
-		for name,controlID in self.controlIDs.items():
-			controls[name] = Win32Control(optionsWindow, controlID)
-			
-		return optionsWindow, controls
+		optionsWindow = self._waitForWindow(windowName=optionsTitle)
+		if optionsWindow:
+			self.optionsOpenLatency["click"].add(time.time() - start)
+		return optionsWindow
 
-	def hideWindows(self, numberOfChecks=2, delayBetweenChecks=0.1, minimizeForce=False):
+	@traced()
+	def hideWindows(self):
 		""" Hide the (real) magnifier's control windows. This includes
 			the standard window, the magnifier icon, and the settings
 			dialog.
 			
-			This function will push itself to a daemon thread for 
-			background processing, so it doesn't lock up NVDA. This is
-			because the function may take a while to complete, as it can
-			check repeatedly for windows to re-appear.
-			
-			@param numberOfChecks: number of times to check for each
-				window
-			@param delayBetweenChecks: how long to wait before checking
-				for windows' appearance
+			The request is handed to the window hider service and this
+			returns immediately. The service keeps hiding the windows for
+			a short while, as they may re-appear; requests made in that
+			time are merged.
 		"""
 		# Exit if the user has configured windows to stay open
-		if self.configuring or not Windows7MagnifierConfig.conf["magnifier"]["hideMagnifierControls"]: return
-		
-		# Detect if the calling thread is main NVDA thread
-		if threading.currentThread() == self.mainThread:
-			# If it is, call this function inside a new thread and exit
-			t = threading.Thread(target=self.hideWindows, args=(numberOfChecks, delayBetweenChecks))
-			t.daemon = True
-			t.start()
-			return
-
-		time.sleep(1)
-		# Window classes and names to search for
-		windowArgs = [
-			("MagUIClass", None),
-		]
-		
-		# Check for windows repeatedly, hide them if they are found
-		for i in range(numberOfChecks):
-			for args in windowArgs:
-				hwnd = winUser.user32.FindWindowA(args[0], args[1])
-				if hwnd != 0:
-					self._hideWindow(hwnd)
-			# don't be a resource-hog, pause a bit between checks
-			time.sleep(delayBetweenChecks)
-		
-	def _type(self, string):
-		for c in string:
-			self._pressKey(self._virtualizeKeys([c]))
-
+		if self.configuring or not self.settings.hideMagnifierControls: return
+		self.windowHider.request()
+		
 	def _pressKey(self, keyCodes):
 		""" Internal function used to simulate a key press. This is used
 			to map this addon's hotkeys to Windows 7 Magnifier hotkeys
 			@param keyCodes: A list of virtual key codes. All supplied
 				will be pressed simultaneously.
 		"""
-		keyCodes = self._virtualizeKeys(keyCodes)
-		
-		# Simulate each key being pressed down (in order)
-		for key in keyCodes:
-			winUser.user32.keybd_event(key, key, 0, 0)
-
-		# Simulate each key being released (in reverse order)
-		keyCodes.reverse()
-		for key in keyCodes:
-			winUser.user32.keybd_event(key, key, KEYEVENTF_KEYUP, 0)
-			
-	def _releaseKeys(self, keyCodes, allModifiers=False):
-		""" Ensure keyboard buttons are released.
-			Some actions simulate key presses, and these don't behave
-			properly if the user still has keys depressed.
-		"""
-		keyCodes = self._virtualizeKeys(keyCodes)
-		
-		if allModifiers:
-			keyCodes.append(winUser.VK_LWIN)
-			keyCodes.append(winUser.VK_RWIN)
-			keyCodes.append(winUser.VK_MENU)
-			keyCodes.append(winUser.VK_CONTROL)
-			keyCodes.append(winUser.VK_SHIFT)
-			keyCodes.append(winUser.VK_CAPITAL)
-			keyCodes.append(winUser.VK_NUMLOCK)
-
-		for key in keyCodes:
-			winUser.user32.keybd_event(key, key, KEYEVENTF_KEYUP, 0)
+		# Each key down in order, then up in reverse order, in one batch
+		self.keys.press(keyCodes)
 			
 	def _hideWindow(self, hwnd):
 		""" Internal convenience function to hide a window
 			@param hwnd: A handle to the window to be hidden
 		"""
 		if self.configuring == True: return
-		winUser.user32.ShowWindow(hwnd, SW_SHOWMINNOACTIVE)
+		self.win32.showWindow(hwnd, SW_SHOWMINNOACTIVE)
 		
 	def _showWindow(self, hwnd, makeForeground=True):
 		""" Internal convenience function to make a window visible
@@ -466,10 +972,11 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 			@param makeForeground: if True bring the window to the front
 			@param waitForVisible: if True block until window is visible
 		"""
-		winUser.user32.ShowWindow(hwnd, win32con.SW_RESTORE)
+		self.win32.showWindow(hwnd, winBindings.SW_RESTORE)
 		if makeForeground:
-			winUser.setForegroundWindow(hwnd)
+			self.win32.setForegroundWindow(hwnd)
 				
+	@traced()
 	def _waitForMagnifierWindow(self, maxChecks=100, delayBetweenChecks=0.1):
 		""" Block until the main magnifier window is available
 			@param maxChecks: the maximum number of times to check for a
@@ -480,77 +987,139 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 		return mainWindow
 		
 	def _waitForWindow(self, windowClass=None, windowName=None, maxChecks=100, delayBetweenChecks=0.1):
-		""" Block until a given window is available
+		""" Block until a given window is available. Wakes as soon as
+			the window is created rather than polling for it.
 			@param windowClass: the class to search for
 			@param windowName: the name to search for
-			@param maxChecks: the maximum number of times to check for a
-				window
-			@param delayBetweenChecks: how long to pause between checks
+			@param maxChecks: together with delayBetweenChecks, sets the
+				maximum time to wait for a window
+			@param delayBetweenChecks: see maxChecks
 		"""
 		if windowClass != None:
-			windowClass = windowClass.encode("ascii", "ignore")
+			windowClass = unicode(windowClass)
 		if windowName != None:
-			windowName = windowName.encode("ascii", "ignore")
+			windowName = unicode(windowName)
+		
+		# The magnifier's own windows are usually already known
+		role = self.windows.roleOf(windowClass, windowName)
+		if role:
+			hwnd = self.windows.get(role)
+			if hwnd: return hwnd
 		log.debug("Waiting for window '%s', '%s'" % (windowClass, windowName))
-		hwnd = 0
-		for i in range(maxChecks): # For best results, change to xrange please.
+		
+		def progress():
 			# Play progress tones while magnifier is loading.
-			if i%10 == 0: tones.beep(440, 100)
-			if hwnd == 0:
-				hwnd = winUser.user32.FindWindowA(windowClass, windowName)
-				
-			if hwnd != 0:
-				break
-			else:
-				time.sleep(delayBetweenChecks)
-			
-		return hwnd
+			tones.beep(440, 100)
+		
+		waiter = self.windowWatcher.waitForWindow(windowClass, windowName, timeout=maxChecks * delayBetweenChecks, tick=progress)
+		return waiter.hwnd
 
-	def _virtualizeKeys(self, keyCodes):
-		""" Convert chars to their Virtual Key equivalents
-			@param keyCodes: A list of chars to convert
-		"""
-		for i in range(len(keyCodes)):
-			# If it's not a string, assume it's already a VK
-			if isinstance(keyCodes[i], basestring):
-				keyCodes[i] = winUser.VkKeyScanEx(keyCodes[i], winUser.user32.GetKeyboardLayout(0))[1]
-				
-		return keyCodes
-			
 	@staticmethod
 	def applyConfig():
 		""" Apply the configured magnifier options set from the NVDA
-			preferences to the (real) magnifier
-		"""
-		if Windows7MagnifierConfig.conf["magnifier"]["mode"] == "Lens":
-			gui.ExecAndPump(
-				GlobalPlugin._instance.applySettings,
-				mode = Windows7MagnifierConfig.conf["magnifier"]["mode"],
-				invertColors = Windows7MagnifierConfig.conf["magnifier"]["invertColors"],
-				lensSizeHorizontal = Windows7MagnifierConfig.conf["magnifier"]["lensSizeHorizontal"],
-				lensSizeVertical = Windows7MagnifierConfig.conf["magnifier"]["lensSizeVertical"]
-			)
-		else:
-			# Fullscreen and docked have identical settings
-			gui.ExecAndPump(
-				GlobalPlugin._instance.applySettings,
-				mode = Windows7MagnifierConfig.conf["magnifier"]["mode"],
-				invertColors = Windows7MagnifierConfig.conf["magnifier"]["invertColors"],
-				followMouse = Windows7MagnifierConfig.conf["magnifier"]["followMouse"],
-				followKeyboard = Windows7MagnifierConfig.conf["magnifier"]["followKeyboard"],
-				followTextInsertion = Windows7MagnifierConfig.conf["magnifier"]["followTextInsertion"]
-			)
+			preferences to the (real) magnifier. Returns immediately;
+			the work is queued on the automation worker.
+		"""
+		plugin = GlobalPlugin._instance
+		plugin.worker.submit("applySettings", onComplete=plugin._onSettingsApplied, **plugin._configuredSettings())
 
-		ui.message(_("Settings applied"))
-			
+	def _configuredSettings(self):
+		""" The configured options, with the active profile's, as
+			arguments for L{applySettings}
+		"""
+		return self.profileSwitcher.activeSettings()
+
+	def _onSettingsChanged(self, changes, external):
+		""" Called when the addon's options change (on any thread)
+		"""
+		if "tracing" in changes:
+			tracing.tracer.enabled = changes["tracing"]
+		if "profileSwitchDelay" in changes:
+			self.profileSwitcher.delay = changes["profileSwitchDelay"]
+		# Edits made to the file by hand take effect without a restart.
+		# They're looked for when another application comes to the
+		# foreground (see event_foreground), e.g. on leaving the editor,
+		# and before each save. A closed magnifier isn't launched for
+		# them; it gets them when it's next started.
+		if external and self._MAGNIFIER_OPTIONS.intersection(changes) and self.isMagnifierRunning():
+			self.applyConfig()
+
+	def _applyConfiguredSettings(self, **settings):
+		""" Worker command: apply settings, then signal readiness
+		"""
+		self.applySettings(**settings)
+		
 		# beep to indicate readiness
 		for i in range(3):
 			try:
-				time.sleep(.1)
+				self.sleep(.1)
 				tones.beep(550 + i*50, 50)
 			except Exception, e:
 				pass
 
+	def event_foreground(self, obj, nextHandler):
+		""" Switch to the profile of the application coming to the
+			foreground
+		"""
+		appModule = getattr(obj, "appModule", None)
+		appName = getattr(appModule, "appName", None)
+		if self.recorder:
+			self.recorder.note("foreground", appName)
+		# The file may have been edited by hand in the application left
+		self.settings.saver.requestCheck()
+		# The magnifier's own windows don't count
+		if appName and appName != "magnify":
+			self.profileSwitcher.foreground(appName)
+		nextHandler()
+
+	def _applyProfile(self, plan):
+		""" Called (on the profile switcher's thread) to switch profiles
+			@param plan: the L{profiles.TransitionPlan}
+		"""
+		# Otherwise the profile is applied when the magnifier starts
+		if not self.isMagnifierRunning(): return
+		changes = plan.changes
+		hotkeysOnly = plan.hotkeysOnly
+		known = self.magnifierState.snapshot()
+		if self.magnifierState.stale or any(known[name] != value for name, value in plan.old.items()):
+			# The magnifier isn't as the plan expects; applySettings
+			# still only changes what differs
+			changes = plan.new
+			hotkeysOnly = False
+		log.debug("Magnifier: profile %s needs %r%s" % (plan.target, changes, " (hotkeys)" if hotkeysOnly else ""))
+		if changes:
+			self.worker.submit("switchProfile", hotkeysOnly=hotkeysOnly, **changes)
+
+	@traced()
+	def _switchProfile(self, hotkeysOnly=False, **changes):
+		""" Worker command: make the changes a profile switch needs. The
+			magnifier is switched with its hotkeys when they suffice, and
+			otherwise through its options dialog, which takes far less
+			time than restarting it to pick up stored settings.
+			@param hotkeysOnly: True if the changes only need hotkeys (see
+				L{profiles.TransitionPlan.hotkeysOnly})
+			@param changes: the settings to change, as for L{applySettings}
+		"""
+		if not self.isMagnifierRunning(): return
+		if not hotkeysOnly or self._optionsSession is not None:
+			# An options dialog kept open by the previous command takes
+			# these changes too, and is committed with them
+			self.applySettings(useStore=False, **changes)
+			return
+		if changes.get("mode") is not None:
+			self._switchMode(changes["mode"])
+		invertColors = changes.get("invertColors")
+		if invertColors is not None and invertColors != self.magnifierState.get("invertColors"):
+			self._pressKey([winUser.VK_CONTROL, winUser.VK_MENU, 'i'])
+			self.magnifierState.update(invertColors=invertColors)
+		self.hideWindows()
+
+	def _onSettingsApplied(self, command):
+		""" Called on the GUI thread once settings have been applied
+		"""
+		if command.error is None:
+			ui.message(_("Settings applied"))
+
 	def _click(self, x, y, hwnd=0):
 		""" Simulate a mouse click
 			@param x: the X coordinate to click
@@ -559,22 +1128,22 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 				are relative to the window
 		"""
 		# Grab the current position so we can move the mouse back when
-		lastPos = win32api.GetCursorPos()
+		lastPos = self.win32.getCursorPos()
 		
 		if hwnd != 0:
 			# make the coordinates relative to the specified window
-			offset = winUser.ScreenToClient(hwnd, 0, 0)
+			offset = self.win32.screenToClient(hwnd, 0, 0)
 			x -= offset[0]
 			y -= offset[1]
-			winUser.setForegroundWindow(hwnd)
+			self.win32.setForegroundWindow(hwnd)
 		
 		# move the mouse and click
-		win32api.SetCursorPos((x,y))
-		win32api.mouse_event(win32con.MOUSEEVENTF_LEFTDOWN,x,y,0,0)
-		win32api.mouse_event(win32con.MOUSEEVENTF_LEFTUP,x,y,0,0)
+		self.win32.setCursorPos(x, y)
+		self.win32.mouseEvent(winBindings.MOUSEEVENTF_LEFTDOWN, x, y)
+		self.win32.mouseEvent(winBindings.MOUSEEVENTF_LEFTUP, x, y)
 		
 		# restore the previous mouse position
-		win32api.SetCursorPos(lastPos)
+		self.win32.setCursorPos(*lastPos)
 		
 	__gestures={
 		"kb:NVDA+shift+g": "toggleMagnifier",
@@ -584,223 +1153,12 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 		"kb:NVDA+numpadPlus": "zoomIn",
 		"kb:NVDA+numpadMinus": "zoomOut",
 		"kb:NVDA+shift+i": "invert",
+		"kb:NVDA+shift+z": "nextZoomPreset",
+		"kb:NVDA+shift+0": "resetZoom",
+		"kb:NVDA+shift+control+g": "reportLastOperation",
+		"kb:NVDA+shift+control+e": "exportTrace",
 	}
 
-class Win32Control:
-	""" The controls in the Window 7 Magnifier options dialog only bind
-		to the generic NVDAObject class... more likely: I don't really
-		know what I'm doing. To work around either case, a wrapper class
-	"""
-	
-	def __init__(self, parentHWND, controlID):
-		""" @param parentHWND: A handle to the parent window
-			@param controlID: The ID of the control. These (apparently)
-				are pretty reliably static, even between executions
-		"""
-		self.parentHWND = parentHWND
-		self.controlID = controlID
-		
-		# use a Win32 function to convert the controlID to a handle
-		self.hwnd = winUser.user32.GetDlgItem(self.parentHWND, self.controlID)
-
-	def setTrackbarValue(self, value):
-		""" Set the value of a trackbar control
-			@param value: The new value to assign
-		"""
-		# TBM_SETPOSNOTIFY is used, or the value doesn't actually take
-		winUser.sendMessage(self.hwnd, TBM_SETPOSNOTIFY, True, value)
-
-	def setChecked(self, checked):
-		""" Sets a checkbox's state
-			@param checked: True for a check, False for unchecked
-		"""
-		# if desired state doesn't match current state, simulate a click
-		if checked != self.isChecked():
-			self.click()
-		 
-	def isChecked(self):
-		""" Determine the state of a checkbox
-			@returns True if checked, False if not
-		"""
-		# The win32 function for checking returns a 1 if checked
-		return 1 == winUser.sendMessage(self.hwnd, BM_GETCHECK, 0, 0)
-		
-	def toggleCheck(self):
-		""" Toggle the state of a checkbox
-		"""
-		self.click()
-		
-	def click(self):
-		""" Simulate a mouse click on the control
-		"""
-		winUser.sendMessage(self.hwnd, BM_CLICK, 0, 0)
-
-class MagnifierSettingsDialog(gui.SettingsDialog):
-	""" A custom settings dialog, designed to function like other NVDA
-		settings dialogs while being a friendlier replacement for the
-		Windows 7 magnifier options dialog
-	"""
-	title = _("NVDA Magnifier Addon Options")
-
-	def makeSettings(self, settingsSizer):
-		""" Create controls and add them to settingsSizer
-			@param settingsSizer: the container to house all controls
-		"""
-		# keep track of the main sizer so we can re-layout later
-		self.settingsSizer = settingsSizer
-		
-		# modes dropdown and label
-		self.modes = ["Fullscreen", "Docked", "Lens"]
-		self.modeDescriptions = [_("Fullscreen"), _("Docked"), _("Lens")]
-		self.modeSelector = wx.Choice(self, wx.NewId(), name=_("&Mode"), choices=self.modeDescriptions)
-		self.modeSelector.SetSelection(self.modes.index(Windows7MagnifierConfig.conf["magnifier"]["mode"]))
-		modeSizer = wx.BoxSizer(wx.HORIZONTAL)
-		modeSizer.Add(wx.StaticText(self, -1, label=_("Mode") + ":"), border=5, flag=wx.RIGHT|wx.ALIGN_CENTER)
-		modeSizer.Add(self.modeSelector)
-		
-		settingsSizer.Add(modeSizer, border=10, flag=wx.BOTTOM)
-		
-		# Make a list of checkboxes for iterative creation
-		boxArgs = [
-			None,
-			("startWithNVDA", _("&Start the magnifier when NVDA starts")),
-			("closeWithNVDA", _("&Close the magnifier when NVDA is terminated")),
-			("hideMagnifierControls", _("&Hide the magnifier control window")),
-			("muteNVDA", _("Mute NVDA when the magnifier control window has focus (requires reload)")),
-			None,
-			("invertColors", _("&Invert colors")),
-			("followMouse", _("Follow the mouse &pointer")),
-			("followKeyboard", _("Follow the &keyboard focus")),
-			("followTextInsertion", _("Follow the &text insertion point"))
-		]
-		
-		# keep track of the checkboxes so they can be easily referenced
-		self.checkBoxes = {}
-		# tracking options grouped in a separate sizer so it can be
-		# hidden during Lens mode
-		self.trackingOptionsSizer = wx.BoxSizer(wx.VERTICAL)
-		for boxArg in boxArgs:
-			if boxArg == None:
-				settingsSizer.Add(wx.StaticLine(self), 0, wx.ALL|wx.EXPAND, 5)				
-				continue
-			name = boxArg[0]
-			box = wx.CheckBox(self, wx.NewId(), label=boxArg[1])
-
-			self.checkBoxes[name] = box
-			box.SetValue(Windows7MagnifierConfig.conf["magnifier"][name])
-			if name.startswith("follow"):
-				# tracking options should be hidden if in Lens mode
-				# Add them to an embedded sizer for easier to hiding
-				self.trackingOptionsSizer.Add(box, border=10, flag=wx.BOTTOM)
-			else:
-				settingsSizer.Add(box, border=10, flag=wx.BOTTOM)
-				
-		settingsSizer.Add(self.trackingOptionsSizer)
-
-		# lens size (horizontal/vertical) grouped in a separate sizer
-		# so it can be hidden during fullscreen/docked mode
-		self.lensSizeSizer = wx.GridSizer(rows=2, cols=2)
-		self.lensControls = []
-		for dimension in [_("Lens &width"), _("Lens h&eight")]:
-			control = wx.SpinCtrl(self, wx.NewId(), min=10, max=100, name=dimension)
-			self.lensSizeSizer.Add(wx.StaticText(self, -1, label=dimension))
-			self.lensSizeSizer.Add(control)
-			self.lensControls.append(control)
-			
-		self.lensControls[0].SetValue(Windows7MagnifierConfig.conf["magnifier"]["lensSizeHorizontal"])
-		self.lensControls[1].SetValue(Windows7MagnifierConfig.conf["magnifier"]["lensSizeVertical"])
-		settingsSizer.Add(self.lensSizeSizer, border=27, flag=wx.BOTTOM)		
-			
-	def postInit(self):
-		""" Called after dialog is created. Sets the focus to the top control
-		"""
-		self.modeSelector.Bind(wx.EVT_CHOICE, self.modeChanged)
-		self.modeChanged(None)
-		self.modeSelector.SetFocus()
-		
-	def onOk(self, evt):
-		""" Event handler for OK button being pressed
-			@param evt: the event which caused this action
-		"""
-		# make sure user has selected at least one tracking option
-		trackingSelected = False
-		for trackingOption in ["followMouse", "followKeyboard", "followTextInsertion"]:
-			if self.checkBoxes[trackingOption].IsChecked():
-				trackingSelected = True
-				break
-		if self.getMode() != "Lens" and not trackingSelected:
-			ui.message(_("You must select at least one 'Follow' option"))
-		else:
-			for name,box in self.checkBoxes.items():
-				Windows7MagnifierConfig.conf["magnifier"][name] = box.IsChecked()
-			
-			Windows7MagnifierConfig.conf["magnifier"]["mode"] = self.getMode()
-			Windows7MagnifierConfig.conf["magnifier"]["lensSizeHorizontal"] = self.lensControls[0].GetValue()
-			Windows7MagnifierConfig.conf["magnifier"]["lensSizeVertical"] = self.lensControls[1].GetValue()
-
-			# save the configuration file
-			Windows7MagnifierConfig.save()
-			
-			# apply the settings
-			GlobalPlugin.applyConfig()
-
-			super(MagnifierSettingsDialog, self).onOk(evt)
-			
-	def getMode(self):
-		""" Convenience method to obtain currently selected mode
-		"""
-		return self.modes[self.modeSelector.GetCurrentSelection()]
-			
-	def modeChanged(self, evt):
-		""" When the mode is changed, show appropriate controls, hide
-				inappropriate controls
-			@param evt: the event which caused this action
-		"""
-		if self.getMode() == "Lens":
-			self.trackingOptionsSizer.ShowItems(False)
-			self.lensSizeSizer.ShowItems(True)
-		else:
-			self.trackingOptionsSizer.ShowItems(True)
-			self.lensSizeSizer.ShowItems(False)
-			
-		self.Layout()
-		self.GetSizer().Fit(self)
-
-def MAKELPARAM(low, high):
-	""" Make an LPARAM for Win32 function calls
-	"""
-	shift = 32 if sys.maxsize > 2**32 else 16
-	return (high << shift) | low
-
-
-TH32CS_SNAPPROCESS = 0x00000002
-class PROCESSENTRY32(ctypes.Structure):
-	_fields_ = [
-		("dwSize", ctypes.c_ulong),
-		("cntUsage", ctypes.c_ulong),
-		("th32ProcessID", ctypes.c_ulong),
-		("th32DefaultHeapID", ctypes.c_ulong),
-		("th32ModuleID", ctypes.c_ulong),
-		("cntThreads", ctypes.c_ulong),
-		("th32ParentProcessID", ctypes.c_ulong),
-		("pcPriClassBase", ctypes.c_ulong),
-		("dwFlags", ctypes.c_ulong),
-		("szExeFile", ctypes.c_char * 260)
-	]
-
-def searchProcessList(imageName):
-	# See http://msdn2.microsoft.com/en-us/library/ms686701.aspx
-	CreateToolhelp32Snapshot = ctypes.windll.kernel32.CreateToolhelp32Snapshot
-	Process32First = ctypes.windll.kernel32.Process32First
-	Process32Next = ctypes.windll.kernel32.Process32Next
-	CloseHandle = ctypes.windll.kernel32.CloseHandle
-	hProcessSnap = CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
-	pe32 = PROCESSENTRY32()
-	pe32.dwSize = ctypes.sizeof(PROCESSENTRY32)
-	gotProcess = Process32First(hProcessSnap, ctypes.byref(pe32))
-	while gotProcess != win32con.FALSE:
-		if pe32.szExeFile.lower() == imageName.lower(): return pe32
-		gotProcess = Process32Next(hProcessSnap, ctypes.byref(pe32))
-		
-	CloseHandle(hProcessSnap)
-	return None
+#: Seconds taken to import this module
+importTime = time.time() - _importStart
+log.debug("Magnifier: plugin imported in %.3fs" % importTime)
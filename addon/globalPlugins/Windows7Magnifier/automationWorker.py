@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" A single long-lived thread that performs (slow) magnifier
+	automation, so NVDA's main thread never has to wait for it.
+"""
+
+import collections
+import threading
+import time
+
+from logHandler import log
+import tracing
+
+def mergeReplace(pending, new):
+	""" Coalescing rule: the newer command's arguments win
+	"""
+	return new
+
+class Command(object):
+	""" A queued request for the worker
+	"""
+
+	def __init__(self, name, kwargs, onComplete=None):
+		self.name = name
+		self.kwargs = kwargs
+		self.onComplete = [onComplete] if onComplete else []
+		self.submitTime = time.time()
+		self.startTime = None
+		self.endTime = None
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+
+	@property
+	def duration(self):
+		""" How long the command took to run, in seconds
+		"""
+		if self.startTime is None or self.endTime is None: return None
+		return self.endTime - self.startTime
+
+class AutomationWorker(object):
+	""" Runs registered command handlers one at a time, in submission
+		order, on a dedicated thread.
+	"""
+
+	def __init__(self, callAfter=None):
+		""" @param callAfter: used to deliver completion callbacks to the
+				GUI thread (e.g. wx.CallAfter). If None they run on the
+				worker thread.
+		"""
+		self.callAfter = callAfter
+		self.thread = None
+		self._handlers = {}
+		self._queue = collections.deque()
+		self._cond = threading.Condition()
+		self._running = False
+		self._current = None
+		# Statistics
+		self.submitted = 0
+		self.coalesced = 0
+		self.executed = 0
+		self.failed = 0
+
+	def register(self, name, handler, merge=None):
+		""" Make a command available
+			@param name: the command's name, used with L{submit}
+			@param handler: called with the command's arguments on the
+				worker thread
+			@param merge: if given, a queued command with the same name
+				directly ahead of a new one is combined with it. Called
+				as merge(pendingKwargs, newKwargs), returning the merged
+				arguments. See L{mergeReplace}.
+		"""
+		self._handlers[name] = (handler, merge)
+
+	def start(self):
+		with self._cond:
+			if self._running: return
+			self._running = True
+		self.thread = threading.Thread(target=self._run, name="Windows7Magnifier.AutomationWorker")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self, timeout=5):
+		""" Discard queued commands and end the thread once the
+			current command (if any) completes
+		"""
+		with self._cond:
+			self._running = False
+			self._queue.clear()
+			self._cond.notifyAll()
+		if self.thread and self.thread is not threading.currentThread():
+			self.thread.join(timeout)
+		self.thread = None
+
+	def submit(self, name, onComplete=None, **kwargs):
+		""" Queue a command and return immediately
+			@param name: a name given to L{register}
+			@param onComplete: optional function called as
+				onComplete(command) once the command has run
+			@returns: the queued L{Command} (possibly one it was merged into)
+		"""
+		handler, merge = self._handlers[name]
+		with self._cond:
+			self.submitted += 1
+			if merge and self._queue and self._queue[-1].name == name:
+				pending = self._queue[-1]
+				pending.kwargs = merge(pending.kwargs, kwargs)
+				if onComplete: pending.onComplete.append(onComplete)
+				self.coalesced += 1
+				log.debug("Magnifier: coalesced '%s' command" % name)
+				return pending
+			command = Command(name, kwargs, onComplete)
+			self._queue.append(command)
+			self._cond.notify()
+			return command
+
+	@property
+	def isBusy(self):
+		with self._cond:
+			return self._current is not None or len(self._queue) > 0
+
+	@property
+	def pending(self):
+		with self._cond:
+			return len(self._queue)
+
+	@property
+	def nextCommand(self):
+		""" The name of the command that will run next, or None
+		"""
+		with self._cond:
+			return self._queue[0].name if self._queue else None
+
+	def isWorkerThread(self):
+		return self.thread is not None and threading.currentThread() is self.thread
+
+	def waitUntilIdle(self, timeout=None):
+		""" Block until every queued command has run
+			@returns: True if idle, False if the timeout expired
+		"""
+		deadline = None if timeout is None else time.time() + timeout
+		with self._cond:
+			while self._current is not None or self._queue:
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0: return False
+				self._cond.wait(remaining)
+		return True
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while self._running and not self._queue:
+					self._cond.wait()
+				if not self._running: return
+				command = self._current = self._queue.popleft()
+			self._execute(command)
+			with self._cond:
+				self._current = None
+				self._cond.notifyAll()
+
+	def _execute(self, command):
+		handler = self._handlers[command.name][0]
+		command.startTime = time.time()
+		try:
+			with tracing.tracer.span(command.name):
+				command.result = handler(**command.kwargs)
+			self.executed += 1
+		except Exception, e:
+			command.error = e
+			self.failed += 1
+			log.error("Magnifier: '%s' command failed" % command.name, exc_info=True)
+		command.endTime = time.time()
+		log.debug("Magnifier: '%s' command took %.3fs (queued %.3fs)" % (command.name, command.duration, command.startTime - command.submitTime))
+		command.done.set()
+		for callback in command.onComplete:
+			if self.callAfter:
+				self.callAfter(callback, command)
+			else:
+				callback(command)
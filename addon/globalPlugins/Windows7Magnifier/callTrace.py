@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Records every Win32 call the addon makes, with what prompted it
+	(scripts, window events, foreground changes, option changes), so
+	latency problems seen on a user's machine can be replayed off
+	Windows (see benchmarks/replayTrace.py). The most recent events are
+	kept in a bounded ring buffer and saved as compact JSON lines.
+"""
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+import winBindings
+
+#: The version of the trace format written by L{CallRecorder.save}
+VERSION = 1
+
+#: How many events a recorder keeps
+CAPACITY = 20000
+
+#: The events which prompted the addon to act, rather than calls it made
+INPUTS = frozenset(("script", "foreground", "settings", "window"))
+
+class CallRecorder(object):
+	""" Wraps the Win32 bindings in use, recording when each call was
+		made, on which thread, its arguments, its result and how long it
+		took. Install it with L{winBindings.install}.
+	"""
+
+	def __init__(self, bindings, header=None, capacity=CAPACITY, clock=time.time, ignoredThreads=()):
+		""" @param bindings: the bindings to record calls to
+			@param header: extra information saved with the trace (e.g.
+				the addon's options), by name
+			@param capacity: how many events to keep
+			@param ignoredThreads: the names of threads whose calls aren't
+				recorded (e.g. the WinEvent hook's, which makes calls for
+				every window on the system)
+		"""
+		self.bindings = bindings
+		self.ignoredThreads = frozenset(ignoredThreads)
+		self.header = dict(header or {})
+		self.clock = clock
+		self.start = clock()
+		self._lock = threading.Lock()
+		self._events = collections.deque(maxlen=capacity)
+		self._local = threading.local()
+		#: How many events were recorded, including those since dropped
+		self.recorded = 0
+
+	def __getattr__(self, name):
+		if name not in winBindings.WRAPPERS:
+			# Constants, such as INVALID_HANDLE_VALUE
+			return getattr(self.bindings, name)
+		func = getattr(self.bindings, name)
+		def wrapper(*args):
+			if threading.currentThread().name in self.ignoredThreads:
+				return func(*args)
+			start = self.clock()
+			try:
+				result = func(*args)
+				# Iterators (e.g. processEntries) can only be consumed once
+				if isinstance(result, collections.Iterator):
+					result = list(result)
+			except EnvironmentError, e:
+				self._record(start, name, args, {"error": str(e)}, self.clock() - start)
+				raise
+			self._record(start, name, args, result, self.clock() - start)
+			return result
+		# Made once per wrapper
+		self.__dict__[name] = wrapper
+		return wrapper
+
+	def sleep(self, seconds):
+		""" time.sleep, recorded
+		"""
+		start = self.clock()
+		time.sleep(seconds)
+		self._record(start, "sleep", (seconds,), None, self.clock() - start)
+
+	def note(self, kind, *data):
+		""" Record an input (see L{INPUTS}). Ignored while another input
+			is being handled on the same thread, as it's a consequence of
+			that one.
+			@param kind: e.g. "script"
+			@param data: what the replay needs to repeat it
+		"""
+		if getattr(self._local, "depth", 0): return
+		self._record(self.clock(), kind, data, None, 0)
+
+	@contextlib.contextmanager
+	def input(self, kind, *data):
+		""" A context manager recording an input (see L{note}), during
+			which other inputs aren't recorded
+		"""
+		self.note(kind, *data)
+		self._local.depth = getattr(self._local, "depth", 0) + 1
+		try:
+			yield
+		finally:
+			self._local.depth -= 1
+
+	@property
+	def events(self):
+		""" The events kept, oldest first, as (offset, name, thread,
+			args, result, duration); offset is seconds since the
+			recorder was created
+		"""
+		with self._lock:
+			return list(self._events)
+
+	def save(self, path):
+		""" Write the events kept to a file, replacing it
+			@returns: the number of events written
+		"""
+		events = self.events
+		names = {}
+		threads = {}
+		lines = []
+		for offset, name, thread, args, result, duration in events:
+			lines.append(json.dumps([round(offset * 1000, 3), names.setdefault(name, len(names)),
+				threads.setdefault(thread, len(threads)), args, result, round(duration * 1000, 3)],
+				separators=(",", ":"), encoding="mbcs", default=repr))
+		header = dict(self.header)
+		header.update({
+			"version": VERSION,
+			"start": self.start,
+			"recorded": self.recorded,
+			"dropped": self.recorded - len(events),
+			"names": sorted(names, key=names.get),
+			"threads": sorted(threads, key=threads.get),
+		})
+		with open(path, "w") as f:
+			f.write(json.dumps(header, encoding="mbcs", default=repr) + "\n")
+			for line in lines:
+				f.write(line + "\n")
+		return len(events)
+
+	def _record(self, start, name, args, result, duration):
+		thread = threading.currentThread().name
+		with self._lock:
+			self._events.append((start - self.start, name, thread, args, result, duration))
+			self.recorded += 1
+
+def load(path):
+	""" Read a trace written by L{CallRecorder.save}
+		@returns: the header, and the events as (offset, name, thread,
+			args, result, duration) with times in seconds
+		@rtype: tuple
+		@raise ValueError: if the file isn't a trace this can read
+	"""
+	with open(path) as f:
+		header = json.loads(f.readline())
+		if header.get("version") != VERSION:
+			raise ValueError("unsupported trace version %r" % header.get("version"))
+		names = header["names"]
+		threads = header["threads"]
+		events = []
+		for line in f:
+			if not line.strip(): continue
+			offset, name, thread, args, result, duration = json.loads(line)
+			events.append((offset / 1000.0, names[name], threads[thread], args, result, duration / 1000.0))
+	return header, events
+
+def summarize(events):
+	""" @param events: as returned by L{load}
+		@returns: [number of calls, seconds spent] by name, for the
+			calls (and sleeps) among the events
+		@rtype: dict
+	"""
+	totals = {}
+	for offset, name, thread, args, result, duration in events:
+		if name in INPUTS: continue
+		total = totals.setdefault(name, [0, 0.0])
+		total[0] += 1
+		total[1] += duration
+	return totals
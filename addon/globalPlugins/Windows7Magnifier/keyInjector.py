@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Simulated keystrokes. Each chord (or a whole sequence of them) is
+	injected with a single SendInput call, so keys the user presses
+	meanwhile can't land in the middle of it.
+"""
+
+import threading
+
+KEYEVENTF_KEYUP = 0x02
+
+class KeyInjector(object):
+	""" Presses chords through the Win32 bindings, translating
+		characters to virtual keys for the foreground window's keyboard
+		layout
+	"""
+
+	def __init__(self, win32):
+		""" @param win32: the L{winBindings} in use
+		"""
+		self.win32 = win32
+		self._lock = threading.Lock()
+		# Character to virtual key translations, for one layout
+		self._layout = None
+		self._vkCache = {}
+		# Statistics
+		self.batches = 0
+		self.events = 0
+		self.cacheHits = 0
+		self.cacheMisses = 0
+		self.layoutChanges = 0
+
+	def virtualize(self, keys):
+		""" Convert characters to their virtual keys
+			@param keys: virtual key codes and/or characters
+			@returns: a new list of virtual key codes
+		"""
+		if not any(isinstance(key, basestring) for key in keys):
+			return list(keys)
+		# The layout of the application being typed in; the calling
+		# thread's own layout doesn't follow the user switching language
+		layout = self.win32.getKeyboardLayout(self.win32.getWindowThreadId(self.win32.getForegroundWindow()))
+		with self._lock:
+			if layout != self._layout:
+				if self._layout is not None: self.layoutChanges += 1
+				self._layout = layout
+				self._vkCache = {}
+			cache = self._vkCache
+		vks = []
+		for key in keys:
+			# If it's not a string, assume it's already a VK
+			if isinstance(key, basestring):
+				vk = cache.get(key)
+				if vk is None:
+					self.cacheMisses += 1
+					vk = cache[key] = self.win32.vkKeyScanEx(key, layout)[1]
+				else:
+					self.cacheHits += 1
+				key = vk
+			vks.append(key)
+		return vks
+
+	def chordEvents(self, keys):
+		""" @returns: the (vk, flags) events pressing keys together:
+			each key down in order, then up in reverse order
+		"""
+		vks = self.virtualize(keys)
+		return [(vk, 0) for vk in vks] + [(vk, KEYEVENTF_KEYUP) for vk in reversed(vks)]
+
+	def press(self, keys):
+		""" Press keys simultaneously, as one batch
+			@param keys: virtual key codes and/or characters
+		"""
+		self.send(self.chordEvents(keys))
+
+	def pressSequence(self, chords):
+		""" Press several chords one after another, as one batch (e.g. a
+			burst of zoom hotkeys)
+			@param chords: a list of key lists, as for L{press}
+		"""
+		events = []
+		for keys in chords:
+			events.extend(self.chordEvents(keys))
+		self.send(events)
+
+	def release(self, keys):
+		""" Send key up events for keys, as one batch
+		"""
+		self.send([(vk, KEYEVENTF_KEYUP) for vk in self.virtualize(keys)])
+
+	def send(self, events):
+		""" Inject (vk, flags) events with a single call
+		"""
+		if not events: return
+		self.batches += 1
+		self.events += len(events)
+		self.win32.sendInput(events)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" The addon's record of what the (real) magnifier is currently set to,
+	so settings that already match don't have to be applied again.
+"""
+
+import threading
+
+from logHandler import log
+
+#: The settings tracked, in the order they are applied
+FIELDS = (
+	"mode",
+	"invertColors",
+	"followMouse",
+	"followKeyboard",
+	"followTextInsertion",
+	"lensSizeHorizontal",
+	"lensSizeVertical",
+)
+
+class MagnifierState(object):
+	""" Known values of the magnifier's settings. A value of None means
+		unknown. The whole model is marked stale whenever something
+		outside the addon may have changed the magnifier (e.g. it was
+		restarted, or the user opened its options dialog).
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._values = dict.fromkeys(FIELDS)
+		self._stale = True
+		self.staleReason = "never read"
+
+	@property
+	def stale(self):
+		with self._lock:
+			return self._stale
+
+	def markStale(self, reason):
+		""" Stop trusting the model until it is refreshed
+			@param reason: logged, to help explain unexpected refreshes
+		"""
+		with self._lock:
+			if not self._stale:
+				log.debug("Magnifier: state is now stale (%s)" % reason)
+			self._stale = True
+			self.staleReason = reason
+
+	def refreshed(self, **values):
+		""" Replace the model with values read from the real magnifier
+		"""
+		with self._lock:
+			self._values = dict.fromkeys(FIELDS)
+			self._set(values)
+			self._stale = False
+			self.staleReason = None
+
+	def update(self, **values):
+		""" Record settings the addon has just applied. Does not make a
+			stale model fresh.
+		"""
+		with self._lock:
+			self._set(values)
+
+	def get(self, name):
+		with self._lock:
+			return self._values[name]
+
+	def snapshot(self):
+		""" @returns: a copy of the known values
+			@rtype: dict
+		"""
+		with self._lock:
+			return dict(self._values)
+
+	def diff(self, **desired):
+		""" Work out which of the desired settings need applying
+			@param desired: settings to compare; None values are ignored
+			@returns: the desired settings which differ from (or aren't
+				known in) the model. Everything is returned when stale.
+			@rtype: dict
+		"""
+		with self._lock:
+			delta = {}
+			for name, value in desired.items():
+				if value is None: continue
+				if self._stale or self._values[name] != value:
+					delta[name] = value
+			return delta
+
+	def _set(self, values):
+		for name, value in values.items():
+			if name not in self._values:
+				raise KeyError(name)
+			if value is not None:
+				self._values[name] = value
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Tracks which mode the magnifier is in from its windows appearing
+	and disappearing, so callers can wait for a mode instead of
+	polling for it.
+"""
+
+import threading
+import time
+
+from logHandler import log
+import windowWatcher
+import windowInventory
+
+# States
+STOPPED = "Stopped"
+STARTING = "Starting"
+FULLSCREEN = windowInventory.FULLSCREEN
+DOCKED = windowInventory.DOCKED
+LENS = windowInventory.LENS
+
+#: The states in which the magnifier is running in a mode
+MODES = frozenset((FULLSCREEN, DOCKED, LENS))
+
+class TransitionStats(object):
+	""" Latencies of the transitions between one pair of states
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.last = None
+
+	def add(self, latency):
+		self.count += 1
+		self.total += latency
+		self.max = max(self.max, latency)
+		self.last = latency
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count else None
+
+class ModeMachine(object):
+	""" The magnifier's state: L{STOPPED}, L{STARTING} (running without
+		a mode window yet), or one of the L{MODES}. Driven by window
+		notifications and the process exiting.
+	"""
+
+	def __init__(self, watcher, inventory, clock=time.time):
+		""" @param watcher: the L{windowWatcher.WindowWatcher}
+			@param inventory: the L{windowInventory.WindowInventory}, used
+				to find the state when notifications can't be relied on
+		"""
+		self.watcher = watcher
+		self.inventory = inventory
+		self.clock = clock
+		self._cond = threading.Condition()
+		self._state = STOPPED
+		# The windows being tracked. Destroy notifications can't tell
+		# the class of the window, so they're matched by handle.
+		self._mainWindow = 0
+		self._modeWindows = {}
+		# Where the pending (requested) transition started from, and when
+		self._requestedFrom = None
+		self._requestedAt = None
+		#: L{TransitionStats} by (from, to) state pair
+		self.latencies = {}
+		self.transitions = 0
+		self.timeouts = 0
+		self.retries = 0
+		self._classes = dict((windowInventory.CLASSES[mode], mode) for mode in MODES)
+		watcher.addListener(self._onWindowEvent)
+		self.sync()
+
+	def stop(self):
+		self.watcher.removeListener(self._onWindowEvent)
+		with self._cond:
+			self._cond.notifyAll()
+
+	@property
+	def state(self):
+		with self._cond:
+			return self._state
+
+	@property
+	def mode(self):
+		""" The current mode, or None if not running in one
+		"""
+		state = self.state
+		return state if state in MODES else None
+
+	def sync(self):
+		""" Set the state from the windows that exist, in case a
+			notification was missed
+		"""
+		handles = self.inventory.find(windowInventory.MAIN, *MODES)
+		mode = None
+		for candidate in windowInventory.MODES:
+			if handles[candidate]:
+				mode = candidate
+				break
+		with self._cond:
+			self._mainWindow = handles[windowInventory.MAIN]
+			self._modeWindows = dict((handles[m], m) for m in MODES if handles[m])
+			if mode:
+				self._enter(mode)
+			elif self._mainWindow:
+				self._enter(STARTING)
+			elif self._state != STARTING:
+				# (Starting may be waiting for the process to create its
+				# first window)
+				self._enter(STOPPED)
+		return self.state
+
+	def launching(self):
+		""" The magnifier is being launched
+		"""
+		with self._cond:
+			if self._state == STOPPED:
+				self._request()
+				self._enter(STARTING)
+
+	def exited(self):
+		""" The magnifier process has exited
+		"""
+		with self._cond:
+			self._mainWindow = 0
+			self._modeWindows.clear()
+			self._enter(STOPPED)
+
+	def waitFor(self, states, timeout):
+		""" Block until the machine is in one of the given states
+			@param states: a state, or a collection of states
+			@returns: True if reached, False if the timeout expired
+		"""
+		if isinstance(states, basestring): states = (states,)
+		deadline = self.clock() + timeout
+		with self._cond:
+			while self._state not in states:
+				remaining = deadline - self.clock()
+				if remaining <= 0: return False
+				self._cond.wait(remaining)
+			return True
+
+	def requestMode(self, mode, send, timeout=3.0, retries=1):
+		""" Switch to a mode
+			@param mode: one of L{MODES}
+			@param send: makes the magnifier switch (e.g. presses its
+				hotkey); called again for each retry
+			@param timeout: seconds to wait for the mode window each try
+			@param retries: how many more times to send if it times out
+			@returns: True if the magnifier is now in the mode
+		"""
+		if self.sync() == mode: return True
+		for attempt in range(retries + 1):
+			if attempt:
+				self.retries += 1
+				log.debug("Magnifier: no %s mode window after %.1fs, retrying" % (mode, timeout))
+			with self._cond:
+				self._request()
+			send()
+			if self.waitFor(mode, timeout): return True
+			self.timeouts += 1
+			# Perhaps a notification was missed
+			if self.sync() == mode: return True
+		log.warning("Magnifier: could not switch to %s mode" % mode)
+		return False
+
+	def summary(self):
+		parts = []
+		for (old, new), stats in sorted(self.latencies.items()):
+			parts.append("%s->%s %d x %.3fs (max %.3fs)" % (old, new, stats.count, stats.mean, stats.max))
+		return ", ".join(parts) or "no transitions"
+
+	def _request(self):
+		# Called with the lock held
+		self._requestedFrom = self._state
+		self._requestedAt = self.clock()
+
+	def _enter(self, state):
+		# Called with the lock held
+		if state == self._state: return
+		old, self._state = self._state, state
+		self.transitions += 1
+		if state in MODES and self._requestedAt is not None:
+			key = (self._requestedFrom, state)
+			stats = self.latencies.get(key)
+			if stats is None: stats = self.latencies[key] = TransitionStats()
+			stats.add(self.clock() - self._requestedAt)
+			self._requestedAt = self._requestedFrom = None
+		log.debug("Magnifier: %s -> %s" % (old, state))
+		self._cond.notifyAll()
+
+	def _onWindowEvent(self, event, hwnd, windowClass, windowName):
+		mainClass = windowInventory.CLASSES[windowInventory.MAIN]
+		with self._cond:
+			if event == windowWatcher.EVENT_OBJECT_DESTROY:
+				mode = self._modeWindows.pop(hwnd, None)
+				if mode and mode == self._state:
+					# The mode window went away; running, but in no mode
+					self._enter(STARTING)
+				elif hwnd == self._mainWindow:
+					self._mainWindow = 0
+					self._modeWindows.clear()
+					self._enter(STOPPED)
+				return
+			if event not in (windowWatcher.EVENT_OBJECT_CREATE, windowWatcher.EVENT_OBJECT_SHOW): return
+			mode = self._classes.get(windowClass)
+			if mode:
+				self._modeWindows[hwnd] = mode
+				self._enter(mode)
+			elif windowClass == mainClass:
+				self._mainWindow = hwnd
+				if self._state == STOPPED: self._enter(STARTING)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" A session with the magnifier's (real) options dialog. The control
+	handles are resolved once and every control is read in one batch,
+	so only the values that differ are written, and the dialog can be
+	kept open across several queued changes before they are committed.
+"""
+
+from logHandler import log
+
+BM_CLICK = 0xF5
+BM_GETCHECK = 0xF0
+TBM_GETPOS = 0x400
+TBM_SETPOSNOTIFY = 0x422
+
+#: The dialog's checkboxes, in the order they are read
+CHECKBOXES = ("invertColors", "followMouse", "followKeyboard", "followTextInsertion")
+
+#: The dialog's trackbars, in the order they are read
+TRACKBARS = ("lensSizeHorizontal", "lensSizeVertical")
+
+def toTrackbar(name, value):
+	""" The trackbars' scales are offset (and in one case reversed) from
+		the lens size
+		@returns: the trackbar position for a lens size
+	"""
+	if name == "lensSizeHorizontal": return value - 10
+	return 100 - value
+
+def fromTrackbar(name, position):
+	""" @returns: the lens size for a trackbar position
+	"""
+	if name == "lensSizeHorizontal": return position + 10
+	return 100 - position
+
+class OptionsDialogSession(object):
+	""" The open options dialog, with its controls' handles and values
+	"""
+
+	def __init__(self, win32, hwnd, controlIDs):
+		""" @param win32: the L{winBindings} in use
+			@param hwnd: the options dialog
+			@param controlIDs: the ID of each control, by setting name
+		"""
+		self.win32 = win32
+		self.hwnd = hwnd
+		# Resolve every control once; lens size controls only exist
+		# in lens mode
+		self.controls = {}
+		for name in CHECKBOXES + TRACKBARS:
+			self.controls[name] = win32.getDlgItem(hwnd, controlIDs[name])
+		self._values = None
+		#: How many changes were written in this session
+		self.writes = 0
+		#: How many applySettings calls used this session
+		self.uses = 0
+
+	def isOpen(self):
+		""" @returns: True if the dialog still exists (the user may have
+			closed it)
+		"""
+		return bool(self.hwnd) and bool(self.win32.isWindow(self.hwnd))
+
+	def read(self):
+		""" Read every control, once per session; later calls return the
+			values as last read or written
+			@returns: the value of each control that exists, by name
+			@rtype: dict
+		"""
+		if self._values is None:
+			values = {}
+			for name in CHECKBOXES:
+				if self.controls.get(name):
+					values[name] = self._isChecked(name)
+			for name in TRACKBARS:
+				if self.controls.get(name):
+					values[name] = fromTrackbar(name, self.win32.sendMessage(self.controls[name], TBM_GETPOS, 0, 0))
+			self._values = values
+		return dict(self._values)
+
+	def write(self, settings, confirm=None):
+		""" Set the controls whose values differ from the dialog's
+			@param settings: the values to set, by setting name
+			@param confirm: optional function called as confirm(name,
+				isSet) after clicking a checkbox, to wait until isSet()
+				is True
+			@returns: the settings that were changed
+			@rtype: dict
+		"""
+		current = self.read()
+		changes = {}
+		for name, value in settings.items():
+			if name not in self.controls: continue
+			if not self.controls[name]:
+				log.debug("Magnifier: Could not find control %s" % name)
+				continue
+			if current.get(name) != value:
+				changes[name] = value
+
+		# Magnifier will complain if you uncheck all tracking options.
+		# So we must mark all the CHECKED boxes first
+		checkboxes = sorted([name for name in CHECKBOXES if name in changes], key=lambda name: not changes[name])
+		for name in checkboxes:
+			log.debug("Magnifier: Setting %s %s" % (name, changes[name]))
+			self.win32.sendMessage(self.controls[name], BM_CLICK, 0, 0)
+			if confirm:
+				value = changes[name]
+				confirm(name, lambda: self._isChecked(name) == value)
+		for name in TRACKBARS:
+			# TBM_SETPOSNOTIFY is used, or the value doesn't actually take
+			if name in changes:
+				self.win32.sendMessage(self.controls[name], TBM_SETPOSNOTIFY, True, toTrackbar(name, changes[name]))
+
+		self._values.update(changes)
+		self.writes += len(changes)
+		return changes
+
+	def _isChecked(self, name):
+		# The win32 function for checking returns a 1 if checked
+		return 1 == self.win32.sendMessage(self.controls[name], BM_GETCHECK, 0, 0)
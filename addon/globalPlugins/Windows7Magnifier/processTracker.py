@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Keeps track of a single process (the magnifier) by holding a
+	waitable handle to it, rather than searching the process list every
+	time someone asks whether it is running.
+"""
+
+import threading
+import time
+
+from logHandler import log
+import winBindings
+
+SYNCHRONIZE = 0x00100000
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+INFINITE = 0xFFFFFFFF
+WAIT_OBJECT_0 = 0
+
+class ProcessTracker(object):
+	""" Answers "is the process running" from cached state. The cache
+		is filled by one process list snapshot and invalidated when the
+		process handle is signalled (i.e. the process exited).
+	"""
+
+	def __init__(self, imageName, backend, negativeCacheTime=2.0, unopenedCacheTime=2.0):
+		""" @param imageName: the executable to track, e.g. magnify.exe
+			@param backend: A L{Win32ProcessBackend} or L{FakeProcessBackend}
+			@param negativeCacheTime: how long (seconds) a "not running"
+				answer is trusted before the process list is searched
+				again. L{invalidate} discards it early.
+			@param unopenedCacheTime: how long (seconds) a "running"
+				answer is trusted when the process was found but no handle
+				to it could be opened (e.g. access denied)
+		"""
+		self.imageName = imageName
+		self.backend = backend
+		self.negativeCacheTime = negativeCacheTime
+		self.unopenedCacheTime = unopenedCacheTime
+		self._lock = threading.Lock()
+		self._pid = None
+		self._handle = None
+		self._lastMiss = None
+		self._lastUnopened = None
+		self._exitListeners = []
+		self._monitor = None
+		self._exited = None
+		# Counters
+		self.snapshotsTaken = 0
+		self.handlesOpen = 0
+		self.exitsObserved = 0
+		self.openFailures = 0
+
+	@property
+	def pid(self):
+		return self._pid
+
+	@property
+	def handle(self):
+		return self._handle
+
+	def addExitListener(self, callback):
+		""" @param callback: called as callback(pid, exitCode) on the
+				monitor thread when the tracked process exits. exitCode is
+				None if it couldn't be read. L{waitForExit} returns once
+				every listener has.
+		"""
+		self._exitListeners.append(callback)
+
+	def removeExitListener(self, callback):
+		if callback in self._exitListeners:
+			self._exitListeners.remove(callback)
+
+	def invalidate(self):
+		""" Forget a cached answer, e.g. because the process has just
+			been launched or one of its windows appeared
+		"""
+		self._lastMiss = None
+		self._lastUnopened = None
+
+	def isRunning(self):
+		""" Determine if the process is running
+			@returns: True if running, False if not
+			@rtype: boolean
+		"""
+		with self._lock:
+			if self._handle is not None:
+				# If it has exited, the monitor thread is about to clean up
+				return not self.backend.hasExited(self._handle)
+			if self._lastMiss is not None and time.time() - self._lastMiss < self.negativeCacheTime:
+				return False
+			if self._lastUnopened is not None and time.time() - self._lastUnopened < self.unopenedCacheTime:
+				return True
+			return self._refresh()
+
+	def waitForExit(self, timeout):
+		""" Block until the tracked process has exited
+			@param timeout: the maximum number of seconds to wait
+			@returns: True if it isn't running (any more)
+		"""
+		running = self.isRunning()
+		with self._lock:
+			exited = self._exited
+		if exited is None or exited.isSet():
+			# Either gone, or running without a handle to wait on
+			return not running
+		# Also waits for the exit listeners, if it has just exited
+		return exited.wait(timeout) or exited.isSet()
+
+	def stop(self):
+		""" Stop monitoring and close any open handle
+		"""
+		# Wake the monitor before closing the handle it's waiting on
+		self.backend.interrupt()
+		if self._monitor:
+			self._monitor.join(5)
+			self._monitor = None
+		with self._lock:
+			self._releaseHandle()
+
+	def summary(self):
+		return "%d snapshots, %d handles open, %d exits observed, %d processes not opened" % (self.snapshotsTaken, self.handlesOpen, self.exitsObserved, self.openFailures)
+
+	def _refresh(self):
+		""" Search the process list. Must be called with the lock held.
+		"""
+		self.snapshotsTaken += 1
+		pid = self.backend.findProcess(self.imageName)
+		if pid is None:
+			self._lastMiss = time.time()
+			self._lastUnopened = None
+			self._pid = None
+			return False
+		self._lastMiss = None
+		handle = self.backend.openProcess(pid)
+		if handle is None:
+			# Can't wait on it (e.g. access denied), so trust the answer
+			# for a short while only
+			log.debug("Magnifier: could not open process %d" % pid)
+			self.openFailures += 1
+			self._pid = pid
+			self._lastUnopened = time.time()
+			return True
+		self._lastUnopened = None
+		self._pid = pid
+		self._handle = handle
+		self.handlesOpen += 1
+		self.backend.resetInterrupt()
+		self._exited = threading.Event()
+		self._monitor = threading.Thread(target=self._watch, args=(handle, pid), name="Windows7Magnifier.ProcessTracker")
+		self._monitor.daemon = True
+		self._monitor.start()
+		return True
+
+	def _releaseHandle(self):
+		""" Must be called with the lock held
+		"""
+		if self._handle is None: return
+		self.backend.closeHandle(self._handle)
+		self.handlesOpen -= 1
+		self._handle = None
+		self._pid = None
+
+	def _watch(self, handle, pid):
+		""" Monitor thread: block on the process handle until it exits
+		"""
+		if not self.backend.waitForExit(handle):
+			# Interrupted by stop()
+			return
+		with self._lock:
+			exitCode = self.backend.exitCode(handle)
+			if self._handle == handle:
+				self._releaseHandle()
+			self._lastMiss = None
+			self.exitsObserved += 1
+			exited = self._exited
+		log.debug("Magnifier: process %d exited with code %r" % (pid, exitCode))
+		for listener in list(self._exitListeners):
+			try:
+				listener(pid, exitCode)
+			except:
+				log.error("Magnifier: process exit listener failed", exc_info=True)
+		# Only once the listeners are done, so whoever waited for the exit
+		# (e.g. to relaunch) can't have its work undone by them
+		exited.set()
+
+class Win32ProcessBackend(object):
+	""" Finds and waits on processes through the Win32 API
+	"""
+
+	def __init__(self):
+		self._win32 = winBindings.get()
+		# Manual reset event used to interrupt waits on shutdown
+		self._stopEvent = self._win32.createEvent(True, False)
+
+	def findProcess(self, imageName):
+		return searchProcessList(imageName)
+
+	def openProcess(self, pid):
+		return self._win32.openProcess(SYNCHRONIZE | PROCESS_QUERY_LIMITED_INFORMATION, pid)
+
+	def hasExited(self, handle):
+		return self._win32.waitForSingleObject(handle, 0) == WAIT_OBJECT_0
+
+	def exitCode(self, handle):
+		""" @returns: the exited process's exit code, or None
+		"""
+		return self._win32.getExitCodeProcess(handle)
+
+	def waitForExit(self, handle):
+		""" @returns: True if the process exited, False if interrupted
+		"""
+		result = self._win32.waitForMultipleObjects((handle, self._stopEvent), False, INFINITE)
+		return result == WAIT_OBJECT_0
+
+	def closeHandle(self, handle):
+		self._win32.closeHandle(handle)
+
+	def interrupt(self):
+		self._win32.setEvent(self._stopEvent)
+
+	def resetInterrupt(self):
+		self._win32.resetEvent(self._stopEvent)
+
+class FakeProcessBackend(object):
+	""" An in-memory stand-in for L{Win32ProcessBackend}
+	"""
+
+	def __init__(self):
+		self._cond = threading.Condition()
+		self._processes = {}
+		self._handles = {}
+		self._exitCodes = {}
+		self._nextPid = 1000
+		self._nextHandle = 4
+		self._interrupted = False
+
+	def launch(self, imageName):
+		""" Simulate a process starting
+			@returns: the new pid
+		"""
+		with self._cond:
+			pid = self._nextPid
+			self._nextPid += 4
+			self._processes[pid] = imageName
+			return pid
+
+	def kill(self, pid, exitCode=0):
+		""" Simulate a process exiting
+			@param exitCode: non-zero for e.g. a crash
+		"""
+		with self._cond:
+			self._processes.pop(pid, None)
+			self._exitCodes[pid] = exitCode
+			self._cond.notifyAll()
+
+	def findProcess(self, imageName):
+		with self._cond:
+			for pid, name in sorted(self._processes.items()):
+				if name.lower() == imageName.lower(): return pid
+		return None
+
+	def openProcess(self, pid):
+		with self._cond:
+			if pid not in self._processes: return None
+			handle = self._nextHandle
+			self._nextHandle += 4
+			self._handles[handle] = pid
+			return handle
+
+	def hasExited(self, handle):
+		with self._cond:
+			return self._handles.get(handle) not in self._processes
+
+	def exitCode(self, handle):
+		with self._cond:
+			return self._exitCodes.get(self._handles.get(handle))
+
+	def waitForExit(self, handle):
+		with self._cond:
+			while self._handles.get(handle) in self._processes:
+				if self._interrupted: return False
+				self._cond.wait()
+			return True
+
+	def closeHandle(self, handle):
+		with self._cond:
+			self._handles.pop(handle, None)
+
+	@property
+	def openHandles(self):
+		return len(self._handles)
+
+	def interrupt(self):
+		with self._cond:
+			self._interrupted = True
+			self._cond.notifyAll()
+
+	def resetInterrupt(self):
+		with self._cond:
+			self._interrupted = False
+
+def searchProcessList(imageName):
+	""" Walk a snapshot of the process list looking for imageName
+		@returns: the matching process's pid, or None
+	"""
+	# See http://msdn2.microsoft.com/en-us/library/ms686701.aspx
+	win32 = winBindings.get()
+	hProcessSnap = win32.createToolhelp32Snapshot()
+	if hProcessSnap is None: return None
+	try:
+		imageName = imageName.lower()
+		for pid, exeFile in win32.processEntries(hProcessSnap):
+			if exeFile.lower() == imageName: return pid
+	finally:
+		win32.closeHandle(hProcessSnap)
+	return None
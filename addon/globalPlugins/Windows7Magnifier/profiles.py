@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Per application profiles. The profile of the foreground application
+	is switched to once the foreground has settled, and what has to
+	change between each pair of profiles is worked out ahead of time.
+"""
+
+import threading
+import time
+
+from logHandler import log
+
+#: The options which apply in each mode, as arguments for applySettings.
+#: Fullscreen and docked have identical settings.
+MODE_OPTIONS = {
+	"Lens": ("mode", "invertColors", "lensSizeHorizontal", "lensSizeVertical"),
+	None: ("mode", "invertColors", "followMouse", "followKeyboard", "followTextInsertion"),
+}
+
+#: The options the magnifier has hotkeys for
+HOTKEY_OPTIONS = frozenset(("mode", "invertColors"))
+
+def effectiveSettings(base, profile=None):
+	""" @param base: the configured options, by name
+		@param profile: the options set by a profile, if any
+		@returns: the options to apply, as arguments for applySettings
+		@rtype: dict
+	"""
+	values = dict(base)
+	if profile: values.update(profile)
+	names = MODE_OPTIONS.get(values["mode"], MODE_OPTIONS[None])
+	return dict((name, values[name]) for name in names)
+
+class TransitionPlan(object):
+	""" What has to change to go from one profile to another
+	"""
+
+	def __init__(self, old, new, source, target):
+		""" @param old: the effective settings of the profile left
+			@param new: the effective settings of the profile entered
+			@param source: the name of the profile left (None for none)
+			@param target: the name of the profile entered
+		"""
+		self.old = old
+		self.new = new
+		self.source = source
+		self.target = target
+		#: The settings which differ
+		self.changes = dict((name, value) for name, value in new.items() if old.get(name) != value)
+		#: True if the magnifier's hotkeys suffice, so neither its
+		#: options dialog nor a restart is needed
+		self.hotkeysOnly = HOTKEY_OPTIONS.issuperset(self.changes)
+
+	def __repr__(self):
+		return "<TransitionPlan %s->%s %r%s>" % (self.source, self.target, self.changes, " (hotkeys)" if self.hotkeysOnly else "")
+
+class ProfileSwitcher(object):
+	""" Follows the foreground application and switches to its profile
+		once it has stayed in the foreground for a short while, so
+		alt+tabbing past an application doesn't switch.
+	"""
+
+	def __init__(self, settings, getProfiles, apply, delay=0.5, clock=time.time):
+		""" @param settings: the L{Windows7MagnifierConfig.MagnifierSettings}
+			@param getProfiles: returns the profiles, by application name
+				(see L{Windows7MagnifierConfig.getProfiles})
+			@param apply: called as apply(plan) on the switcher's thread
+				with the L{TransitionPlan} of each switch
+			@param delay: seconds the foreground must settle for
+		"""
+		self.settings = settings
+		self.getProfiles = getProfiles
+		self.apply = apply
+		self.delay = delay
+		self.clock = clock
+		self.thread = None
+		self._cond = threading.Condition()
+		self._running = False
+		self._active = None
+		self._pending = None
+		self._deadline = None
+		# The plans, and the profiles they were made for. They're also
+		# made again when the configured options change.
+		self._plans = {}
+		self._plannedFrom = None
+		# Statistics
+		self.switches = 0
+		self.superseded = 0
+		self.planHits = 0
+		self.planBuilds = 0
+		settings.subscribe(self._onSettingsChanged)
+
+	@property
+	def active(self):
+		""" The name of the profile in effect, or None
+		"""
+		with self._cond:
+			return self._active
+
+	def activeSettings(self):
+		""" @returns: the options to apply with the active profile, as
+			arguments for applySettings
+		"""
+		active = self.active
+		return effectiveSettings(self.settings.snapshot(), self.getProfiles().get(active))
+
+	def foreground(self, appName):
+		""" An application has come to the foreground. Returns
+			immediately.
+			@param appName: e.g. winword
+		"""
+		appName = appName.lower() if appName else None
+		target = appName if appName in self.getProfiles() else None
+		with self._cond:
+			if self._deadline is not None:
+				if target == self._pending:
+					return
+				self.superseded += 1
+			elif target == self._active:
+				return
+			self._pending = target
+			self._deadline = self.clock() + self.delay
+			if not self._running:
+				self._running = True
+				self.thread = threading.Thread(target=self._run, name="Windows7Magnifier.ProfileSwitcher")
+				self.thread.daemon = True
+				self.thread.start()
+			self._cond.notify()
+
+	def plan(self, source, target):
+		""" @returns: the L{TransitionPlan} from one profile to another
+		"""
+		plan = self._currentPlans().get((source, target))
+		if plan is None:
+			# A profile removed since the switch was requested
+			base = self.settings.snapshot()
+			profiles = self.getProfiles()
+			plan = TransitionPlan(effectiveSettings(base, profiles.get(source)), effectiveSettings(base, profiles.get(target)), source, target)
+		else:
+			self.planHits += 1
+		return plan
+
+	def stop(self):
+		self.settings.unsubscribe(self._onSettingsChanged)
+		with self._cond:
+			self._running = False
+			self._deadline = None
+			self._cond.notify()
+		if self.thread and self.thread is not threading.currentThread():
+			self.thread.join(5)
+		self.thread = None
+
+	def summary(self):
+		return "%d switches, %d superseded, %d plan hits, %d plans built" % (self.switches, self.superseded, self.planHits, self.planBuilds)
+
+	def _currentPlans(self):
+		profiles = self.getProfiles()
+		with self._cond:
+			if self._plannedFrom is profiles:
+				return self._plans
+		return self._makePlans(profiles, self.settings.snapshot())
+
+	def _makePlans(self, profiles, base):
+		""" Plan the transition between every pair of profiles
+		"""
+		names = [None] + sorted(profiles)
+		effective = dict((name, effectiveSettings(base, profiles.get(name))) for name in names)
+		plans = {}
+		for source in names:
+			for target in names:
+				if source != target:
+					plans[(source, target)] = TransitionPlan(effective[source], effective[target], source, target)
+		with self._cond:
+			self._plans = plans
+			self._plannedFrom = profiles
+			self.planBuilds += len(plans)
+		log.debug("Magnifier: planned %d profile transitions" % len(plans))
+		return plans
+
+	def _onSettingsChanged(self, changes, external):
+		# The plans start from the configured options
+		with self._cond:
+			self._plannedFrom = None
+
+	def _run(self):
+		while True:
+			# (Re)make the plans while the foreground settles, so the
+			# switch itself needn't
+			self._currentPlans()
+			with self._cond:
+				while self._running and (self._deadline is None or self.clock() < self._deadline):
+					self._cond.wait(None if self._deadline is None else self._deadline - self.clock())
+				if not self._running: return
+				self._deadline = None
+				source, target = self._active, self._pending
+				if source == target: continue
+				self._active = target
+				self.switches += 1
+			plan = self.plan(source, target)
+			log.debug("Magnifier: switching profile %r" % plan)
+			try:
+				self.apply(plan)
+			except:
+				log.error("Magnifier: could not switch profile", exc_info=True)
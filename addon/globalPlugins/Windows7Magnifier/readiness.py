@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Waiting for the magnifier to become ready, by checking explicit
+	conditions rather than sleeping for fixed amounts of time.
+"""
+
+import threading
+import time
+
+from logHandler import log
+import tracing
+
+class PredicateStats(object):
+	""" Timings for one named condition, so wait budgets can be tuned
+		from real data
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self.waits = 0
+		self.timeouts = 0
+		self.checks = 0
+		self.totalTime = 0.0
+		self.fastest = None
+		self.slowest = None
+
+	def record(self, elapsed, checks, succeeded):
+		self.waits += 1
+		self.checks += checks
+		if not succeeded:
+			self.timeouts += 1
+			return
+		self.totalTime += elapsed
+		if self.fastest is None or elapsed < self.fastest: self.fastest = elapsed
+		if self.slowest is None or elapsed > self.slowest: self.slowest = elapsed
+
+	@property
+	def average(self):
+		successes = self.waits - self.timeouts
+		return self.totalTime / successes if successes else None
+
+	def __repr__(self):
+		if self.average is None:
+			return "%s: %d waits, %d timeouts" % (self.name, self.waits, self.timeouts)
+		return "%s: %d waits, %d timeouts, avg %.3fs, min %.3fs, max %.3fs, %d checks" % (
+			self.name, self.waits, self.timeouts, self.average, self.fastest, self.slowest, self.checks)
+
+class Readiness(object):
+	""" Waits until conditions hold, checking with an adaptive backoff,
+		and keeps statistics for each condition
+	"""
+
+	def __init__(self, clock=time.time, sleep=time.sleep):
+		self.clock = clock
+		self.sleep = sleep
+		self._lock = threading.Lock()
+		self.stats = {}
+
+	def waitUntil(self, name, predicate, timeout, initialDelay=0.005, maxDelay=0.05, backoff=1.5):
+		""" Block until predicate returns a true value
+			@param name: identifies the condition in statistics and logs
+			@param predicate: function called without arguments
+			@param timeout: the maximum number of seconds to wait
+			@param initialDelay: the pause after the first failed check
+			@param maxDelay: the longest pause between checks
+			@param backoff: how much the pause grows after each check
+			@returns: the predicate's result, or None on timeout
+		"""
+		start = self.clock()
+		deadline = start + timeout
+		delay = initialDelay
+		checks = 0
+		with tracing.tracer.span(name):
+			while True:
+				checks += 1
+				result = predicate()
+				now = self.clock()
+				if result or now >= deadline: break
+				self.sleep(min(delay, deadline - now))
+				delay = min(delay * backoff, maxDelay)
+
+		elapsed = now - start
+		with self._lock:
+			stats = self.stats.get(name)
+			if stats is None:
+				stats = self.stats[name] = PredicateStats(name)
+			stats.record(elapsed, checks, bool(result))
+		if result:
+			log.debug("Magnifier: ready '%s' after %.3fs (%d checks)" % (name, elapsed, checks))
+			return result
+		log.debugWarning("Magnifier: gave up waiting for '%s' after %.3fs" % (name, elapsed))
+		return None
+
+	def summary(self):
+		""" @returns: one line of statistics per condition
+			@rtype: list
+		"""
+		with self._lock:
+			return [repr(stats) for name, stats in sorted(self.stats.items())]
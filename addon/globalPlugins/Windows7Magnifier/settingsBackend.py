@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Reads and writes the magnifier's per-user settings directly, so
+	they can be configured without driving its options dialog.
+	The magnifier reads these when it starts, and writes them back when
+	it exits.
+"""
+
+import threading
+
+from logHandler import log
+
+#: Location of the settings under HKEY_CURRENT_USER
+MAGNIFIER_KEY = r"Software\Microsoft\ScreenMagnifier"
+
+#: Stored values for each mode
+MODE_VALUES = {
+	"Docked": 1,
+	"Fullscreen": 2,
+	"Lens": 3,
+}
+
+#: Stored value names, by addon setting name
+VALUE_NAMES = {
+	"mode": "MagnificationMode",
+	"invertColors": "Invert",
+	"followMouse": "FollowMouse",
+	"followKeyboard": "FollowFocus",
+	"followTextInsertion": "FollowCaret",
+	"lensSizeHorizontal": "LensWidth",
+	"lensSizeVertical": "LensHeight",
+}
+
+#: Stored value names of the zoom level and each zoom step, in percent
+MAGNIFICATION = "Magnification"
+ZOOM_INCREMENT = "ZoomIncrement"
+
+class RegistrySettingsStore(object):
+	""" The magnifier's settings key in the registry
+	"""
+
+	def __init__(self, keyPath=MAGNIFIER_KEY):
+		self.keyPath = keyPath
+
+	def read(self, name):
+		""" @returns: the DWORD value, or None if not set
+		"""
+		import _winreg
+		try:
+			with _winreg.OpenKey(_winreg.HKEY_CURRENT_USER, self.keyPath) as key:
+				return int(_winreg.QueryValueEx(key, name)[0])
+		except WindowsError:
+			return None
+
+	def write(self, values):
+		""" @param values: DWORD values by name
+		"""
+		import _winreg
+		with _winreg.CreateKey(_winreg.HKEY_CURRENT_USER, self.keyPath) as key:
+			for name, value in values.items():
+				_winreg.SetValueEx(key, name, 0, _winreg.REG_DWORD, value)
+
+class MemorySettingsStore(object):
+	""" An in-memory stand-in for L{RegistrySettingsStore}
+	"""
+
+	def __init__(self, values=None):
+		self._lock = threading.Lock()
+		self.values = dict(values or {})
+		self.reads = 0
+		self.writes = 0
+
+	def read(self, name):
+		with self._lock:
+			self.reads += 1
+			return self.values.get(name)
+
+	def write(self, values):
+		with self._lock:
+			self.writes += 1
+			self.values.update(values)
+
+class SettingsBackend(object):
+	""" Translates between the addon's settings and the magnifier's
+		stored values
+	"""
+
+	def __init__(self, store):
+		""" @param store: A L{RegistrySettingsStore} or L{MemorySettingsStore}
+		"""
+		self.store = store
+
+	def write(self, **settings):
+		""" Store settings for the magnifier to pick up when it starts.
+			None values are left unchanged.
+		"""
+		values = {}
+		for name, value in settings.items():
+			if value is None: continue
+			if name == "mode":
+				value = MODE_VALUES[value]
+			values[VALUE_NAMES[name]] = int(value)
+		if not values: return
+		log.debug("Magnifier: storing settings %r" % values)
+		self.store.write(values)
+
+	def readZoom(self):
+		""" @returns: the stored zoom level and zoom step, in percent
+			(None if not stored)
+		"""
+		return self.store.read(MAGNIFICATION), self.store.read(ZOOM_INCREMENT)
+
+	def writeZoom(self, level):
+		""" Store the zoom level for the magnifier to start at
+			@param level: in percent
+		"""
+		self.store.write({MAGNIFICATION: int(level)})
+
+	def read(self):
+		""" @returns: the stored settings, omitting any not stored
+			@rtype: dict
+		"""
+		settings = {}
+		for name, valueName in VALUE_NAMES.items():
+			value = self.store.read(valueName)
+			if value is None: continue
+			if name == "mode":
+				modes = [mode for mode, modeValue in MODE_VALUES.items() if modeValue == value]
+				if not modes: continue
+				value = modes[0]
+			elif not name.startswith("lensSize"):
+				value = bool(value)
+			settings[name] = value
+		return settings
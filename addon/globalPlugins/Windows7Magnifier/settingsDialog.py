@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" The addon's settings dialog. Only imported when the dialog is first
+	opened; the dialog itself is created once, then hidden rather than
+	destroyed, and refreshed from the options each time it is reopened.
+"""
+
+import time
+
+import wx
+import gui
+import ui
+import addonHandler
+addonHandler.initTranslation()
+
+from logHandler import log
+from modeMachine import TransitionStats
+import Windows7MagnifierConfig
+
+class MagnifierSettingsDialog(gui.SettingsDialog):
+	""" A custom settings dialog, designed to function like other NVDA
+		settings dialogs while being a friendlier replacement for the
+		Windows 7 magnifier options dialog
+	"""
+	title = _("NVDA Magnifier Addon Options")
+
+	# The dialog, once created. Use L{popup} to show it.
+	_instance = None
+
+	# How the dialog is being opened ("create" or "reuse") and when,
+	# until its first control has the focus
+	_opening = None
+
+	#: Seconds from the menu being chosen until the first control had the
+	#: focus, by how the dialog was opened
+	openLatency = {"create": TransitionStats(), "reuse": TransitionStats()}
+
+	@classmethod
+	def popup(cls):
+		""" Show the dialog, creating it the first time. Either way it's
+			opened through NVDA's own settings dialog popup, which allows
+			one settings dialog at a time.
+		"""
+		dialog = cls._instance
+		if dialog is not None and dialog.IsShown():
+			dialog.Raise()
+			dialog.modeSelector.SetFocus()
+			return
+		cls._opening = ("create" if dialog is None else "reuse", time.time())
+		gui.mainFrame._popupSettingsDialog(cls if dialog is None else cls._reopen)
+
+	@classmethod
+	def _reopen(cls, parent):
+		""" Used in place of the constructor by L{popup} once the dialog
+			exists: claim NVDA's settings dialog slot, as creating a
+			dialog would, and show the options as they are now
+			@param parent: the parent window (unused; it's unchanged)
+			@returns: the dialog, for the caller to show
+			@raise gui.SettingsDialog.MultiInstanceError: if another NVDA
+				settings dialog is open
+		"""
+		if gui.SettingsDialog._hasInstance:
+			raise gui.SettingsDialog.MultiInstanceError("Only one instance of SettingsDialog can exist at a time")
+		dialog = cls._instance
+		gui.SettingsDialog._hasInstance = True
+		try:
+			dialog.refresh()
+		except:
+			# Otherwise no NVDA settings dialog could be opened again
+			gui.SettingsDialog._hasInstance = False
+			raise
+		# Once it has been shown
+		wx.CallAfter(dialog.modeSelector.SetFocus)
+		return dialog
+
+	@classmethod
+	def discard(cls):
+		""" Destroy the dialog (e.g. when the addon is terminated)
+		"""
+		dialog, cls._instance = cls._instance, None
+		if dialog:
+			shown = dialog.IsShown()
+			try:
+				dialog.Destroy()
+			finally:
+				if shown: gui.SettingsDialog._hasInstance = False
+
+	def __init__(self, parent):
+		super(MagnifierSettingsDialog, self).__init__(parent)
+		MagnifierSettingsDialog._instance = self
+
+	def makeSettings(self, settingsSizer):
+		""" Create controls and add them to settingsSizer. Their values
+			are set by L{refresh}.
+			@param settingsSizer: the container to house all controls
+		"""
+		# modes dropdown and label
+		self.modes = ["Fullscreen", "Docked", "Lens"]
+		self.modeDescriptions = [_("Fullscreen"), _("Docked"), _("Lens")]
+		self.modeSelector = wx.Choice(self, wx.ID_ANY, name=_("&Mode"), choices=self.modeDescriptions)
+		modeSizer = wx.BoxSizer(wx.HORIZONTAL)
+		modeSizer.Add(wx.StaticText(self, -1, label=_("Mode") + ":"), border=5, flag=wx.RIGHT|wx.ALIGN_CENTER)
+		modeSizer.Add(self.modeSelector)
+		
+		settingsSizer.Add(modeSizer, border=10, flag=wx.BOTTOM)
+		
+		# Make a list of checkboxes for iterative creation
+		boxArgs = [
+			None,
+			("startWithNVDA", _("&Start the magnifier when NVDA starts")),
+			("closeWithNVDA", _("&Close the magnifier when NVDA is terminated")),
+			("restartMagnifier", _("&Restart the magnifier if it crashes")),
+			("hideMagnifierControls", _("&Hide the magnifier control window")),
+			("muteNVDA", _("Mute NVDA when the magnifier control window has focus (requires reload)")),
+			None,
+			("invertColors", _("&Invert colors")),
+			("followMouse", _("Follow the mouse &pointer")),
+			("followKeyboard", _("Follow the &keyboard focus")),
+			("followTextInsertion", _("Follow the &text insertion point"))
+		]
+		
+		# The options which only apply in some modes are on panels of
+		# their own, sharing one place in the dialog: the tracking
+		# options are hidden during Lens mode, the lens size otherwise
+		self.trackingPanel = wx.Panel(self)
+		trackingSizer = wx.BoxSizer(wx.VERTICAL)
+		
+		# keep track of the checkboxes so they can be easily referenced
+		self.checkBoxes = {}
+		for boxArg in boxArgs:
+			if boxArg == None:
+				settingsSizer.Add(wx.StaticLine(self), 0, wx.ALL|wx.EXPAND, 5)				
+				continue
+			name = boxArg[0]
+			if name.startswith("follow"):
+				box = wx.CheckBox(self.trackingPanel, wx.ID_ANY, label=boxArg[1])
+				trackingSizer.Add(box, border=10, flag=wx.BOTTOM)
+			else:
+				box = wx.CheckBox(self, wx.ID_ANY, label=boxArg[1])
+				settingsSizer.Add(box, border=10, flag=wx.BOTTOM)
+			self.checkBoxes[name] = box
+		self.trackingPanel.SetSizer(trackingSizer)
+
+		# lens size (horizontal/vertical)
+		self.lensPanel = wx.Panel(self)
+		lensSizeSizer = wx.GridSizer(rows=2, cols=2)
+		self.lensControls = []
+		for dimension in [_("Lens &width"), _("Lens h&eight")]:
+			control = wx.SpinCtrl(self.lensPanel, wx.ID_ANY, min=10, max=100, name=dimension)
+			lensSizeSizer.Add(wx.StaticText(self.lensPanel, -1, label=dimension))
+			lensSizeSizer.Add(control)
+			self.lensControls.append(control)
+		self.lensPanel.SetSizer(lensSizeSizer)
+
+		# Both panels take the size of the larger, so switching between
+		# them never changes the size of the dialog
+		trackingSize = self.trackingPanel.GetBestSize()
+		lensSize = self.lensPanel.GetBestSize()
+		size = wx.Size(max(trackingSize.width, lensSize.width), max(trackingSize.height, lensSize.height))
+		self.modePanelSizer = wx.BoxSizer(wx.VERTICAL)
+		for panel in (self.trackingPanel, self.lensPanel):
+			panel.SetMinSize(size)
+			self.modePanelSizer.Add(panel)
+		settingsSizer.Add(self.modePanelSizer, border=10, flag=wx.BOTTOM)
+		
+		self.refresh()
+			
+	def postInit(self):
+		""" Called after dialog is created. Sets the focus to the top control
+		"""
+		self.modeSelector.Bind(wx.EVT_CHOICE, self.modeChanged)
+		self.modeSelector.Bind(wx.EVT_SET_FOCUS, self.onModeSelectorFocus)
+		self.modeSelector.SetFocus()
+
+	def refresh(self):
+		""" Show the options as they are now, discarding any edits made
+			before the dialog was last closed
+		"""
+		# Changes made to the file outside the addon are merged into the
+		# snapshot in the background (e.g. when the editor loses the
+		# foreground), so it needn't wait for the file here
+		settings = Windows7MagnifierConfig.getSettings().snapshot()
+		
+		self.modeSelector.SetSelection(self.modes.index(settings["mode"]))
+		for name, box in self.checkBoxes.items():
+			box.SetValue(settings[name])
+		self.lensControls[0].SetValue(settings["lensSizeHorizontal"])
+		self.lensControls[1].SetValue(settings["lensSizeVertical"])
+		self.modeChanged(None)
+
+	def onModeSelectorFocus(self, evt):
+		""" Measures how long the dialog took to be ready for the user
+			@param evt: the event which caused this action
+		"""
+		opening, MagnifierSettingsDialog._opening = MagnifierSettingsDialog._opening, None
+		if opening:
+			path, start = opening
+			latency = time.time() - start
+			self.openLatency[path].add(latency)
+			log.debug("Magnifier: settings dialog focused %.3fs after being opened (%s)" % (latency, path))
+		evt.Skip()
+		
+	def onOk(self, evt):
+		""" Event handler for OK button being pressed
+			@param evt: the event which caused this action
+		"""
+		# make sure user has selected at least one tracking option
+		trackingSelected = False
+		for trackingOption in ["followMouse", "followKeyboard", "followTextInsertion"]:
+			if self.checkBoxes[trackingOption].IsChecked():
+				trackingSelected = True
+				break
+		if self.getMode() != "Lens" and not trackingSelected:
+			ui.message(_("You must select at least one 'Follow' option"))
+		else:
+			values = {}
+			for name,box in self.checkBoxes.items():
+				values[name] = box.IsChecked()
+			
+			values["mode"] = self.getMode()
+			values["lensSizeHorizontal"] = self.lensControls[0].GetValue()
+			values["lensSizeVertical"] = self.lensControls[1].GetValue()
+
+			# the configuration file is saved in the background
+			Windows7MagnifierConfig.getSettings().update(**values)
+			
+			# apply the settings (imported here, as the plugin package is
+			# what imports this module)
+			from . import GlobalPlugin
+			GlobalPlugin.applyConfig()
+
+			self.close()
+
+	def onCancel(self, evt):
+		""" Event handler for Cancel button being pressed
+			@param evt: the event which caused this action
+		"""
+		self.close()
+
+	def close(self):
+		""" Hide the dialog, to be shown again by L{popup}
+		"""
+		try:
+			self.Hide()
+		finally:
+			gui.SettingsDialog._hasInstance = False
+			
+	def getMode(self):
+		""" Convenience method to obtain currently selected mode
+		"""
+		return self.modes[self.modeSelector.GetCurrentSelection()]
+			
+	def modeChanged(self, evt):
+		""" When the mode is changed, show appropriate controls, hide
+				inappropriate controls
+			@param evt: the event which caused this action
+		"""
+		lens = self.getMode() == "Lens"
+		if self.lensPanel.IsShown() == lens and self.trackingPanel.IsShown() == (not lens):
+			return
+		self.trackingPanel.Show(not lens)
+		self.lensPanel.Show(lens)
+		# The panels are the same size, so nothing else moves
+		self.modePanelSizer.Layout()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Restarts the magnifier when it crashes (exits abnormally without
+	the addon asking it to), backing off when it keeps crashing.
+"""
+
+import threading
+import time
+
+from logHandler import log
+from modeMachine import TransitionStats
+
+class Supervisor(object):
+	""" Told of every magnifier exit (the process tracker waits on the
+		process handle, so nothing polls). Abnormal exits the addon didn't
+		ask for are followed by a restart, after a delay that doubles with
+		each exit that follows a restart closely, up to a limit. Exits
+		with code 0 are the magnifier being closed (e.g. by the user), so
+		it's left closed.
+	"""
+
+	def __init__(self, restart, enabled=None, baseDelay=1.0, maxDelay=30.0, maxRestarts=5, stableTime=30.0, expectTime=10.0, clock=time.time):
+		""" @param restart: called as restart(state) on the supervisor's
+				thread to restart the magnifier; state is what was given
+				to L{exited}. It should call L{recovered} once done.
+			@param enabled: optional function; restarts are only made
+				while it returns True
+			@param baseDelay: seconds before the second restart in a row
+				(the first is immediate); doubled for each one after
+			@param maxDelay: the longest delay between restarts
+			@param maxRestarts: how many restarts in a row before giving up
+			@param stableTime: seconds the magnifier must run after a
+				restart before its next exit starts a new count
+			@param expectTime: how long (seconds) L{expectExit} lasts
+		"""
+		self.restart = restart
+		self.enabled = enabled
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
+		self.maxRestarts = maxRestarts
+		self.stableTime = stableTime
+		self.expectTime = expectTime
+		self.clock = clock
+		self.thread = None
+		self._cond = threading.Condition()
+		self._running = False
+		self._stopped = False
+		self._expectedUntil = None
+		self._deadline = None
+		self._state = None
+		self._exitTime = None
+		self._lastRecovery = None
+		self._consecutive = 0
+		# Statistics
+		self.exits = 0
+		self.normalExits = 0
+		self.unexpectedExits = 0
+		self.restarts = 0
+		self.recoveries = 0
+		self.failures = 0
+		self.gaveUp = 0
+		#: Seconds from an unexpected exit until the magnifier was back
+		self.recoveryTimes = TransitionStats()
+
+	def expectExit(self):
+		""" The addon is about to close the magnifier, so its next exit
+			isn't to be followed by a restart
+		"""
+		with self._cond:
+			self._expectedUntil = self.clock() + self.expectTime
+
+	def exited(self, state, exitCode=None):
+		""" The magnifier has exited. Called on the process tracker's
+			thread.
+			@param state: the magnifier's last known state, handed to
+				the restart function
+			@param exitCode: the process's exit code. 0 means it was
+				closed normally; None (unknown) is taken as abnormal.
+		"""
+		now = self.clock()
+		with self._cond:
+			self.exits += 1
+			if self._stopped: return
+			if self._expectedUntil is not None and now < self._expectedUntil:
+				self._expectedUntil = None
+				return
+			self._expectedUntil = None
+			if exitCode == 0:
+				self.normalExits += 1
+				log.info("Magnifier: closed; not restarting it")
+				return
+			self.unexpectedExits += 1
+			if self.enabled is not None and not self.enabled():
+				log.info("Magnifier: exited unexpectedly; not restarting it")
+				return
+			if self._lastRecovery is None or now - self._lastRecovery >= self.stableTime:
+				# It ran long enough; this isn't part of a crash loop
+				self._consecutive = 0
+			if self._consecutive >= self.maxRestarts:
+				self.gaveUp += 1
+				log.warning("Magnifier: exited %d times in a row after being restarted; giving up" % self._consecutive)
+				return
+			delay = 0 if self._consecutive == 0 else min(self.baseDelay * 2 ** (self._consecutive - 1), self.maxDelay)
+			self._consecutive += 1
+			self._state = state
+			if self._exitTime is None:
+				self._exitTime = now
+			self._deadline = now + delay
+			log.info("Magnifier: exited unexpectedly; restarting in %.1fs" % delay)
+			if not self._running:
+				self._running = True
+				self.thread = threading.Thread(target=self._run, name="Windows7Magnifier.Supervisor")
+				self.thread.daemon = True
+				self.thread.start()
+			self._cond.notify()
+
+	def recovered(self, succeeded):
+		""" The restart asked for has completed
+			@param succeeded: False if the magnifier couldn't be restarted
+		"""
+		now = self.clock()
+		with self._cond:
+			exitTime, self._exitTime = self._exitTime, None
+			if not succeeded:
+				self.failures += 1
+				return
+			self.recoveries += 1
+			self._lastRecovery = now
+			if exitTime is not None:
+				self.recoveryTimes.add(now - exitTime)
+		log.info("Magnifier: recovered in %.3fs" % (self.recoveryTimes.last or 0))
+
+	@property
+	def pending(self):
+		""" True if a restart is waiting for its delay
+		"""
+		with self._cond:
+			return self._deadline is not None
+
+	def stop(self):
+		with self._cond:
+			self._stopped = True
+			self._running = False
+			self._deadline = None
+			self._cond.notify()
+		if self.thread and self.thread is not threading.currentThread():
+			self.thread.join(5)
+		self.thread = None
+
+	def summary(self):
+		return "%d exits (%d closed, %d unexpected), %d restarts, %d recovered (mean %.3fs, max %.3fs), %d failed, gave up %d times" % (
+			self.exits, self.normalExits, self.unexpectedExits, self.restarts, self.recoveries, self.recoveryTimes.mean or 0, self.recoveryTimes.max, self.failures, self.gaveUp)
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while self._running and (self._deadline is None or self.clock() < self._deadline):
+					self._cond.wait(None if self._deadline is None else self._deadline - self.clock())
+				if not self._running: return
+				self._deadline = None
+				state, self._state = self._state, None
+				self.restarts += 1
+			try:
+				self.restart(state)
+			except:
+				log.error("Magnifier: could not restart", exc_info=True)
+				self.recovered(False)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Lightweight latency tracing. Phases of an operation (launch, mode
+	switch, settings apply...) are recorded as spans, and the most
+	recent operations are kept in a bounded ring buffer.
+"""
+
+import collections
+import functools
+import json
+import threading
+import time
+
+class Operation(object):
+	""" A top level span and the phases recorded within it
+	"""
+
+	def __init__(self, name, start):
+		self.name = name
+		self.start = start
+		self.duration = None
+		self.error = None
+		# (name, offset from start, duration, depth) of each phase
+		self.phases = []
+
+	def toDict(self):
+		return {
+			"operation": self.name,
+			"start": self.start,
+			"duration": self.duration,
+			"error": self.error,
+			"phases": [
+				{"name": name, "offset": offset, "duration": duration, "depth": depth}
+				for name, offset, duration, depth in self.phases
+			],
+		}
+
+	def describe(self):
+		""" @returns: a short, speakable breakdown of the operation
+		"""
+		parts = ["%s %.2f seconds" % (self.name, self.duration or 0)]
+		for name, offset, duration, depth in self.phases:
+			if depth == 1:
+				parts.append("%s %.2f" % (name, duration))
+		return ", ".join(parts)
+
+class _NullSpan(object):
+	""" Returned when tracing is disabled, so it costs next to nothing
+	"""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span(object):
+
+	def __init__(self, tracer, name):
+		self.tracer = tracer
+		self.name = name
+
+	def __enter__(self):
+		self.tracer._enter(self.name)
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.tracer._exit(excValue)
+		return False
+
+class Tracer(object):
+	""" Records spans per thread. A span started while no other span is
+		active on its thread begins a new operation.
+	"""
+
+	def __init__(self, capacity=50, enabled=False, clock=time.time):
+		""" @param capacity: how many operations to keep
+			@param enabled: whether spans are recorded at all
+		"""
+		self.enabled = enabled
+		self.clock = clock
+		self._lock = threading.Lock()
+		self._operations = collections.deque(maxlen=capacity)
+		self._local = threading.local()
+		# How many operations have been recorded, and how many of those
+		# were recorded before the last export
+		self._recorded = 0
+		self._exported = 0
+
+	def span(self, name):
+		""" A context manager timing one phase
+			@param name: the phase's (or operation's) name
+		"""
+		if not self.enabled: return _NULL_SPAN
+		return _Span(self, name)
+
+	def traced(self, name=None):
+		""" Decorator equivalent of L{span}
+			@param name: defaults to the function's name
+		"""
+		def decorator(func):
+			spanName = name or func.__name__
+			@functools.wraps(func)
+			def wrapper(*args, **kwargs):
+				if not self.enabled: return func(*args, **kwargs)
+				with _Span(self, spanName):
+					return func(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	@property
+	def operations(self):
+		""" The recorded operations, oldest first
+		"""
+		with self._lock:
+			return list(self._operations)
+
+	def lastOperation(self):
+		with self._lock:
+			return self._operations[-1] if self._operations else None
+
+	def clear(self):
+		with self._lock:
+			self._operations.clear()
+			self._exported = self._recorded
+
+	def export(self, path):
+		""" Append the operations recorded since the last export to a
+			JSON lines file, so each is written once
+			@returns: the number of operations written
+		"""
+		with self._lock:
+			count = min(self._recorded - self._exported, len(self._operations))
+			operations = list(self._operations)[len(self._operations) - count:]
+			recorded = self._recorded
+		with open(path, "a") as f:
+			for operation in operations:
+				f.write(json.dumps(operation.toDict()) + "\n")
+		with self._lock:
+			self._exported = recorded
+		return count
+
+	def _enter(self, name):
+		stack = getattr(self._local, "stack", None)
+		if stack is None:
+			stack = self._local.stack = []
+		now = self.clock()
+		if not stack:
+			self._local.operation = Operation(name, now)
+		stack.append((name, now))
+
+	def _exit(self, error):
+		stack = self._local.stack
+		name, start = stack.pop()
+		now = self.clock()
+		operation = self._local.operation
+		if stack:
+			operation.phases.append((name, start - operation.start, now - start, len(stack)))
+			return
+		operation.duration = now - start
+		operation.phases.sort(key=lambda phase: phase[1])
+		if error is not None:
+			operation.error = repr(error)
+		self._local.operation = None
+		with self._lock:
+			self._operations.append(operation)
+			self._recorded += 1
+
+#: The addon's tracer
+tracer = Tracer()
+traced = tracer.traced
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" The Win32 functions used by this addon, resolved once with their
+	argument and return types declared, behind small typed wrappers.
+
+	Use L{get} to obtain the bindings in use. L{install} swaps in
+	another implementation, such as L{FakeWin32Bindings} off Windows.
+"""
+
+import threading
+
+# Win32 Constants
+SW_RESTORE = 9
+MOUSEEVENTF_LEFTDOWN = 0x02
+MOUSEEVENTF_LEFTUP = 0x04
+TH32CS_SNAPPROCESS = 0x00000002
+INPUT_KEYBOARD = 1
+MAX_PATH = 260
+PROCESS_VM_OPERATION = 0x0008
+PROCESS_VM_READ = 0x0010
+PROCESS_VM_WRITE = 0x0020
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+MEM_COMMIT = 0x1000
+MEM_RELEASE = 0x8000
+PAGE_READWRITE = 0x04
+TB_GETBUTTON = 0x417
+TB_HITTEST = 0x445
+
+#: The name of every wrapper, shared by all implementations
+WRAPPERS = (
+	"findWindow", "showWindow", "keybdEvent", "getDlgItem", "sendMessage",
+	"postMessage", "isWindow", "isWindowVisible", "getForegroundWindow",
+	"setForegroundWindow", "getWindow", "getAncestor", "getClassName",
+	"getWindowText", "getWindowThreadId", "getKeyboardLayout",
+	"vkKeyScanEx", "getCursorPos", "setCursorPos", "mouseEvent",
+	"screenToClient",
+	"createToolhelp32Snapshot", "processEntries", "closeHandle",
+	"openProcess", "getExitCodeProcess", "waitForSingleObject",
+	"waitForMultipleObjects", "createEvent", "setEvent", "resetEvent", "moveFileEx", "enumWindows",
+	"sendInput", "toolbarCommandAt",
+)
+
+class Win32Bindings(object):
+	""" The real Win32 API, through ctypes
+	"""
+
+	def __init__(self):
+		import ctypes
+		from ctypes import wintypes
+		self._ctypes = ctypes
+		user32 = ctypes.WinDLL("user32")
+		kernel32 = ctypes.WinDLL("kernel32")
+		ULONG_PTR = ctypes.c_size_t
+		LPARAM = ctypes.c_ssize_t
+		LRESULT = ctypes.c_ssize_t
+		HWND = wintypes.HWND
+		HANDLE = wintypes.HANDLE
+
+		class PROCESSENTRY32(ctypes.Structure):
+			_fields_ = [
+				("dwSize", wintypes.DWORD),
+				("cntUsage", wintypes.DWORD),
+				("th32ProcessID", wintypes.DWORD),
+				("th32DefaultHeapID", ULONG_PTR),
+				("th32ModuleID", wintypes.DWORD),
+				("cntThreads", wintypes.DWORD),
+				("th32ParentProcessID", wintypes.DWORD),
+				("pcPriClassBase", wintypes.LONG),
+				("dwFlags", wintypes.DWORD),
+				("szExeFile", ctypes.c_char * MAX_PATH)
+			]
+		self._PROCESSENTRY32 = PROCESSENTRY32
+
+		class KEYBDINPUT(ctypes.Structure):
+			_fields_ = [
+				("wVk", wintypes.WORD),
+				("wScan", wintypes.WORD),
+				("dwFlags", wintypes.DWORD),
+				("time", wintypes.DWORD),
+				("dwExtraInfo", ULONG_PTR)
+			]
+		class MOUSEINPUT(ctypes.Structure):
+			_fields_ = [
+				("dx", wintypes.LONG),
+				("dy", wintypes.LONG),
+				("mouseData", wintypes.DWORD),
+				("dwFlags", wintypes.DWORD),
+				("time", wintypes.DWORD),
+				("dwExtraInfo", ULONG_PTR)
+			]
+		# The union must include the (largest) mouse member, or the
+		# structure's size is wrong and SendInput rejects it
+		class INPUTUNION(ctypes.Union):
+			_fields_ = [("mi", MOUSEINPUT), ("ki", KEYBDINPUT)]
+		class INPUT(ctypes.Structure):
+			_fields_ = [("type", wintypes.DWORD), ("u", INPUTUNION)]
+		self._INPUT = INPUT
+
+		def bind(dll, name, restype, *argtypes):
+			func = getattr(dll, name)
+			func.restype = restype
+			func.argtypes = argtypes
+			return func
+
+		self._FindWindow = bind(user32, "FindWindowW", HWND, wintypes.LPCWSTR, wintypes.LPCWSTR)
+		self._ShowWindow = bind(user32, "ShowWindow", wintypes.BOOL, HWND, ctypes.c_int)
+		self._SendInput = bind(user32, "SendInput", wintypes.UINT, wintypes.UINT, ctypes.POINTER(INPUT), ctypes.c_int)
+		self._keybd_event = bind(user32, "keybd_event", None, wintypes.BYTE, wintypes.BYTE, wintypes.DWORD, ULONG_PTR)
+		self._GetDlgItem = bind(user32, "GetDlgItem", HWND, HWND, ctypes.c_int)
+		self._SendMessage = bind(user32, "SendMessageW", LRESULT, HWND, wintypes.UINT, wintypes.WPARAM, LPARAM)
+		self._PostMessage = bind(user32, "PostMessageW", wintypes.BOOL, HWND, wintypes.UINT, wintypes.WPARAM, LPARAM)
+		self._IsWindow = bind(user32, "IsWindow", wintypes.BOOL, HWND)
+		self._IsWindowVisible = bind(user32, "IsWindowVisible", wintypes.BOOL, HWND)
+		self._GetForegroundWindow = bind(user32, "GetForegroundWindow", HWND)
+		self._SetForegroundWindow = bind(user32, "SetForegroundWindow", wintypes.BOOL, HWND)
+		self._GetWindow = bind(user32, "GetWindow", HWND, HWND, wintypes.UINT)
+		self._GetAncestor = bind(user32, "GetAncestor", HWND, HWND, wintypes.UINT)
+		self._GetClassName = bind(user32, "GetClassNameW", ctypes.c_int, HWND, wintypes.LPWSTR, ctypes.c_int)
+		# Unlike GetWindowText, doesn't send messages, so can't hang
+		self._InternalGetWindowText = bind(user32, "InternalGetWindowText", ctypes.c_int, HWND, wintypes.LPWSTR, ctypes.c_int)
+		self._GetKeyboardLayout = bind(user32, "GetKeyboardLayout", wintypes.HKL, wintypes.DWORD)
+		self._VkKeyScanEx = bind(user32, "VkKeyScanExW", ctypes.c_short, wintypes.WCHAR, wintypes.HKL)
+		self._GetCursorPos = bind(user32, "GetCursorPos", wintypes.BOOL, ctypes.POINTER(wintypes.POINT))
+		self._SetCursorPos = bind(user32, "SetCursorPos", wintypes.BOOL, ctypes.c_int, ctypes.c_int)
+		self._mouse_event = bind(user32, "mouse_event", None, wintypes.DWORD, wintypes.DWORD, wintypes.DWORD, wintypes.DWORD, ULONG_PTR)
+		self._WNDENUMPROC = ctypes.WINFUNCTYPE(wintypes.BOOL, HWND, LPARAM)
+		self._EnumWindows = bind(user32, "EnumWindows", wintypes.BOOL, self._WNDENUMPROC, LPARAM)
+		self._ScreenToClient = bind(user32, "ScreenToClient", wintypes.BOOL, HWND, ctypes.POINTER(wintypes.POINT))
+		self._CreateToolhelp32Snapshot = bind(kernel32, "CreateToolhelp32Snapshot", HANDLE, wintypes.DWORD, wintypes.DWORD)
+		self._Process32First = bind(kernel32, "Process32First", wintypes.BOOL, HANDLE, ctypes.POINTER(PROCESSENTRY32))
+		self._Process32Next = bind(kernel32, "Process32Next", wintypes.BOOL, HANDLE, ctypes.POINTER(PROCESSENTRY32))
+		self._CloseHandle = bind(kernel32, "CloseHandle", wintypes.BOOL, HANDLE)
+		self._OpenProcess = bind(kernel32, "OpenProcess", HANDLE, wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+		self._GetExitCodeProcess = bind(kernel32, "GetExitCodeProcess", wintypes.BOOL, HANDLE, ctypes.POINTER(wintypes.DWORD))
+		self._WaitForSingleObject = bind(kernel32, "WaitForSingleObject", wintypes.DWORD, HANDLE, wintypes.DWORD)
+		self._WaitForMultipleObjects = bind(kernel32, "WaitForMultipleObjects", wintypes.DWORD, wintypes.DWORD, ctypes.POINTER(HANDLE), wintypes.BOOL, wintypes.DWORD)
+		self._CreateEvent = bind(kernel32, "CreateEventW", HANDLE, ctypes.c_void_p, wintypes.BOOL, wintypes.BOOL, wintypes.LPCWSTR)
+		self._SetEvent = bind(kernel32, "SetEvent", wintypes.BOOL, HANDLE)
+		self._ResetEvent = bind(kernel32, "ResetEvent", wintypes.BOOL, HANDLE)
+		self._MoveFileEx = bind(kernel32, "MoveFileExW", wintypes.BOOL, wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.DWORD)
+		self._GetWindowThreadProcessId = bind(user32, "GetWindowThreadProcessId", wintypes.DWORD, HWND, ctypes.POINTER(wintypes.DWORD))
+		self._VirtualAllocEx = bind(kernel32, "VirtualAllocEx", ctypes.c_void_p, HANDLE, ctypes.c_void_p, ctypes.c_size_t, wintypes.DWORD, wintypes.DWORD)
+		self._VirtualFreeEx = bind(kernel32, "VirtualFreeEx", wintypes.BOOL, HANDLE, ctypes.c_void_p, ctypes.c_size_t, wintypes.DWORD)
+		self._ReadProcessMemory = bind(kernel32, "ReadProcessMemory", wintypes.BOOL, HANDLE, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+		self._WriteProcessMemory = bind(kernel32, "WriteProcessMemory", wintypes.BOOL, HANDLE, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+		self._GetCurrentProcess = bind(kernel32, "GetCurrentProcess", HANDLE)
+		# Missing before Windows XP SP2, where every process is 32-bit
+		self._IsWow64Process = bind(kernel32, "IsWow64Process", wintypes.BOOL, HANDLE, ctypes.POINTER(wintypes.BOOL)) if hasattr(kernel32, "IsWow64Process") else None
+
+		self._HANDLE_ARRAY = lambda handles: (HANDLE * len(handles))(*handles)
+		self._POINT = wintypes.POINT
+		self._DWORD = wintypes.DWORD
+		self._textBuffers = threading.local()
+		self.INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+	# Windows
+
+	def findWindow(self, windowClass=None, windowName=None):
+		""" @returns: the first matching top level window, or 0
+		"""
+		return self._FindWindow(windowClass, windowName) or 0
+
+	def showWindow(self, hwnd, cmd):
+		return bool(self._ShowWindow(hwnd, cmd))
+
+	def getDlgItem(self, hwnd, controlID):
+		return self._GetDlgItem(hwnd, controlID) or 0
+
+	def sendMessage(self, hwnd, msg, wParam, lParam):
+		return self._SendMessage(hwnd, msg, wParam, lParam)
+
+	def postMessage(self, hwnd, msg, wParam, lParam):
+		return bool(self._PostMessage(hwnd, msg, wParam, lParam))
+
+	def isWindow(self, hwnd):
+		return bool(hwnd) and bool(self._IsWindow(hwnd))
+
+	def isWindowVisible(self, hwnd):
+		return bool(hwnd) and bool(self._IsWindowVisible(hwnd))
+
+	def getForegroundWindow(self):
+		return self._GetForegroundWindow() or 0
+
+	def setForegroundWindow(self, hwnd):
+		return bool(self._SetForegroundWindow(hwnd))
+
+	def getWindow(self, hwnd, relation):
+		return self._GetWindow(hwnd, relation) or 0
+
+	def enumWindows(self):
+		""" @returns: the handles of all top level windows, in z-order
+		"""
+		hwnds = []
+		def collect(hwnd, lParam):
+			hwnds.append(hwnd)
+			return True
+		self._EnumWindows(self._WNDENUMPROC(collect), 0)
+		return hwnds
+
+	def toolbarCommandAt(self, toolbar, x, y):
+		""" Find the command of a toolbar button. Toolbar messages take
+			pointers, so this works in the toolbar process's memory.
+			@param x: client X coordinate of the button
+			@param y: client Y coordinate of the button
+			@returns: the button's command ID, or None (also when the
+				toolbar's process isn't of the same bitness as this one)
+		"""
+		ctypes = self._ctypes
+		pid = ctypes.c_ulong()
+		self._GetWindowThreadProcessId(toolbar, ctypes.byref(pid))
+		process = self._OpenProcess(PROCESS_VM_OPERATION | PROCESS_VM_READ | PROCESS_VM_WRITE | PROCESS_QUERY_LIMITED_INFORMATION, False, pid.value)
+		if not process: return None
+		try:
+			# Pointers in the messages (and the memory calls) only work
+			# between processes of the same bitness. A 32-bit NVDA runs the
+			# 64-bit magnifier on 64-bit Windows; it's clicked instead.
+			ours = self._isWow64(self._GetCurrentProcess())
+			if ours is None or ours != self._isWow64(process): return None
+			# Room for a TBBUTTON of either bitness
+			remote = self._VirtualAllocEx(process, None, 64, MEM_COMMIT, PAGE_READWRITE)
+			if not remote: return None
+			try:
+				point = self._POINT(x, y)
+				if not self._WriteProcessMemory(process, remote, ctypes.byref(point), ctypes.sizeof(point), None): return None
+				index = self._SendMessage(toolbar, TB_HITTEST, 0, remote)
+				# Negative for a separator or no button
+				if index < 0: return None
+				if not self._SendMessage(toolbar, TB_GETBUTTON, index, remote): return None
+				# TBBUTTON.idCommand follows the (int) bitmap index
+				command = ctypes.c_int()
+				if not self._ReadProcessMemory(process, remote + 4, ctypes.byref(command), ctypes.sizeof(command), None): return None
+				return command.value
+			finally:
+				self._VirtualFreeEx(process, remote, 0, MEM_RELEASE)
+		finally:
+			self._CloseHandle(process)
+
+	def _isWow64(self, process):
+		""" @returns: True if process is 32-bit on 64-bit Windows, or
+				None if that couldn't be found out
+		"""
+		if self._IsWow64Process is None: return False
+		result = self._ctypes.c_long()
+		if not self._IsWow64Process(process, self._ctypes.byref(result)): return None
+		return bool(result.value)
+
+	def getAncestor(self, hwnd, flags):
+		return self._GetAncestor(hwnd, flags) or 0
+
+	def getClassName(self, hwnd):
+		""" @returns: the window's class name, or None
+		"""
+		buf = self._textBuffer()
+		return buf.value if self._GetClassName(hwnd, buf, 256) else None
+
+	def getWindowText(self, hwnd):
+		""" @returns: the window's title, or None if it has none
+		"""
+		buf = self._textBuffer()
+		return buf.value if self._InternalGetWindowText(hwnd, buf, 256) else None
+
+	def _textBuffer(self):
+		buf = getattr(self._textBuffers, "buf", None)
+		if buf is None:
+			buf = self._textBuffers.buf = self._ctypes.create_unicode_buffer(256)
+		return buf
+
+	# Keyboard and mouse
+
+	def keybdEvent(self, vk, flags):
+		self._keybd_event(vk, vk, flags, 0)
+
+	def sendInput(self, events):
+		""" Inject keyboard events as one batch, which other input can't
+			interleave with
+			@param events: (virtual key, flags) pairs
+			@returns: the number of events injected
+		"""
+		inputs = (self._INPUT * len(events))()
+		for i, (vk, flags) in enumerate(events):
+			inputs[i].type = INPUT_KEYBOARD
+			inputs[i].u.ki.wVk = vk
+			inputs[i].u.ki.dwFlags = flags
+		return self._SendInput(len(events), inputs, self._ctypes.sizeof(self._INPUT))
+
+	def getWindowThreadId(self, hwnd):
+		""" @returns: the id of the thread which created the window, or 0
+		"""
+		return self._GetWindowThreadProcessId(hwnd, None) or 0
+
+	def getKeyboardLayout(self, threadID=0):
+		return self._GetKeyboardLayout(threadID) or 0
+
+	def vkKeyScanEx(self, char, layout):
+		""" @returns: (shift state, virtual key)
+		"""
+		result = self._VkKeyScanEx(char, layout)
+		return ((result >> 8) & 0xFF, result & 0xFF)
+
+	def getCursorPos(self):
+		point = self._POINT()
+		self._GetCursorPos(self._ctypes.byref(point))
+		return (point.x, point.y)
+
+	def setCursorPos(self, x, y):
+		return bool(self._SetCursorPos(x, y))
+
+	def mouseEvent(self, flags, x, y):
+		self._mouse_event(flags, x, y, 0, 0)
+
+	def screenToClient(self, hwnd, x, y):
+		point = self._POINT(x, y)
+		self._ScreenToClient(hwnd, self._ctypes.byref(point))
+		return (point.x, point.y)
+
+	# Processes and synchronization
+
+	def createToolhelp32Snapshot(self):
+		""" @returns: a process list snapshot handle, or None
+		"""
+		handle = self._CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
+		if not handle or handle == self.INVALID_HANDLE_VALUE: return None
+		return handle
+
+	def processEntries(self, snapshot):
+		""" Iterate over a process list snapshot
+			@returns: (pid, image name) pairs
+		"""
+		entry = self._PROCESSENTRY32()
+		entry.dwSize = self._ctypes.sizeof(entry)
+		ok = self._Process32First(snapshot, self._ctypes.byref(entry))
+		while ok:
+			yield entry.th32ProcessID, entry.szExeFile
+			ok = self._Process32Next(snapshot, self._ctypes.byref(entry))
+
+	def closeHandle(self, handle):
+		return bool(self._CloseHandle(handle))
+
+	def openProcess(self, access, pid):
+		return self._OpenProcess(access, False, pid) or None
+
+	def getExitCodeProcess(self, handle):
+		""" @returns: the process's exit code, or None if it can't be read
+		"""
+		code = self._DWORD()
+		if not self._GetExitCodeProcess(handle, self._ctypes.byref(code)): return None
+		return code.value
+
+	def waitForSingleObject(self, handle, timeout):
+		return self._WaitForSingleObject(handle, timeout)
+
+	def waitForMultipleObjects(self, handles, waitAll, timeout):
+		return self._WaitForMultipleObjects(len(handles), self._HANDLE_ARRAY(handles), waitAll, timeout)
+
+	def createEvent(self, manualReset, initialState):
+		return self._CreateEvent(None, manualReset, initialState, None)
+
+	def setEvent(self, handle):
+		return bool(self._SetEvent(handle))
+
+	def resetEvent(self, handle):
+		return bool(self._ResetEvent(handle))
+
+	# Files
+
+	def moveFileEx(self, source, destination, flags):
+		""" @raise WindowsError: if the move failed
+		"""
+		if not self._MoveFileEx(source, destination, flags):
+			raise self._ctypes.WinError()
+
+class FakeWin32Bindings(object):
+	""" A stand-in for L{Win32Bindings} off Windows. Every wrapper
+		counts its calls and returns a harmless default, unless a
+		handler is registered for it in L{handlers}.
+	"""
+
+	DEFAULTS = {
+		"getCursorPos": (0, 0),
+		"screenToClient": (0, 0),
+		"vkKeyScanEx": None,
+		"processEntries": (),
+		"enumWindows": (),
+		"openProcess": None,
+		"getExitCodeProcess": None,
+		"createToolhelp32Snapshot": None,
+		"getClassName": None,
+		"getWindowText": None,
+		"toolbarCommandAt": None,
+	}
+
+	def __init__(self, **handlers):
+		""" @param handlers: functions by wrapper name, called with the
+				wrapper's arguments
+		"""
+		self._lock = threading.Lock()
+		self.handlers = dict(handlers)
+		self.calls = dict.fromkeys(WRAPPERS, 0)
+		self.callCount = 0
+		self.INVALID_HANDLE_VALUE = -1
+
+	def __getattr__(self, name):
+		if name not in WRAPPERS:
+			raise AttributeError(name)
+		def wrapper(*args):
+			with self._lock:
+				self.calls[name] += 1
+				self.callCount += 1
+			handler = self.handlers.get(name)
+			if handler is not None:
+				return handler(*args)
+			if name == "vkKeyScanEx":
+				return (0, ord(args[0].upper()))
+			return self.DEFAULTS.get(name, 0)
+		return wrapper
+
+_bindings = None
+_lock = threading.Lock()
+
+def get():
+	""" @returns: the bindings in use, creating the real ones on first use
+	"""
+	global _bindings
+	if _bindings is None:
+		with _lock:
+			if _bindings is None:
+				_bindings = Win32Bindings()
+	return _bindings
+
+def install(bindings):
+	""" Replace the bindings in use, e.g. with L{FakeWin32Bindings}
+		@returns: the bindings previously in use (possibly None)
+	"""
+	global _bindings
+	with _lock:
+		previous, _bindings = _bindings, bindings
+	return previous
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" A persistent service which hides the magnifier's control window
+	whenever it is asked to, and keeps hiding it for a short while
+	afterwards, as the magnifier likes to pop it back up.
+"""
+
+import threading
+import time
+
+from logHandler import log
+import windowWatcher
+
+class WindowHider(object):
+	""" Handles hide requests on a single thread. A request opens a
+		"watch" period during which matching windows are hidden as soon
+		as they are shown; requests made during an open watch period
+		just extend it.
+	"""
+
+	def __init__(self, watcher, hide, windowClass=u"MagUIClass", watchTime=1.2, shouldHide=None, find=None):
+		""" @param watcher: the L{windowWatcher.WindowWatcher} reporting
+				window notifications
+			@param hide: called as hide(hwnd) to hide a window
+			@param windowClass: the class of the windows to hide
+			@param watchTime: how long (seconds) after a request to keep
+				hiding windows that appear
+			@param shouldHide: optional function returning False when
+				windows must currently be left alone
+			@param find: optional function returning the window to hide
+				(or 0) for the final sweep. Defaults to searching for
+				windowClass.
+		"""
+		self.watcher = watcher
+		self.hide = hide
+		self.windowClass = windowClass
+		self.watchTime = watchTime
+		self.shouldHide = shouldHide
+		self.find = find or (lambda: self.watcher.findWindow(self.windowClass, None))
+		self._cond = threading.Condition()
+		self._watchUntil = 0
+		self._sweep = False
+		self._shown = []
+		self._running = False
+		self._thread = None
+		# Metrics
+		self.requestsReceived = 0
+		self.requestsDeduplicated = 0
+		self.windowsHidden = 0
+		self.passes = 0
+
+	def start(self):
+		with self._cond:
+			if self._running: return
+			self._running = True
+		self.watcher.addListener(self._onWindowEvent)
+		self._thread = threading.Thread(target=self._run, name="Windows7Magnifier.WindowHider")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self.watcher.removeListener(self._onWindowEvent)
+		with self._cond:
+			self._running = False
+			self._cond.notifyAll()
+		if self._thread:
+			self._thread.join(5)
+			self._thread = None
+
+	def request(self):
+		""" Ask for the windows to be hidden. Returns immediately.
+			@returns: False if the request was merged into one already
+				being handled
+		"""
+		with self._cond:
+			self.requestsReceived += 1
+			now = time.time()
+			duplicate = now < self._watchUntil
+			if duplicate:
+				self.requestsDeduplicated += 1
+			else:
+				self.passes += 1
+				self._sweep = True
+			self._watchUntil = now + self.watchTime
+			self._cond.notifyAll()
+			return not duplicate
+
+	def summary(self):
+		return "%d requests (%d merged), %d passes, %d windows hidden" % (self.requestsReceived, self.requestsDeduplicated, self.passes, self.windowsHidden)
+
+	@property
+	def watching(self):
+		with self._cond:
+			return time.time() < self._watchUntil
+
+	def _onWindowEvent(self, event, hwnd, windowClass, windowName):
+		""" Window notification (on the watcher's thread). Only queues
+			the window, the hiding happens on this service's thread.
+		"""
+		if event != windowWatcher.EVENT_OBJECT_SHOW or windowClass != self.windowClass: return
+		with self._cond:
+			if time.time() < self._watchUntil:
+				self._shown.append(hwnd)
+				self._cond.notifyAll()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while self._running and not self._sweep and not self._shown:
+					remaining = self._watchUntil - time.time()
+					if remaining > 0:
+						self._cond.wait(remaining)
+						if time.time() >= self._watchUntil and not self._shown:
+							# Watch period over, one last look in case a
+							# notification was missed
+							self._sweep = True
+					else:
+						self._cond.wait()
+				if not self._running: return
+				sweep, self._sweep = self._sweep, False
+				shown, self._shown = self._shown, []
+			if self.shouldHide and not self.shouldHide(): continue
+			if sweep:
+				hwnd = self.find()
+				if hwnd: shown.append(hwnd)
+			for hwnd in set(shown):
+				try:
+					self.hide(hwnd)
+					self.windowsHidden += 1
+				except:
+					log.error("Magnifier: could not hide window %s" % hwnd, exc_info=True)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Knows the handles of the magnifier's windows. One enumeration of
+	the top level windows finds all of them, and the handles are kept
+	(checked with IsWindow before reuse) and updated from window
+	notifications, so most lookups make no search at all.
+"""
+
+import threading
+import time
+
+import windowWatcher
+
+# Window roles
+MAIN = "main"
+FULLSCREEN = "Fullscreen"
+LENS = "Lens"
+DOCKED = "Docked"
+OPTIONS = "options"
+
+#: The mode each mode window indicates
+MODES = (FULLSCREEN, LENS, DOCKED)
+
+#: The class of each role's window
+CLASSES = {
+	MAIN: u"MagUIClass",
+	FULLSCREEN: u"Screen Magnifier Fullscreen Window",
+	LENS: u"Screen Magnifier Lens Window",
+	DOCKED: u"Screen Magnifier Window",
+	OPTIONS: u"#32770",
+}
+
+class WindowInventory(object):
+	""" Cached handles of the magnifier's windows, by role
+	"""
+
+	def __init__(self, watcher, optionsTitle, absentTime=0.25, clock=time.time):
+		""" @param watcher: the L{windowWatcher.WindowWatcher}; its
+				backend enumerates and validates windows, and its
+				notifications keep the cache current
+			@param optionsTitle: the (localized) title of the options
+				dialog, which has a generic class
+			@param absentTime: how long (seconds) a window found missing
+				is believed missing without searching again. Creation
+				notifications override this.
+		"""
+		self.watcher = watcher
+		self.backend = watcher.backend
+		self.optionsTitle = optionsTitle
+		self.absentTime = absentTime
+		self.clock = clock
+		self._lock = threading.Lock()
+		self._handles = dict.fromkeys(CLASSES, 0)
+		self._refreshed = None
+		# Roles changed by notifications during an enumeration
+		self._changed = set()
+		self._roleByClass = dict((cls, role) for role, cls in CLASSES.items())
+		# Statistics
+		self.hits = 0
+		self.misses = 0
+		self.enumerations = 0
+		self.staleHandles = 0
+		watcher.addListener(self._onWindowEvent)
+
+	def stop(self):
+		self.watcher.removeListener(self._onWindowEvent)
+
+	def get(self, role):
+		""" @param role: e.g. L{MAIN} or L{OPTIONS}
+			@returns: the role's window, or 0 if it doesn't exist
+		"""
+		return self.find(role)[role]
+
+	def find(self, *roles):
+		""" Look up several roles, with at most one enumeration
+			@returns: the window of each role (0 if it doesn't exist)
+			@rtype: dict
+		"""
+		result = {}
+		missing = False
+		with self._lock:
+			fresh = self._refreshed is not None and self.clock() - self._refreshed < self.absentTime
+			for role in roles:
+				hwnd = self._handles[role]
+				if hwnd and self.backend.isWindow(hwnd):
+					self.hits += 1
+					result[role] = hwnd
+					continue
+				if hwnd:
+					# The window went away without us hearing about it
+					self.staleHandles += 1
+					self._handles[role] = 0
+				elif fresh:
+					self.hits += 1
+					result[role] = 0
+					continue
+				self.misses += 1
+				missing = True
+		if missing:
+			handles = self.refresh()
+			for role in roles:
+				result.setdefault(role, handles[role])
+		return result
+
+	def currentMode(self):
+		""" @returns: 'Fullscreen', 'Lens', 'Docked', or None, depending
+			on which mode window exists
+		"""
+		handles = self.find(*MODES)
+		for mode in MODES:
+			if handles[mode]: return mode
+		return None
+
+	def roleOf(self, windowClass, windowName):
+		""" @returns: the role of a window with this class and name, or
+			None if it isn't one of the magnifier's
+		"""
+		if windowName is not None and windowName == self.optionsTitle:
+			return OPTIONS
+		role = self._roleByClass.get(windowClass)
+		if role is None or role == OPTIONS: return None
+		if windowName is not None and role != MAIN: return None
+		return role
+
+	def refresh(self):
+		""" Enumerate the top level windows once, finding every role
+			@returns: the window of each role
+			@rtype: dict
+		"""
+		with self._lock:
+			self._changed.clear()
+		handles = dict.fromkeys(CLASSES, 0)
+		for hwnd, windowClass, windowName in self.backend.enumerateWindows(self._roleByClass):
+			role = self._roleByClass[windowClass]
+			if role == OPTIONS and windowName != self.optionsTitle: continue
+			if not handles[role]: handles[role] = hwnd
+		with self._lock:
+			self.enumerations += 1
+			# A notification received meanwhile is newer than what the
+			# enumeration saw
+			for role in self._changed:
+				handles[role] = self._handles[role]
+			self._handles = handles
+			self._refreshed = self.clock()
+		return dict(handles)
+
+	def invalidate(self):
+		""" Forget every handle, so the next lookup enumerates
+		"""
+		with self._lock:
+			self._handles = dict.fromkeys(CLASSES, 0)
+			self._refreshed = None
+
+	def summary(self):
+		return "%d hits, %d misses, %d enumerations, %d stale handles" % (self.hits, self.misses, self.enumerations, self.staleHandles)
+
+	def _onWindowEvent(self, event, hwnd, windowClass, windowName):
+		if event == windowWatcher.EVENT_OBJECT_DESTROY:
+			with self._lock:
+				for role, known in self._handles.items():
+					if known == hwnd:
+						self._handles[role] = 0
+						self._changed.add(role)
+			return
+		if event not in (windowWatcher.EVENT_OBJECT_CREATE, windowWatcher.EVENT_OBJECT_SHOW): return
+		role = self._roleByClass.get(windowClass)
+		if role is None: return
+		if role == OPTIONS and windowName != self.optionsTitle: return
+		with self._lock:
+			self._handles[role] = hwnd
+			self._changed.add(role)
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Event driven discovery of top level windows.
+
+	Rather than polling FindWindow until a window shows up, a backend
+	reports window create/show/destroy notifications and any thread
+	waiting for a matching window is woken immediately.
+"""
+
+import threading
+import time
+
+from logHandler import log
+import winBindings
+
+# Win32 Constants - WinEvents
+EVENT_OBJECT_CREATE = 0x8000
+EVENT_OBJECT_DESTROY = 0x8001
+EVENT_OBJECT_SHOW = 0x8002
+EVENT_OBJECT_HIDE = 0x8003
+OBJID_WINDOW = 0
+CHILDID_SELF = 0
+WINEVENT_OUTOFCONTEXT = 0x0000
+WINEVENT_SKIPOWNPROCESS = 0x0002
+GA_PARENT = 1
+WM_QUIT = 0x0012
+
+#: The name of the WinEvent hook's thread
+HOOK_THREAD = "Windows7Magnifier.WinEventBackend"
+
+class WindowWaiter(object):
+	""" A single request to be told when a matching window appears.
+		A value of None for the class or name matches anything.
+	"""
+
+	def __init__(self, windowClass, windowName, timeout):
+		self.windowClass = windowClass
+		self.windowName = windowName
+		self.startTime = time.time()
+		self.deadline = self.startTime + timeout
+		self.endTime = None
+		self.hwnd = 0
+		self._event = threading.Event()
+
+	def matches(self, windowClass, windowName):
+		""" Determine if a window satisfies this waiter
+			@param windowClass: the class of the window
+			@param windowName: the title of the window
+		"""
+		if self.windowClass is not None and self.windowClass != windowClass: return False
+		if self.windowName is not None and self.windowName != windowName: return False
+		return True
+
+	def resolve(self, hwnd):
+		""" Wake the waiting thread with the window that was found
+			@param hwnd: A handle to the matching window (0 on timeout)
+		"""
+		if self._event.isSet(): return
+		self.hwnd = hwnd
+		self.endTime = time.time()
+		self._event.set()
+
+	def wait(self, timeout):
+		""" Block until resolved or timeout seconds have passed
+			@returns: True if resolved
+		"""
+		self._event.wait(max(0, timeout))
+		return self._event.isSet()
+
+	@property
+	def done(self):
+		return self._event.isSet()
+
+	@property
+	def elapsed(self):
+		""" How long the wait took (so far, if still waiting), in seconds
+		"""
+		return (self.endTime or time.time()) - self.startTime
+
+class WindowWatcher(object):
+	""" Dispatches window notifications from a backend to any number
+		of concurrent waiters and listeners.
+	"""
+
+	#: Seconds between looking for a waited for window anyway, in case
+	#: its notification was missed
+	RECHECK_INTERVAL = 0.5
+	#: Seconds between looks when the backend gets no notifications
+	POLL_INTERVAL = 0.1
+
+	def __init__(self, backend):
+		""" @param backend: A L{WinEventBackend} or L{FakeWindowBackend}
+		"""
+		self.backend = backend
+		self._lock = threading.Lock()
+		self._waiters = []
+		self._listeners = []
+		# Statistics, so slow waits can be spotted in the log
+		self.waitsCompleted = 0
+		self.waitsTimedOut = 0
+		self.waitsRechecked = 0
+		self.lastWaitTime = None
+		self.backend.start(self._onWindowEvent)
+
+	def stop(self):
+		""" Stop receiving notifications and release all waiters
+		"""
+		self.backend.stop()
+		with self._lock:
+			waiters, self._waiters = self._waiters, []
+		for waiter in waiters:
+			waiter.resolve(0)
+
+	def addListener(self, callback):
+		""" Register a function called for every window notification
+			@param callback: called as callback(event, hwnd, windowClass,
+				windowName) on the backend's thread
+		"""
+		with self._lock:
+			self._listeners.append(callback)
+
+	def removeListener(self, callback):
+		with self._lock:
+			if callback in self._listeners:
+				self._listeners.remove(callback)
+
+	def findWindow(self, windowClass=None, windowName=None):
+		""" Look for an existing window without waiting
+			@returns: A handle to the window, or 0 if not found
+		"""
+		return self.backend.findWindow(windowClass, windowName)
+
+	def waitForWindow(self, windowClass=None, windowName=None, timeout=10.0, tick=None, tickInterval=1.0):
+		""" Block until a matching window exists, or the timeout expires
+			@param windowClass: the class to search for
+			@param windowName: the name to search for
+			@param timeout: the maximum number of seconds to wait
+			@param tick: optional function called every tickInterval
+				seconds while waiting (e.g. progress tones)
+			@returns: the resolved L{WindowWaiter}; its hwnd is 0 on timeout
+		"""
+		# Notifications wake the wait at once; looking again now and then
+		# covers a missed one, or a hook which couldn't be installed
+		recheck = self.RECHECK_INTERVAL if self.backend.hooked else self.POLL_INTERVAL
+		waiter = WindowWaiter(windowClass, windowName, timeout)
+		# Register before looking, so a window created in between the
+		# lookup and the registration can't be missed
+		with self._lock:
+			self._waiters.append(waiter)
+		try:
+			hwnd = self.backend.findWindow(windowClass, windowName)
+			if hwnd:
+				waiter.resolve(hwnd)
+			nextTick = time.time()
+			while not waiter.done:
+				now = time.time()
+				if tick and now >= nextTick:
+					tick()
+					nextTick = now + tickInterval
+				remaining = waiter.deadline - now
+				if remaining <= 0:
+					waiter.resolve(0)
+					break
+				if waiter.wait(min(remaining, recheck, nextTick - now) if tick else min(remaining, recheck)): break
+				hwnd = self.backend.findWindow(windowClass, windowName)
+				if hwnd:
+					if self.backend.hooked:
+						log.debug("Magnifier: window '%s', '%s' found without a notification" % (windowClass, windowName))
+					self.waitsRechecked += 1
+					waiter.resolve(hwnd)
+		finally:
+			with self._lock:
+				if waiter in self._waiters:
+					self._waiters.remove(waiter)
+
+		self.lastWaitTime = waiter.elapsed
+		if waiter.hwnd:
+			self.waitsCompleted += 1
+		else:
+			self.waitsTimedOut += 1
+		log.debug("Magnifier: waited %.3fs for window '%s', '%s' (hwnd %s)" % (waiter.elapsed, windowClass, windowName, waiter.hwnd))
+		return waiter
+
+	def _onWindowEvent(self, event, hwnd, windowClass, windowName):
+		""" Called by the backend for each window notification
+		"""
+		with self._lock:
+			waiters = list(self._waiters)
+			listeners = list(self._listeners)
+		# Listeners first, so a woken waiter sees their effects
+		for listener in listeners:
+			try:
+				listener(event, hwnd, windowClass, windowName)
+			except:
+				log.error("Magnifier: window listener failed", exc_info=True)
+		if event in (EVENT_OBJECT_CREATE, EVENT_OBJECT_SHOW):
+			for waiter in waiters:
+				if waiter.matches(windowClass, windowName):
+					waiter.resolve(hwnd)
+
+class WinEventBackend(object):
+	""" Receives top level window notifications through an out of
+		context WinEvent hook, serviced by its own message loop thread.
+	"""
+
+	def __init__(self):
+		self._thread = None
+		self._threadID = None
+		self._callback = None
+		self._started = threading.Event()
+		#: Whether the hook is installed, so notifications arrive
+		self.hooked = False
+
+	def start(self, callback):
+		""" Install the hook
+			@param callback: called as callback(event, hwnd, windowClass,
+				windowName)
+		"""
+		self._callback = callback
+		self._thread = threading.Thread(target=self._run, name=HOOK_THREAD)
+		self._thread.daemon = True
+		self._thread.start()
+		self._started.wait(5)
+
+	def stop(self):
+		""" Remove the hook and end the message loop
+		"""
+		import ctypes
+		if self._threadID:
+			ctypes.windll.user32.PostThreadMessageW(self._threadID, WM_QUIT, 0, 0)
+		if self._thread:
+			self._thread.join(5)
+		self._thread = None
+		self._threadID = None
+
+	def findWindow(self, windowClass, windowName):
+		return winBindings.get().findWindow(windowClass, windowName)
+
+	def enumerateWindows(self, classes):
+		""" One pass over the top level windows
+			@param classes: the window classes of interest
+			@returns: (hwnd, class, title) of each window with one of
+				those classes, in z-order
+		"""
+		win32 = winBindings.get()
+		found = []
+		for hwnd in win32.enumWindows():
+			windowClass = win32.getClassName(hwnd)
+			if windowClass in classes:
+				found.append((hwnd, windowClass, win32.getWindowText(hwnd)))
+		return found
+
+	def isWindow(self, hwnd):
+		return winBindings.get().isWindow(hwnd)
+
+	def _run(self):
+		import ctypes
+		from ctypes import wintypes
+		user32 = ctypes.windll.user32
+		win32 = winBindings.get()
+		WinEventProc = ctypes.WINFUNCTYPE(None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND, wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+		desktop = user32.GetDesktopWindow()
+
+		def onEvent(hook, event, hwnd, idObject, idChild, thread, eventTime):
+			# Only interested in top level windows themselves
+			if idObject != OBJID_WINDOW or idChild != CHILDID_SELF or not hwnd: return
+			if event != EVENT_OBJECT_DESTROY and win32.getAncestor(hwnd, GA_PARENT) != desktop: return
+			windowClass = win32.getClassName(hwnd)
+			# Doesn't send messages, so a hung window can't stall the hook
+			windowName = win32.getWindowText(hwnd)
+			try:
+				self._callback(event, hwnd, windowClass, windowName)
+			except:
+				log.error("Magnifier: WinEvent callback failed", exc_info=True)
+
+		# Keep a reference, or the callback will be garbage collected
+		self._proc = WinEventProc(onEvent)
+		hook = user32.SetWinEventHook(EVENT_OBJECT_CREATE, EVENT_OBJECT_HIDE, 0, self._proc, 0, 0, WINEVENT_OUTOFCONTEXT | WINEVENT_SKIPOWNPROCESS)
+		self._threadID = ctypes.windll.kernel32.GetCurrentThreadId()
+		self.hooked = bool(hook)
+		self._started.set()
+		if not hook:
+			log.error("Magnifier: could not install WinEvent hook, polling for windows instead")
+			return
+		msg = wintypes.MSG()
+		try:
+			while user32.GetMessageW(ctypes.byref(msg), None, 0, 0) > 0:
+				user32.TranslateMessage(ctypes.byref(msg))
+				user32.DispatchMessageW(ctypes.byref(msg))
+		finally:
+			user32.UnhookWinEvent(hook)
+
+class FakeWindowBackend(object):
+	""" An in-memory stand-in for L{WinEventBackend}, so window
+		discovery can be exercised off Windows.
+	"""
+
+	def __init__(self):
+		self._callback = None
+		self.hooked = True
+		self._lock = threading.Lock()
+		self._windows = {}
+		self._nextHwnd = 0x1000
+
+	def start(self, callback):
+		self._callback = callback
+
+	def stop(self):
+		self._callback = None
+
+	def findWindow(self, windowClass, windowName):
+		with self._lock:
+			for hwnd, (cls, name) in sorted(self._windows.items()):
+				if windowClass is not None and cls != windowClass: continue
+				if windowName is not None and name != windowName: continue
+				return hwnd
+		return 0
+
+	def enumerateWindows(self, classes):
+		with self._lock:
+			return [(hwnd, cls, name) for hwnd, (cls, name) in sorted(self._windows.items()) if cls in classes]
+
+	def isWindow(self, hwnd):
+		with self._lock:
+			return hwnd in self._windows
+
+	def createWindow(self, windowClass, windowName=None, delay=0):
+		""" Simulate a window appearing
+			@param delay: if non-zero, create the window from a timer
+				thread after this many seconds
+			@returns: the new hwnd (or None when delayed)
+		"""
+		if delay:
+			timer = threading.Timer(delay, self.createWindow, args=(windowClass, windowName))
+			timer.daemon = True
+			timer.start()
+			return None
+		with self._lock:
+			hwnd = self._nextHwnd
+			self._nextHwnd += 4
+			self._windows[hwnd] = (windowClass, windowName)
+		self._notify(EVENT_OBJECT_CREATE, hwnd, windowClass, windowName)
+		self._notify(EVENT_OBJECT_SHOW, hwnd, windowClass, windowName)
+		return hwnd
+
+	def destroyWindow(self, hwnd):
+		""" Simulate a window going away
+		"""
+		with self._lock:
+			windowClass, windowName = self._windows.pop(hwnd, (None, None))
+		self._notify(EVENT_OBJECT_DESTROY, hwnd, windowClass, windowName)
+
+	def _notify(self, event, hwnd, windowClass, windowName):
+		if self._callback:
+			self._callback(event, hwnd, windowClass, windowName)
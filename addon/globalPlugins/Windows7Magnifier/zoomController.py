@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Merges rapid zoom key presses into a single net zoom change, and
+	keeps track of the zoom level.
+"""
+
+import threading
+import time
+
+#: The magnifier's zoom range, in percent
+MINIMUM_ZOOM = 100
+MAXIMUM_ZOOM = 1600
+
+#: How far (in percent) each zoom step goes when the magnifier hasn't
+#: stored its own setting
+DEFAULT_INCREMENT = 100
+
+def clampZoom(level):
+	return max(MINIMUM_ZOOM, min(MAXIMUM_ZOOM, level))
+
+class ZoomController(object):
+	""" Collects zoom presses (from the main thread) into a pending net
+		delta, which is sent as one burst by the automation worker.
+		Holding a zoom key accelerates: the longer the key repeats, the
+		more steps each press is worth.
+	"""
+
+	def __init__(self, schedule, inject, afterBurst=None, repeatInterval=0.35, accelerateEvery=8, maxStep=3, clock=time.time):
+		""" @param schedule: called (without arguments) to have L{flush}
+				run later on the worker
+			@param inject: called as inject(steps) to send a burst of zoom
+				steps, positive to zoom in and negative to zoom out
+			@param afterBurst: optional function called once after each
+				burst, e.g. to hide the magnifier windows
+			@param repeatInterval: presses closer together than this (in
+				seconds) count as a key repeat
+			@param accelerateEvery: how many repeats before each press is
+				worth one more step
+			@param maxStep: the most steps a single press can be worth
+		"""
+		self.schedule = schedule
+		self.inject = inject
+		self.afterBurst = afterBurst
+		self.repeatInterval = repeatInterval
+		self.accelerateEvery = accelerateEvery
+		self.maxStep = maxStep
+		self.clock = clock
+		self._lock = threading.Lock()
+		self._pending = 0
+		self._scheduled = False
+		self._lastPress = None
+		self._lastDirection = 0
+		self._repeats = 0
+		# Statistics
+		self.presses = 0
+		self.bursts = 0
+		self.stepsSent = 0
+		self.largestBurst = 0
+
+	def press(self, direction):
+		""" Register a zoom key press
+			@param direction: 1 to zoom in, -1 to zoom out
+			@returns: the number of steps the press was worth
+		"""
+		now = self.clock()
+		with self._lock:
+			self.presses += 1
+			if self._lastPress is not None and direction == self._lastDirection and now - self._lastPress < self.repeatInterval:
+				self._repeats += 1
+			else:
+				self._repeats = 0
+			self._lastPress = now
+			self._lastDirection = direction
+			step = min(1 + self._repeats // self.accelerateEvery, self.maxStep)
+			self._pending += direction * step
+			schedule = not self._scheduled
+			self._scheduled = True
+		if schedule:
+			self.schedule()
+		return step
+
+	@property
+	def pending(self):
+		with self._lock:
+			return self._pending
+
+	def flush(self):
+		""" Send the pending net delta as one burst. Presses that arrive
+			while a burst is being sent are collected for the next one.
+			@returns: the number of steps sent
+		"""
+		with self._lock:
+			steps = self._pending
+			self._pending = 0
+			self._scheduled = False
+		if steps == 0: return 0
+		self.inject(steps)
+		self.bursts += 1
+		self.stepsSent += abs(steps)
+		self.largestBurst = max(self.largestBurst, abs(steps))
+		if self.afterBurst:
+			self.afterBurst()
+		return steps
+
+class ZoomModel(object):
+	""" The magnifier's zoom level, read from its stored settings and
+		then followed as zoom steps are sent, so the addon knows the
+		level without asking the magnifier.
+	"""
+
+	def __init__(self, read):
+		""" @param read: returns the stored (magnification, increment) in
+				percent, either of which may be None (see
+				L{settingsBackend.SettingsBackend.readZoom})
+		"""
+		self.read = read
+		self._lock = threading.Lock()
+		self._level = None
+		self.increment = DEFAULT_INCREMENT
+		#: Whether the magnifier stores its level as it changes, rather
+		#: than only when it exits. None until seen.
+		self.liveStore = None
+		# Statistics
+		self.syncs = 0
+		self.corrections = 0
+
+	@property
+	def level(self):
+		""" The zoom level in percent, or None if not known
+		"""
+		with self._lock:
+			return self._level
+
+	def sync(self):
+		""" Take the level and step size from the magnifier's stored
+			settings
+			@returns: the level, or None if not stored
+		"""
+		stored, increment = self.read()
+		with self._lock:
+			self.syncs += 1
+			if increment:
+				self.increment = increment
+			if stored is not None:
+				self._level = clampZoom(stored)
+			return self._level
+
+	def forget(self):
+		""" The magnifier exited; it stores its level as it does, so the
+			next L{sync} reads the level it starts with
+		"""
+		with self._lock:
+			self._level = None
+
+	def stepped(self, steps):
+		""" Zoom steps were sent
+			@param steps: positive to zoom in, negative to zoom out
+		"""
+		with self._lock:
+			if self._level is not None:
+				self._level = clampZoom(self._level + steps * self.increment)
+
+	def stepsTo(self, target):
+		""" @param target: the level wanted, in percent
+			@returns: how many steps get closest to it, positive to zoom
+				in and negative to zoom out
+		"""
+		level = self.level
+		if level is None:
+			level = self.sync()
+		if level is None:
+			level = MINIMUM_ZOOM
+			with self._lock:
+				self._level = level
+		with self._lock:
+			increment = self.increment
+		return int(round((clampZoom(target) - level) / float(increment)))
+
+	def confirm(self, before, waitUntil, timeout=0.5):
+		""" Check the level against the one the magnifier stores, when it
+			stores it as it changes
+			@param before: the level before the steps were sent
+			@param waitUntil: waits for a condition, as
+				L{readiness.Readiness.waitUntil}
+			@returns: the (possibly corrected) level
+		"""
+		expected = self.level
+		if expected is None or expected == before or self.liveStore is False:
+			return expected
+		readStored = lambda: self.read()[0]
+		if waitUntil("zoom level stored", lambda: readStored() == expected, timeout):
+			self.liveStore = True
+			return expected
+		stored = readStored()
+		if stored is None or (stored == before and not self.liveStore):
+			# Only stored when the magnifier exits
+			self.liveStore = False
+			return expected
+		with self._lock:
+			self.corrections += 1
+			self._level = clampZoom(stored)
+			return self._level
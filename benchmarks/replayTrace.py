@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Replays a trace of the plugin's Win32 calls, recorded on a user's
+	machine with the recordCalls option, against the plugin off Windows.
+
+	Every Win32 call is answered with the result recorded for it, after
+	as long as it took when recorded. The scripts, window events,
+	foreground changes and option changes recorded are fed to the plugin
+	at the times they happened. The replay records a trace of its own,
+	and the two are compared call by call. The magnifier's registry
+	settings aren't part of the trace, so they start out empty.
+
+	Usage: python replayTrace.py windows7magnifier-calls.trace [--speed 2] [--no-delays]
+"""
+
+import argparse
+import collections
+import os
+import sys
+import threading
+import time
+
+import simulatedNVDA
+
+#: The WinEvent hook's thread. Its calls aren't replayed, since the
+#: window events it found are delivered by the replay itself.
+HOOK_THREAD = "Windows7Magnifier.WinEventBackend"
+
+#: What waits return when the replay ends while they're still waiting,
+#: so they are taken as interrupted rather than as the process exiting
+INTERRUPTED = {"waitForMultipleObjects": 1}
+
+#: How many calls that weren't recorded to list
+MAX_UNMATCHED = 20
+
+def freeze(value):
+	""" JSON lists to tuples, so recorded arguments can be compared with
+		those given
+	"""
+	if isinstance(value, (list, tuple)):
+		return tuple(freeze(item) for item in value)
+	return value
+
+class RecordedCall(object):
+	__slots__ = ("result", "duration", "used")
+
+	def __init__(self, result, duration):
+		self.result = result
+		self.duration = duration
+		self.used = False
+
+class ReplayBindings(object):
+	""" Win32 bindings answering each call with what the same call
+		returned when recorded. Calls are matched on their arguments, in
+		order, and once a call is made more often than it was recorded
+		its last result is repeated. A call never recorded with those
+		arguments gets the next result recorded for the same function,
+		or failing that a harmless default.
+	"""
+
+	#: How calls were answered, in the order of L{matches}
+	ANSWERS = ("exact", "repeated", "other", "default")
+
+	def __init__(self, calls, delays=True, speed=1.0):
+		""" @param calls: the recorded calls, as (name, args, result,
+				duration)
+			@param delays: whether calls take as long as they did when
+				recorded
+			@param speed: how many times faster than recorded to replay
+		"""
+		from Windows7Magnifier import winBindings
+		self._wrappers = winBindings.WRAPPERS
+		self._defaults = winBindings.FakeWin32Bindings.DEFAULTS
+		self.delays = delays
+		self.speed = speed
+		self.INVALID_HANDLE_VALUE = -1
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._byArgs = collections.defaultdict(collections.deque)
+		self._byName = collections.defaultdict(collections.deque)
+		self._last = {}
+		self._recorded = []
+		for name, args, result, duration in calls:
+			call = RecordedCall(result, duration)
+			self._byArgs[(name, freeze(args))].append(call)
+			self._byName[name].append(call)
+			self._recorded.append((name, call))
+		#: How many calls were answered each way (see L{ANSWERS}), by name
+		self.matches = collections.defaultdict(lambda: [0] * len(self.ANSWERS))
+		#: The first calls that weren't recorded, as (name, args)
+		self.unmatched = []
+
+	def __getattr__(self, name):
+		if name not in self._wrappers:
+			raise AttributeError(name)
+		def wrapper(*args):
+			call = self._answer(name, args)
+			if call is None:
+				if name == "vkKeyScanEx":
+					return (0, ord(args[0].upper()))
+				return self._defaults.get(name, 0)
+			if self.delays and call.duration:
+				if self._stopped.wait(call.duration / self.speed) and name in INTERRUPTED:
+					return INTERRUPTED[name]
+			if isinstance(call.result, dict) and "error" in call.result:
+				raise EnvironmentError(call.result["error"])
+			return freeze(call.result)
+		self.__dict__[name] = wrapper
+		return wrapper
+
+	def stop(self):
+		""" End every delay, including those still to come
+		"""
+		self._stopped.set()
+
+	def unused(self):
+		""" @returns: the number of recorded calls never answered, by name
+			@rtype: dict
+		"""
+		unused = collections.defaultdict(int)
+		with self._lock:
+			for name, call in self._recorded:
+				if not call.used: unused[name] += 1
+		return unused
+
+	def _answer(self, name, args):
+		key = (name, freeze(args))
+		with self._lock:
+			call = self._next(self._byArgs.get(key))
+			if call is not None:
+				answer = 0
+			elif key in self._last:
+				call = self._last[key]
+				answer = 1
+			else:
+				call = self._next(self._byName.get(name))
+				answer = 2 if call is not None else 3
+			if call is not None:
+				call.used = True
+				self._last[key] = call
+			self.matches[name][answer] += 1
+			if answer >= 2 and len(self.unmatched) < MAX_UNMATCHED:
+				self.unmatched.append((name, args))
+		return call
+
+	@staticmethod
+	def _next(queue):
+		# Calls may already have been taken through the other queue
+		while queue and queue[0].used:
+			queue.popleft()
+		return queue.popleft() if queue else None
+
+def _replayWindowBackend():
+	from Windows7Magnifier import windowWatcher
+	class ReplayWindowBackend(windowWatcher.WinEventBackend):
+		""" Finds windows through the (replayed) Win32 bindings. The
+			recorded window events are delivered by the replay rather
+			than a hook.
+		"""
+		def start(self, callback):
+			self._callback = callback
+			self.hooked = True
+		def stop(self):
+			pass
+		def deliver(self, event, hwnd, windowClass, windowName):
+			self._callback(event, hwnd, windowClass, windowName)
+	return ReplayWindowBackend()
+
+class Focus(object):
+	""" The object given to event_foreground
+	"""
+
+	class AppModule(object):
+		pass
+
+	def __init__(self, appName):
+		self.appModule = Focus.AppModule()
+		self.appModule.appName = appName
+
+def writeProfiles(configPath, profiles):
+	""" Write the recorded profiles to the addon's ini file
+	"""
+	with open(os.path.join(configPath, "windows7magnifier.ini"), "w") as f:
+		f.write("[profiles]\n")
+		for appName, options in sorted(profiles.items()):
+			f.write("[[%s]]\n" % appName)
+			for name, value in sorted(options.items()):
+				f.write("%s = %s\n" % (name, value))
+
+def replay(path, delays=True, speed=1.0):
+	""" Run the plugin against a recorded trace
+		@returns: the recorded trace's header and events, the replay's
+			events, the L{ReplayBindings} and the plugin
+		@rtype: tuple
+	"""
+	simulatedNVDA.install(simulate=False)
+	import globalVars
+	import Windows7Magnifier
+	from Windows7Magnifier import callTrace, settingsBackend, winBindings, Windows7MagnifierConfig
+	header, events = callTrace.load(path)
+	configPath = globalVars.appArgs.configPath
+	writeProfiles(configPath, header.get("profiles", {}))
+
+	# The recorded options, with the replay recording its own trace
+	settings = Windows7MagnifierConfig.getSettings()
+	options = dict((name, value) for name, value in header.get("settings", {}).items() if name in Windows7MagnifierConfig.FIELDS)
+	options.update(recordCalls=True, tracing=True)
+	settings.update(**options)
+
+	calls = [(name, args, result, duration) for offset, name, thread, args, result, duration in events
+		if name in winBindings.WRAPPERS and thread != HOOK_THREAD]
+	bindings = ReplayBindings(calls, delays=delays, speed=speed)
+	winBindings.install(bindings)
+	windows = _replayWindowBackend()
+	Windows7Magnifier.GlobalPlugin.windowBackendFactory = staticmethod(lambda: windows)
+	Windows7Magnifier.GlobalPlugin.settingsStoreFactory = staticmethod(settingsBackend.MemorySettingsStore)
+
+	start = time.time()
+	plugin = Windows7Magnifier.GlobalPlugin()
+	end = 0
+	for offset, name, thread, args, result, duration in events:
+		end = max(end, offset + duration)
+		if name not in callTrace.INPUTS: continue
+		delay = start + offset / speed - time.time()
+		if delay > 0: time.sleep(delay)
+		if name == "script":
+			getattr(plugin, "script_%s" % args[0])(None)
+		elif name == "foreground":
+			plugin.event_foreground(Focus(args[0]), lambda: None)
+		elif name == "settings":
+			changes, external = args
+			changes = dict((str(key), value) for key, value in changes.items())
+			if external:
+				settings.mergeExternal(dict(settings.snapshot(), **changes))
+			else:
+				settings.update(**changes)
+		elif name == "window":
+			windows.deliver(*args)
+	delay = start + end / speed - time.time()
+	if delay > 0: time.sleep(delay)
+	plugin.worker.waitUntilIdle(60)
+	bindings.stop()
+	plugin.terminate()
+	replayedHeader, replayed = callTrace.load(os.path.join(configPath, "windows7magnifier-calls.trace"))
+	return header, events, replayed, bindings, plugin
+
+def report(header, events, replayed, bindings, plugin):
+	from Windows7Magnifier import callTrace, tracing
+	if header["dropped"]:
+		print("The trace starts %d events in (the beginning was dropped), so early calls won't match" % header["dropped"])
+	events = [event for event in events if event[2] != HOOK_THREAD]
+	recorded = callTrace.summarize(events)
+	again = callTrace.summarize(replayed)
+	unused = bindings.unused()
+	print("%-26s %9s %10s %9s %10s %7s  %s" % ("call", "recorded", "ms", "replayed", "ms", "unused", "/".join(ReplayBindings.ANSWERS)))
+	for name in sorted(set(recorded) | set(again)):
+		count, seconds = recorded.get(name, (0, 0.0))
+		replayedCount, replayedSeconds = again.get(name, (0, 0.0))
+		answers = "/".join(str(n) for n in bindings.matches[name]) if name in bindings.matches else "-"
+		print("%-26s %9d %10.1f %9d %10.1f %7d  %s" % (name, count, seconds * 1000, replayedCount, replayedSeconds * 1000, unused.get(name, 0), answers))
+	if bindings.unmatched:
+		print("Calls that weren't recorded:")
+		for name, args in bindings.unmatched:
+			print("  %s%r" % (name, tuple(args)))
+	operations = tracing.tracer.operations
+	if operations:
+		print("Operations:")
+		for operation in operations:
+			print("  " + operation.describe())
+	for line in plugin.readiness.summary():
+		print(line)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("trace", help="a trace saved by the recordCalls option")
+	parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than recorded to replay (default 1)")
+	parser.add_argument("--no-delays", action="store_true", help="answer calls at once, rather than taking as long as recorded")
+	args = parser.parse_args(argv)
+	report(*replay(args.trace, delays=not args.no_delays, speed=args.speed))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Measures the plugin's operations against the simulated magnifier
+	in simulatedNVDA, and fails if any got slower (or made more Win32
+	calls, or started more threads) than the stored baseline allows.
+
+	Usage: python runBenchmarks.py [--update-baseline] [--tolerance 0.25]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import simulatedNVDA
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+METRICS = ("wallTime", "scriptTime", "win32Calls", "threadsStarted")
+# Absolute allowances on top of the relative tolerance, so tiny values
+# don't fail on noise
+SLACK = {"wallTime": 0.1, "scriptTime": 0.02, "win32Calls": 5, "threadsStarted": 0}
+
+def measure(action, settle=None):
+	""" Run one operation
+		@param action: what a user (or NVDA) would do; its duration is
+			the time NVDA's main thread is held up
+		@param settle: waits for any background work to complete
+		@returns: the operation's metrics
+		@rtype: dict
+	"""
+	before = simulatedNVDA.counters.snapshot()
+	start = time.time()
+	action()
+	scriptTime = time.time() - start
+	if settle: settle()
+	wallTime = time.time() - start
+	after = simulatedNVDA.counters.snapshot()
+	return {
+		"wallTime": wallTime,
+		"scriptTime": scriptTime,
+		"win32Calls": after["win32Calls"] - before["win32Calls"],
+		"threadsStarted": after["threadsStarted"] - before["threadsStarted"],
+	}
+
+def runOperations(sim):
+	""" Drive the plugin through a typical session
+		@returns: (name, metrics) for each operation, in order
+	"""
+	results = []
+	plugin = [None]
+
+	# Importing happened when the simulation was installed; the module
+	# times itself
+	import Windows7Magnifier
+	importTime = Windows7Magnifier.importTime
+	results.append(("pluginImport", {"wallTime": importTime, "scriptTime": importTime, "win32Calls": 0, "threadsStarted": 0}))
+
+	# Per application profiles
+	import globalVars
+	with open(os.path.join(globalVars.appArgs.configPath, "windows7magnifier.ini"), "w") as f:
+		f.write("[profiles]\n[[winword]]\ninvertColors = False\n[[firefox]]\nmode = Fullscreen\n")
+
+	def load():
+		plugin[0] = simulatedNVDA.loadPlugin()
+	results.append(("pluginInit", measure(load)))
+	plugin = plugin[0]
+
+	from Windows7Magnifier import Windows7MagnifierConfig
+	settings = Windows7MagnifierConfig.getSettings()
+
+	def idle():
+		if not plugin.worker.waitUntilIdle(60):
+			raise RuntimeError("worker did not finish")
+
+	def waitFor(condition):
+		deadline = time.time() + 30
+		while not condition():
+			if time.time() > deadline: raise RuntimeError("simulation did not settle")
+			time.sleep(0.005)
+
+	def zoom(script, presses):
+		def action():
+			for i in range(presses):
+				script(None)
+		return action
+
+	def changeConfig(**values):
+		def action():
+			settings.update(**values)
+			plugin.applyConfig()
+		return action
+
+	results.append(("startMagnifier", measure(lambda: plugin.worker.submit("start"), idle)))
+	results.append(("applyConfig (changed)", measure(changeConfig(invertColors=True, followMouse=False), idle)))
+	results.append(("applyConfig (unchanged)", measure(changeConfig(), idle)))
+	results.append(("applyConfig (mode switch)", measure(changeConfig(mode="Lens", lensSizeHorizontal=50), idle)))
+
+	class Focus(object):
+		def __init__(self, appName):
+			self.appModule = Focus.AppModule()
+			self.appModule.appName = appName
+		class AppModule(object):
+			pass
+	def foreground(*appNames):
+		# NVDA's foreground events, as when alt+tabbing
+		def action():
+			for appName in appNames:
+				plugin.event_foreground(Focus(appName), lambda: None)
+		return action
+	def switchedTo(invertColors):
+		def settle():
+			waitFor(lambda: sim.settings["invertColors"] == invertColors)
+			idle()
+		return settle
+	results.append(("profile switch (hotkeys)", measure(foreground("winword"), switchedTo(False))))
+	results.append(("profile switch (alt+tab x3)", measure(foreground("explorer", "firefox", "explorer"), switchedTo(True))))
+
+	def queuedDialogChanges():
+		# Changes queued behind each other share one options dialog
+		settings.update(settingsBackend="dialog")
+		plugin.worker.submit("applySettings", followKeyboard=False)
+		plugin.worker.submit("switchProfile", followMouse=False, followKeyboard=True)
+		plugin.worker.submit("applySettings", lensSizeVertical=40)
+	results.append(("applySettings x3 (dialog)", measure(queuedDialogChanges, idle)))
+	settings.update(settingsBackend="registry")
+
+	def openOptions(click):
+		# The options dialog, opened by its command or by clicking
+		def action():
+			plugin.configuring = True
+			plugin._optionsCommand = 0 if click else None
+			plugin._openOptionsWindow()
+		return action
+	def closeOptions():
+		sim.command(sim.dialog, simulatedNVDA.IDOK)
+		waitFor(lambda: not sim.dialog)
+		plugin.configuring = False
+	results.append(("openOptions (message)", measure(openOptions(False), closeOptions)))
+	results.append(("openOptions (click)", measure(openOptions(True), closeOptions)))
+	plugin._optionsCommand = None
+	results.append(("zoomIn x20", measure(zoom(plugin.script_zoomIn, 20), idle)))
+	results.append(("zoomOut x20", measure(zoom(plugin.script_zoomOut, 20), idle)))
+	def zoomTo(level):
+		def settle():
+			idle()
+			if sim.zoom != level: raise RuntimeError("zoomed to %d, not %d" % (sim.zoom, level))
+		return settle
+	results.append(("zoomTo 400%", measure(lambda: plugin.zoomTo(400), zoomTo(400))))
+	results.append(("nextZoomPreset", measure(lambda: plugin.script_nextZoomPreset(None), zoomTo(800))))
+	def recovered():
+		waitFor(lambda: plugin.supervisor.recoveries == 1)
+		idle()
+		if not sim.running or sim.zoom != 800 or sim.settings["mode"] != "Lens":
+			raise RuntimeError("magnifier not restored")
+	results.append(("recover after crash", measure(sim.crash, recovered)))
+	results.append(("resetZoom", measure(lambda: plugin.script_resetZoom(None), zoomTo(100))))
+	results.append(("invert", measure(lambda: plugin.script_invert(None), idle)))
+	results.append(("toggleMagnifier (close)", measure(lambda: plugin.script_toggleMagnifier(None), lambda: (idle(), waitFor(lambda: not sim.running)))))
+	results.append(("toggleMagnifier (start)", measure(lambda: plugin.script_toggleMagnifier(None), idle)))
+	results.append(("terminate", measure(plugin.terminate)))
+	waitFor(lambda: not sim.running)
+
+	# NVDA starting with the magnifier configured to start too: the
+	# plugin's construction mustn't wait for the launch
+	def loadStarting():
+		plugin[0] = simulatedNVDA.loadPlugin(startWithNVDA=True)
+	plugin = [None]
+	results.append(("pluginInit (startWithNVDA)", measure(loadStarting, lambda: plugin[0].worker.waitUntilIdle(60))))
+	plugin[0].terminate()
+	waitFor(lambda: not sim.running)
+
+	# NVDA starting while the magnifier is already running with the
+	# configured settings: applying them mustn't restart it
+	plugin = simulatedNVDA.loadPlugin()
+	sim.settingsBackend.write(**plugin._configuredSettings())
+	sim.launch()
+	waitFor(lambda: sim.modeWindow)
+	launches = sim.launches
+	def notRelaunched():
+		idle()
+		if sim.launches != launches: raise RuntimeError("magnifier relaunched to apply unchanged settings")
+	results.append(("applyConfig (already running)", measure(plugin.applyConfig, notRelaunched)))
+	plugin.terminate()
+	return results
+
+def compare(results, baseline, tolerance):
+	""" @returns: a description of each metric which regressed
+		@rtype: list
+	"""
+	regressions = []
+	for name, metrics in results:
+		expected = baseline.get(name)
+		if expected is None: continue
+		for metric in METRICS:
+			if metric not in expected: continue
+			allowed = expected[metric] * (1 + tolerance) + SLACK[metric]
+			if metrics[metric] > allowed:
+				regressions.append("%s: %s %s > allowed %s (baseline %s)" % (name, metric, _format(metrics[metric]), _format(allowed), _format(expected[metric])))
+	return regressions
+
+def _format(value):
+	return "%.3f" % value if isinstance(value, float) else str(value)
+
+def report(results):
+	print("%-32s %10s %10s %10s %8s" % ("operation", "wall (s)", "script (s)", "win32", "threads"))
+	for name, metrics in results:
+		print("%-32s %10.3f %10.3f %10d %8d" % (name, metrics["wallTime"], metrics["scriptTime"], metrics["win32Calls"], metrics["threadsStarted"]))
+
+def main(argv):
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--update-baseline", action="store_true", help="store these results as the new baseline")
+	parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression (default 0.25)")
+	parser.add_argument("--launch-latency", type=float, default=0.3)
+	parser.add_argument("--mode-latency", type=float, default=0.15)
+	parser.add_argument("--dialog-latency", type=float, default=0.15)
+	args = parser.parse_args(argv)
+
+	sim = simulatedNVDA.install(launchLatency=args.launch_latency, modeLatency=args.mode_latency, dialogLatency=args.dialog_latency)
+	results = runOperations(sim)
+	report(results)
+
+	if args.update_baseline:
+		with open(BASELINE_FILE, "w") as f:
+			json.dump(dict(results), f, indent=1, sort_keys=True)
+		print("Baseline updated")
+		return 0
+	if not os.path.isfile(BASELINE_FILE):
+		print("No baseline to compare against (run with --update-baseline)")
+		return 0
+	with open(BASELINE_FILE) as f:
+		baseline = json.load(f)
+	regressions = compare(results, baseline, args.tolerance)
+	for regression in regressions:
+		print("REGRESSION " + regression)
+	return 1 if regressions else 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,583 @@
+# -*- coding: utf-8 -*-
+# Windows 7 Magnifier Integration Addon for NVDA
+#
+# This file is covered by the GNU General Public License.
+# You can read the licence by clicking Help->License in the NVDA menu
+# or by visiting http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+#
+
+""" Stand-ins for the NVDA and Win32 modules the plugin imports, backed
+	by a simulated Windows 7 magnifier. Lets the plugin run (and be
+	measured) off Windows.
+
+	Call L{install} before importing Windows7Magnifier.
+"""
+
+import __builtin__
+import codecs
+import heapq
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+ADDON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "addon")
+
+# Key codes understood by the simulated magnifier
+VK_SHIFT = 0x10
+VK_CONTROL = 0x11
+VK_MENU = 0x12
+VK_CAPITAL = 0x14
+VK_LWIN = 0x5B
+VK_RWIN = 0x5C
+VK_NUMLOCK = 0x90
+VK_OEM_PLUS = 0xBB
+VK_OEM_MINUS = 0xBD
+KEYEVENTF_KEYUP = 0x02
+
+# Messages understood by the simulated magnifier
+WM_CLOSE = 0x10
+WM_COMMAND = 0x111
+IDOK = 1
+BM_CLICK = 0xF5
+BM_GETCHECK = 0xF0
+TBM_GETPOS = 0x400
+TBM_SETPOSNOTIFY = 0x422
+
+#: The exit code of a crashed magnifier
+EXCEPTION_ACCESS_VIOLATION = 0xC0000005
+
+#: The command of the main window's options button
+OPTIONS_COMMAND = 0x9C4D
+
+MAIN_CLASS = u"MagUIClass"
+OPTIONS_TITLE = u"Magnifier Options"
+MODE_CLASSES = {
+	"Fullscreen": u"Screen Magnifier Fullscreen Window",
+	"Lens": u"Screen Magnifier Lens Window",
+	"Docked": u"Screen Magnifier Window",
+}
+CHECKBOX_IDS = {
+	319: "invertColors",
+	315: "followMouse",
+	316: "followKeyboard",
+	317: "followTextInsertion",
+}
+TRACKBAR_IDS = {
+	321: "lensSizeHorizontal",
+	323: "lensSizeVertical",
+}
+
+class Counters(object):
+	""" Win32 calls and threads started, for comparing operations
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.win32Calls = 0
+		self.threadsStarted = 0
+		self.byName = {}
+
+	def call(self, name):
+		with self._lock:
+			self.win32Calls += 1
+			self.byName[name] = self.byName.get(name, 0) + 1
+
+	def snapshot(self):
+		with self._lock:
+			win32Calls = self.win32Calls
+			if magnifier and magnifier.bindings:
+				win32Calls += magnifier.bindings.callCount
+			return {"win32Calls": win32Calls, "threadsStarted": self.threadsStarted}
+
+counters = Counters()
+
+def counted(name):
+	""" Decorator counting calls to a simulated Win32 function
+	"""
+	def decorator(func):
+		def wrapper(*args, **kwargs):
+			counters.call(name)
+			return func(*args, **kwargs)
+		wrapper.__name__ = func.__name__
+		return wrapper
+	return decorator
+
+class Scheduler(object):
+	""" Runs delayed simulation events on one thread, so the simulation
+		doesn't skew the plugin's thread counts
+	"""
+
+	def __init__(self):
+		self._cond = threading.Condition()
+		self._events = []
+		self._seq = itertools.count()
+		self._thread = threading.Thread(target=self._run, name="simulation")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def after(self, delay, func, *args):
+		with self._cond:
+			heapq.heappush(self._events, (time.time() + delay, next(self._seq), func, args))
+			self._cond.notify()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._events or self._events[0][0] > time.time():
+					self._cond.wait(self._events[0][0] - time.time() if self._events else None)
+				when, seq, func, args = heapq.heappop(self._events)
+			try:
+				func(*args)
+			except:
+				logging.exception("simulation event failed")
+
+class SimulatedMagnifier(object):
+	""" A Windows 7 magnifier: its process, windows, hotkeys, options
+		dialog and stored settings.
+	"""
+
+	def __init__(self, launchLatency=0.3, modeLatency=0.15, dialogLatency=0.15, closeLatency=0.05):
+		""" @param launchLatency: seconds from launch until the main window
+				exists
+			@param modeLatency: seconds for a mode window to appear after
+				launch or a mode hotkey
+			@param dialogLatency: seconds for the options dialog to open
+			@param closeLatency: seconds for the process to exit after
+				WM_CLOSE
+		"""
+		self.launchLatency = launchLatency
+		self.modeLatency = modeLatency
+		self.dialogLatency = dialogLatency
+		self.closeLatency = closeLatency
+		self.scheduler = Scheduler()
+		self.windows = None
+		self.processes = None
+		self.store = None
+		self.settingsBackend = None
+		self.bindings = None
+		self._lock = threading.RLock()
+		self.pid = None
+		self.mainWindow = 0
+		self.toolbar = 0
+		self.modeWindow = 0
+		self.dialog = 0
+		self.foreground = 0
+		self.settings = self._defaults()
+		self.pending = None
+		self.zoom = 100
+		self.zoomIncrement = 100
+		self.launches = 0
+		self._keysDown = []
+		self._chordHandled = False
+
+	def start(self):
+		""" Create the fake backends. Needs the stand-in modules, as
+			this imports the plugin's package.
+		"""
+		from Windows7Magnifier import settingsBackend, winBindings
+		self.bindings = _simulatedBindings(self)
+		winBindings.install(self.bindings)
+		self.windows = _countingWindowBackend()
+		self.processes = _countingProcessBackend()
+		self.store = settingsBackend.MemorySettingsStore()
+		self.settingsBackend = settingsBackend.SettingsBackend(self.store)
+
+	@staticmethod
+	def _defaults():
+		return {
+			"mode": "Fullscreen",
+			"invertColors": False,
+			"followMouse": True,
+			"followKeyboard": True,
+			"followTextInsertion": True,
+			"lensSizeHorizontal": 20,
+			"lensSizeVertical": 25,
+		}
+
+	@property
+	def running(self):
+		return self.pid is not None
+
+	# Process lifetime
+
+	def launch(self):
+		with self._lock:
+			if self.running: return
+			self.launches += 1
+			self.settings = self._defaults()
+			self.settings.update(self.settingsBackend.read())
+			self.zoom = self.store.read("Magnification") or 100
+			self.zoomIncrement = self.store.read("ZoomIncrement") or 100
+			self.pid = self.processes.launch("Magnify.exe")
+			self.scheduler.after(self.launchLatency, self._createMainWindow, self.pid)
+
+	def _createMainWindow(self, pid):
+		with self._lock:
+			if self.pid != pid: return
+			self.mainWindow = self.windows.createWindow(MAIN_CLASS, u"Magnifier")
+			self.toolbar = self.mainWindow + 1
+			self.foreground = self.mainWindow
+			self.scheduler.after(self.modeLatency, self._createModeWindow, pid, self.settings["mode"])
+
+	def _createModeWindow(self, pid, mode):
+		with self._lock:
+			if self.pid != pid: return
+			if self.modeWindow:
+				self.windows.destroyWindow(self.modeWindow)
+			self.modeWindow = self.windows.createWindow(MODE_CLASSES[mode], None)
+			self.settings["mode"] = mode
+
+	def close(self):
+		with self._lock:
+			if not self.running: return
+			self.scheduler.after(self.closeLatency, self._exit, self.pid)
+
+	def crash(self):
+		""" Exit at once, without saving settings
+		"""
+		with self._lock:
+			if self.running: self._exit(self.pid, save=False)
+
+	def _exit(self, pid, save=True):
+		with self._lock:
+			if self.pid != pid: return
+			# The real magnifier saves its settings on exit
+			if save: self.settingsBackend.write(**self.settings)
+			for hwnd in (self.dialog, self.modeWindow, self.mainWindow):
+				if hwnd: self.windows.destroyWindow(hwnd)
+			self.dialog = self.modeWindow = self.mainWindow = self.toolbar = 0
+			# A crash ends it with an exception code, as on Windows
+			self.processes.kill(pid, 0 if save else EXCEPTION_ACCESS_VIOLATION)
+			self.pid = None
+
+	# Keyboard
+
+	def keyEvent(self, vk, flags):
+		with self._lock:
+			if not flags & KEYEVENTF_KEYUP:
+				if vk not in self._keysDown: self._keysDown.append(vk)
+				return
+			if self._keysDown and not self._chordHandled:
+				self._chordHandled = True
+				self._chord(frozenset(self._keysDown))
+			if vk in self._keysDown: self._keysDown.remove(vk)
+			if not self._keysDown: self._chordHandled = False
+
+	def _chord(self, keys):
+		ctrlAlt = set([VK_CONTROL, VK_MENU])
+		modes = {ord("F"): "Fullscreen", ord("D"): "Docked", ord("L"): "Lens"}
+		if keys >= ctrlAlt and len(keys) == 3:
+			key = list(keys - ctrlAlt)[0]
+			if not self.running: return
+			if key in modes:
+				self.scheduler.after(self.modeLatency, self._createModeWindow, self.pid, modes[key])
+			elif key == ord("I"):
+				self.settings["invertColors"] = not self.settings["invertColors"]
+		elif keys == set([VK_LWIN, VK_OEM_PLUS]):
+			# Windows starts the magnifier when zooming in
+			if not self.running:
+				self.launch()
+			self.zoom = min(1600, self.zoom + self.zoomIncrement)
+			self.store.write({"Magnification": self.zoom})
+		elif keys == set([VK_LWIN, VK_OEM_MINUS]):
+			if self.running:
+				self.zoom = max(100, self.zoom - self.zoomIncrement)
+				self.store.write({"Magnification": self.zoom})
+
+	def enter(self):
+		with self._lock:
+			if self.dialog and self.foreground == self.dialog:
+				self._commitDialog()
+
+	def _commitDialog(self):
+		with self._lock:
+			self.settings.update(self.pending)
+			self.pending = None
+			self.windows.destroyWindow(self.dialog)
+			self.dialog = 0
+			self.foreground = self.mainWindow
+
+	# Mouse and the options dialog
+
+	def click(self):
+		with self._lock:
+			if self.running and self.mainWindow and self.foreground in (self.mainWindow, self.toolbar):
+				self.openOptions()
+
+	def openOptions(self, activate=True):
+		""" @param activate: whether the dialog becomes the foreground
+				window; not when opened by a background process's message
+		"""
+		with self._lock:
+			if self.dialog: return
+			self.scheduler.after(self.dialogLatency, self._createDialog, self.pid, activate)
+
+	def _createDialog(self, pid, activate):
+		with self._lock:
+			if self.pid != pid or self.dialog: return
+			self.pending = dict(self.settings)
+			self.dialog = self.windows.createWindow(u"#32770", OPTIONS_TITLE)
+			if activate: self.foreground = self.dialog
+
+	def command(self, hwnd, commandID):
+		""" A WM_COMMAND message
+		"""
+		with self._lock:
+			if not self.running: return
+			if hwnd == self.mainWindow and commandID == OPTIONS_COMMAND:
+				self.openOptions(activate=False)
+			elif self.dialog and hwnd == self.dialog and commandID == IDOK:
+				self._commitDialog()
+
+	def dialogItem(self, dialog, controlID):
+		with self._lock:
+			if not dialog or dialog != self.dialog: return 0
+			if controlID not in CHECKBOX_IDS and controlID not in TRACKBAR_IDS: return 0
+			return dialog * 0x1000 + controlID
+
+	def controlMessage(self, hwnd, msg, wParam, lParam):
+		with self._lock:
+			if not self.dialog or hwnd // 0x1000 != self.dialog: return 0
+			controlID = hwnd % 0x1000
+			if controlID in CHECKBOX_IDS:
+				name = CHECKBOX_IDS[controlID]
+				if msg == BM_GETCHECK: return int(self.pending[name])
+				if msg == BM_CLICK: self.pending[name] = not self.pending[name]
+			elif controlID in TRACKBAR_IDS:
+				name = TRACKBAR_IDS[controlID]
+				horizontal = name == "lensSizeHorizontal"
+				if msg == TBM_GETPOS:
+					value = self.pending[name]
+					return value - 10 if horizontal else 100 - value
+				if msg == TBM_SETPOSNOTIFY:
+					self.pending[name] = lParam + 10 if horizontal else 100 - lParam
+			return 0
+
+def _simulatedBindings(sim):
+	""" The plugin's Win32 bindings, answered by the simulation
+	"""
+	from Windows7Magnifier import winBindings
+	cursor = [(0, 0)]
+
+	def sendMessage(hwnd, msg, wParam, lParam):
+		if msg == WM_CLOSE and hwnd and hwnd == sim.mainWindow:
+			sim.close()
+			return 0
+		return sim.controlMessage(hwnd, msg, wParam, lParam)
+
+	def setForegroundWindow(hwnd):
+		sim.foreground = hwnd
+		return True
+
+	def sendInput(events):
+		for vk, flags in events:
+			sim.keyEvent(vk, flags)
+		return len(events)
+
+	def setCursorPos(x, y):
+		cursor[0] = (x, y)
+		return True
+
+	def postMessage(hwnd, msg, wParam, lParam):
+		if msg == WM_COMMAND:
+			# Delivered later, by the magnifier's message loop
+			sim.scheduler.after(0, sim.command, hwnd, wParam & 0xFFFF)
+		return bool(sim.windows.exists(hwnd))
+
+	def toolbarCommandAt(toolbar, x, y):
+		if not toolbar or toolbar != sim.toolbar: return None
+		return OPTIONS_COMMAND if (x, y) == (160, 15) else None
+
+	def mouseEvent(flags, x, y):
+		if flags & winBindings.MOUSEEVENTF_LEFTUP: sim.click()
+
+	return winBindings.FakeWin32Bindings(
+		findWindow=lambda windowClass=None, windowName=None: sim.windows.findWindow(windowClass, windowName),
+		showWindow=lambda hwnd, cmd: True,
+		keybdEvent=sim.keyEvent,
+		sendInput=sendInput,
+		getDlgItem=sim.dialogItem,
+		sendMessage=sendMessage,
+		postMessage=postMessage,
+		toolbarCommandAt=toolbarCommandAt,
+		getWindow=lambda hwnd, relation: sim.toolbar if hwnd and hwnd == sim.mainWindow else 0,
+		setForegroundWindow=setForegroundWindow,
+		getForegroundWindow=lambda: sim.foreground,
+		isWindow=lambda hwnd: sim.windows.exists(hwnd),
+		isWindowVisible=lambda hwnd: sim.windows.exists(hwnd),
+		getKeyboardLayout=lambda thread=0: 0x409,
+		getCursorPos=lambda: cursor[0],
+		setCursorPos=setCursorPos,
+		mouseEvent=mouseEvent,
+	)
+
+def _countingWindowBackend():
+	from Windows7Magnifier import windowWatcher
+	class CountingWindowBackend(windowWatcher.FakeWindowBackend):
+		def findWindow(self, windowClass, windowName):
+			counters.call("FindWindow")
+			return super(CountingWindowBackend, self).findWindow(windowClass, windowName)
+		def enumerateWindows(self, classes):
+			counters.call("EnumWindows")
+			return super(CountingWindowBackend, self).enumerateWindows(classes)
+		def isWindow(self, hwnd):
+			counters.call("IsWindow")
+			return super(CountingWindowBackend, self).isWindow(hwnd)
+		def exists(self, hwnd):
+			with self._lock:
+				return hwnd in self._windows
+	return CountingWindowBackend()
+
+def _countingProcessBackend():
+	from Windows7Magnifier import processTracker
+	class CountingProcessBackend(processTracker.FakeProcessBackend):
+		def findProcess(self, imageName):
+			counters.call("CreateToolhelp32Snapshot")
+			return super(CountingProcessBackend, self).findProcess(imageName)
+		def openProcess(self, pid):
+			counters.call("OpenProcess")
+			return super(CountingProcessBackend, self).openProcess(pid)
+		def hasExited(self, handle):
+			counters.call("WaitForSingleObject")
+			return super(CountingProcessBackend, self).hasExited(handle)
+	return CountingProcessBackend()
+
+#: The simulated magnifier, created by install()
+magnifier = None
+#: Everything spoken through ui.message
+messages = []
+#: Every tone played
+beeps = []
+
+def _module(name, **attrs):
+	module = types.ModuleType(name)
+	module.__dict__.update(attrs)
+	sys.modules[name] = module
+	return module
+
+def _countThreads():
+	start = threading.Thread.start
+	def countingStart(self):
+		counters.threadsStarted += 1
+		return start(self)
+	threading.Thread.start = countingStart
+
+def install(configPath=None, simulate=True, **latencies):
+	""" Put the stand-in modules in place and create the simulated
+		magnifier
+		@param configPath: where the addon's ini file lives (a temporary
+			directory by default)
+		@param simulate: False to only install the stand-in modules,
+			leaving the Win32 bindings to the caller (see replayTrace)
+		@param latencies: passed to L{SimulatedMagnifier}
+		@returns: the L{SimulatedMagnifier}, or None
+	"""
+	global magnifier
+	pluginDir = os.path.join(ADDON_DIR, "globalPlugins")
+	if pluginDir not in sys.path: sys.path.insert(0, pluginDir)
+	# The plugin decodes paths with the ANSI code page
+	codecs.register(lambda name: codecs.lookup("utf-8") if name == "mbcs" else None)
+	__builtin__._ = lambda text: text
+
+	log = logging.getLogger("nvda")
+	log.debugWarning = log.warning
+	_module("logHandler", log=log)
+	_module("globalVars", appArgs=types.ModuleType("appArgs"))
+	sys.modules["globalVars"].appArgs.configPath = configPath or tempfile.mkdtemp()
+	sys.modules["globalVars"].appArgs.secure = False
+	import validate
+	def validateConfig(conf, validator):
+		result = conf.validate(validator, preserve_errors=True)
+		if result is True: return []
+		return ["%s: %s" % (key, error) for key, error in (result.items() if isinstance(result, dict) else [])]
+	_module("config", val=validate.Validator(), validateConfig=validateConfig)
+
+	magnifier = SimulatedMagnifier(**latencies) if simulate else None
+	_installWin32(magnifier)
+	_installNVDA(magnifier)
+	if magnifier: magnifier.start()
+	_countThreads()
+	return magnifier
+
+def _installWin32(sim):
+	_module("winUser",
+		VK_SHIFT=VK_SHIFT, VK_CONTROL=VK_CONTROL, VK_MENU=VK_MENU, VK_CAPITAL=VK_CAPITAL,
+		VK_LWIN=VK_LWIN, VK_RWIN=VK_RWIN, VK_NUMLOCK=VK_NUMLOCK)
+
+	@counted("ShellExecute")
+	def ShellExecute(hwnd, operation, file, parameters, directory, showCmd):
+		if sim: sim.launch()
+	_module("shellapi", ShellExecute=ShellExecute)
+
+def _installNVDA(sim):
+	class GlobalPlugin(object):
+		def __init__(self): pass
+		def terminate(self): pass
+	_module("globalPluginHandler", GlobalPlugin=GlobalPlugin)
+
+	class AppModule(object):
+		def __init__(self, *args, **kwargs): pass
+	_module("appModuleHandler", AppModule=AppModule)
+
+	class Addon(object):
+		def __init__(self, path):
+			self.path = path
+			self.manifest = {"summary": u"Windows 7 Magnifier integration for the NVDA GUI"}
+	_module("addonHandler", Addon=Addon, initTranslation=lambda: None)
+
+	_module("ui", message=messages.append)
+	_module("tones", beep=lambda hz, length, *args: beeps.append(hz))
+	_module("speech", cancelSpeech=lambda: None)
+	_module("api")
+
+	class KeyboardInputGesture(object):
+		def __init__(self, name):
+			self.name = name
+		@classmethod
+		def fromName(cls, name):
+			return cls(name)
+		@counted("SendInput")
+		def send(self):
+			if sim and self.name == "enter": sim.enter()
+	_module("keyboardHandler", KeyboardInputGesture=KeyboardInputGesture)
+
+	class MenuItem(object):
+		pass
+	class Menu(object):
+		def __init__(self):
+			self.SubMenu = self
+		def FindItemByPosition(self, position): return self
+		def FindItem(self, label): return -1
+		def FindItemById(self, id): return MenuItem()
+		def Append(self, *args): return MenuItem()
+	class SysTrayIcon(object):
+		menu = Menu()
+		def Bind(self, *args): pass
+	class MainFrame(object):
+		sysTrayIcon = SysTrayIcon()
+		def _popupSettingsDialog(self, dialogClass, *args): pass
+	class SettingsDialog(object):
+		pass
+	_module("gui", mainFrame=MainFrame(), SettingsDialog=SettingsDialog, ExecAndPump=lambda func, *args, **kwargs: func(*args, **kwargs))
+
+	# Completion callbacks run straight away on the calling thread
+	_module("wx", ID_ANY=-1, EVT_MENU=None, CallAfter=lambda func, *args, **kwargs: func(*args, **kwargs))
+
+def loadPlugin(startWithNVDA=False, **config):
+	""" Import the plugin and construct it against the simulation
+		@param startWithNVDA: the plugin's startWithNVDA option
+		@param config: other [magnifier] options to set first
+		@returns: the GlobalPlugin instance
+	"""
+	import Windows7Magnifier
+	from Windows7Magnifier import Windows7MagnifierConfig
+	Windows7MagnifierConfig.getSettings().update(startWithNVDA=startWithNVDA, **config)
+	Windows7Magnifier.GlobalPlugin.windowBackendFactory = staticmethod(lambda: magnifier.windows)
+	Windows7Magnifier.GlobalPlugin.processBackendFactory = staticmethod(lambda: magnifier.processes)
+	Windows7Magnifier.GlobalPlugin.settingsStoreFactory = staticmethod(lambda: magnifier.store)
+	return Windows7Magnifier.GlobalPlugin()
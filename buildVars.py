@@ -42,3 +42,11 @@ i18nSources = pythonSources + ["buildVars.py"]
 # Files that will be ignored when building the nvda-addon file
 # Paths are relative to the addon directory, not to the root directory of your addon sources.
 excludedFiles = []
+
+# Bundle the python files as optimized bytecode (.pyo) instead of as source,
+# so NVDA doesn't have to compile them when the add-on is first loaded.
+# Off by default: the bundle only loads in an NVDA running the same Python
+# version as the build, and it can't be run from source. Python checks
+# bytecode against the time stamp of its source, which is reset when NVDA
+# installs the add-on, so the sources are left out.
+precompile = False